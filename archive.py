@@ -0,0 +1,178 @@
+# archive.py
+import io
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+from typing import IO, Any, Dict, Optional
+
+
+# 超过这个大小的流式成员（dairies.txt、dairies.html）先溢出到临时文件，再整体写入归档
+SPOOL_MAX_BYTES = 32 * 1024 * 1024
+
+# 按扩展名判断格式
+ARCHIVE_FORMATS = (
+    (".tar.gz", "tar.gz"),
+    (".tgz", "tar.gz"),
+    (".tar.zst", "tar.zst"),
+    (".tzst", "tar.zst"),
+    (".tar", "tar"),
+    (".zip", "zip"),
+)
+
+# zip 里不再压缩的成员（图片本身已是压缩格式）
+_STORED_EXTS = (".jpg", ".jpeg", ".png", ".gif", ".webp", ".bin")
+
+
+def archive_format(path: str) -> str:
+    lower = path.lower()
+    for suffix, fmt in ARCHIVE_FORMATS:
+        if lower.endswith(suffix):
+            return fmt
+    raise ValueError(f"unsupported archive type: {path} (use .tar / .tar.gz / .tar.zst / .zip)")
+
+
+def _zstd_writer(f: IO[bytes]) -> Any:
+    try:
+        import zstandard
+    except ImportError:
+        raise RuntimeError("writing .tar.zst needs the zstandard package: pip install zstandard") from None
+    return zstandard.ZstdCompressor(level=3).stream_writer(f, closefd=False)
+
+
+class ArchiveWriter:
+    """
+    把导出结果顺序写进一个归档文件（tar / tar.gz / tar.zst / zip），代替 images/ 下成千上万的小文件：
+    - add_bytes()：整块写入一个成员（图片在内存里下载完后直接写入，不落地）
+    - open()：流式写一个成员（dairies.txt、dairies.html），内容先进 SpooledTemporaryFile，关闭时写入归档
+    - 线程安全：多个下载线程可以同时 add_bytes，成员按完成顺序依次写出
+    - 先写 <path>.tmp，close() 成功后原子改名；abort() 删除半成品
+    - .tar.zst 需要 zstandard 包（Python 3.14+ 使用标准库）
+    成员名一律是归档内的相对路径（"images/image_1.jpg"），HTML 里的图片链接与之对应。
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.format = archive_format(path)
+        self.tmp_path = path + ".tmp"
+        self.members: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._raw = open(self.tmp_path, "wb")
+        self._zstd: Any = None
+        self._tar: Optional[tarfile.TarFile] = None
+        self._zip: Optional[zipfile.ZipFile] = None
+        try:
+            if self.format == "zip":
+                self._zip = zipfile.ZipFile(self._raw, "w", zipfile.ZIP_DEFLATED, allowZip64=True)
+            elif self.format == "tar.zst" and sys.version_info >= (3, 14):
+                self._tar = tarfile.open(fileobj=self._raw, mode="w|zst")
+            elif self.format == "tar.zst":
+                self._zstd = _zstd_writer(self._raw)
+                self._tar = tarfile.open(fileobj=self._zstd, mode="w|")
+            else:
+                self._tar = tarfile.open(fileobj=self._raw, mode="w|gz" if self.format == "tar.gz" else "w|")
+        except BaseException:
+            self._raw.close()
+            os.remove(self.tmp_path)
+            raise
+
+    def __enter__(self) -> "ArchiveWriter":
+        return self
+
+    def __exit__(self, exc_type: Any, *exc: Any) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def _claim(self, name: str, size: int) -> None:
+        if name in self.members:
+            raise ValueError(f"duplicate archive member: {name}")
+        self.members[name] = size
+
+    def _tarinfo(self, name: str, size: int) -> tarfile.TarInfo:
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mtime = int(time.time())
+        info.mode = 0o644
+        return info
+
+    def _zipinfo(self, name: str) -> zipfile.ZipInfo:
+        info = zipfile.ZipInfo(name, time.localtime()[:6])
+        info.compress_type = zipfile.ZIP_STORED if name.lower().endswith(_STORED_EXTS) else zipfile.ZIP_DEFLATED
+        info.external_attr = 0o644 << 16
+        return info
+
+    def add_bytes(self, name: str, data: bytes) -> int:
+        """写入一个成员，返回字节数。"""
+        with self._lock:
+            self._claim(name, len(data))
+            if self._zip is not None:
+                self._zip.writestr(self._zipinfo(name), data)
+            else:
+                self._tar.addfile(self._tarinfo(name, len(data)), io.BytesIO(data))
+        return len(data)
+
+    def _add_spooled(self, name: str, spool: IO[bytes]) -> None:
+        size = spool.tell()
+        spool.seek(0)
+        with self._lock:
+            self._claim(name, size)
+            if self._zip is not None:
+                with self._zip.open(self._zipinfo(name), "w", force_zip64=size > 0x7FFFFFFF) as dst:
+                    shutil.copyfileobj(spool, dst, 1024 * 1024)
+            else:
+                self._tar.addfile(self._tarinfo(name, size), spool)
+
+    def open(self, name: str, encoding: str = "utf-8") -> IO[str]:
+        """流式写一个文本成员；关闭返回的文件对象时写入归档。"""
+        return io.TextIOWrapper(io.BufferedWriter(_SpooledMember(self, name), 1 << 20), encoding=encoding)
+
+    def close(self) -> None:
+        if self._zip is not None:
+            self._zip.close()
+        if self._tar is not None:
+            self._tar.close()
+        if self._zstd is not None:
+            self._zstd.close()
+        self._raw.close()
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self) -> None:
+        # 内层 writer 也要关掉（写出的内容随后整个删除），否则它们析构时还会去写已关闭的文件
+        for writer in (self._zip, self._tar, self._zstd):
+            if writer is not None:
+                try:
+                    writer.close()
+                except Exception:
+                    pass
+        try:
+            self._raw.close()
+        finally:
+            if os.path.exists(self.tmp_path):
+                os.remove(self.tmp_path)
+
+
+class _SpooledMember(io.RawIOBase):
+    def __init__(self, archive: ArchiveWriter, name: str) -> None:
+        self.archive = archive
+        self.name = name
+        self._spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b: Any) -> int:
+        return self._spool.write(b)
+
+    def close(self) -> None:
+        if not self.closed:
+            try:
+                self.archive._add_spooled(self.name, self._spool)
+            finally:
+                self._spool.close()
+        super().close()
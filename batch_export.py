@@ -0,0 +1,217 @@
+# batch_export.py
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+from requests.adapters import HTTPAdapter
+
+import main
+from fetch_data import FairShareScheduler, RateLimiter
+
+
+# =========================
+# 批量导出多个账号：所有账号共用一个连接池、一份全局限速和在途名额
+# =========================
+
+# 账号列表（JSON 数组），每项：
+#   {"email": "...", "password": "..."}                          密码直接写在文件里
+#   {"email": "...", "password_env": "NIDERIJI_PASSWORD_B"}      或从环境变量读
+# 可选 "name"（输出目录名与指标里的 account 标签，默认由 email 生成）、"dir"（输出目录，默认 BATCH_OUTPUT_ROOT/name）
+ACCOUNTS_PATH = "accounts.json"
+
+# 每个账号一棵输出目录树：dairies.txt、images/、dairies.html、sync_state.json、run_report.json 等都在里面
+BATCH_OUTPUT_ROOT = "accounts"
+
+# 同时导出的账号数；按上次耗时从长到短开始（没跑过的排最前），总耗时接近最大的那个账号
+BATCH_MAX_ACCOUNTS = 8
+
+# 全体账号同时在途的请求数上限；名额按账号轮转发放，大账号不会饿住小账号
+BATCH_MAX_INFLIGHT = 16
+
+# 全体账号共用的限速（替代 main.py 里按单账号设置的 TEXT_RATE_RPS / IMAGE_RATE_*）
+BATCH_TEXT_RATE_RPS = 10.0
+BATCH_IMAGE_RATE_RPS = 10.0
+BATCH_IMAGE_RATE_BPS: Optional[float] = None
+
+# 批量运行状态：每个账号的 queued/running/ok/failed、耗时、错误；运行中随时更新
+BATCH_STATUS_PATH = "batch_status.json"
+
+
+def _account_name(email: str) -> str:
+    return re.sub(r"[^A-Za-z0-9._-]+", "_", email).strip("._") or "account"
+
+
+def load_accounts(path: str) -> List[Dict[str, Any]]:
+    """读取账号列表，补全 name/password，返回 [{"name", "email", "password", "dir"}]。"""
+    with open(path, "r", encoding="utf-8") as f:
+        raw = json.load(f)
+    if not isinstance(raw, list):
+        raise ValueError(f"{path}: expected a JSON array of accounts")
+
+    accounts: List[Dict[str, Any]] = []
+    seen: Dict[str, str] = {}
+    for i, item in enumerate(raw):
+        email = str(item.get("email") or "").strip()
+        if not email:
+            raise ValueError(f"{path}: account #{i} has no email")
+        password = item.get("password")
+        if not password and item.get("password_env"):
+            password = os.getenv(item["password_env"])
+        if not password:
+            raise ValueError(f"{path}: no password for {email}")
+        name = str(item.get("name") or _account_name(email))
+        if name in seen:
+            raise ValueError(f"{path}: {email} and {seen[name]} share the name {name!r}; set \"name\" explicitly")
+        seen[name] = email
+        accounts.append({
+            "name": name,
+            "email": email,
+            "password": password,
+            "dir": item.get("dir") or os.path.join(BATCH_OUTPUT_ROOT, name),
+        })
+    return accounts
+
+
+class BatchStatus:
+    """批量运行状态（线程安全），每次变化都原子地重写 path。"""
+
+    def __init__(self, path: Optional[str]) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self.previous: Dict[str, Dict[str, Any]] = {}
+        if path and os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    self.previous = json.load(f).get("accounts") or {}
+            except (OSError, ValueError):
+                self.previous = {}
+        self.data: Dict[str, Any] = {"started": time.time(), "finished": None, "accounts": {}}
+
+    def last_seconds(self, name: str) -> Optional[float]:
+        prev = self.previous.get(name) or {}
+        return prev.get("seconds") if prev.get("state") == "ok" else None
+
+    def update(self, name: str, **fields: Any) -> None:
+        with self._lock:
+            self.data["accounts"].setdefault(name, {}).update(fields)
+            self._write()
+
+    def finish(self) -> None:
+        with self._lock:
+            self.data["finished"] = time.time()
+            self._write()
+
+    def _write(self) -> None:
+        if not self.path:
+            return
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.data, f, ensure_ascii=False, indent=1)
+        os.replace(tmp, self.path)
+
+
+def run_batch(
+    accounts: List[Dict[str, Any]],
+    max_accounts: int = BATCH_MAX_ACCOUNTS,
+    max_inflight: int = BATCH_MAX_INFLIGHT,
+    status_path: Optional[str] = BATCH_STATUS_PATH,
+) -> int:
+    """
+    并发导出多个账号，返回失败的账号数。
+    - 每个账号是一个 main.ExportJob：独立的输出目录、同步状态、token 缓存与运行报告（指标带 account 标签）
+    - 共享：一个 HTTPAdapter（连接池）、正文/图片各一个全局 RateLimiter、一个 FairShareScheduler（在途名额）
+    - 一个账号失败不影响其他账号
+    """
+    status = BatchStatus(status_path)
+    scheduler = FairShareScheduler(max_inflight)
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=max_inflight + max_accounts)
+    text_limiter = RateLimiter(rate_rps=BATCH_TEXT_RATE_RPS)
+    image_limiter = RateLimiter(rate_rps=BATCH_IMAGE_RATE_RPS, rate_bps=BATCH_IMAGE_RATE_BPS)
+
+    # 最长的先开始（没有记录的视为最长），避免大账号最后才开跑拖长总时间
+    order = sorted(accounts, key=lambda a: -(status.last_seconds(a["name"]) or float("inf")))
+    for acc in order:
+        status.update(acc["name"], email=acc["email"], dir=acc["dir"], state="queued")
+
+    def run_one(acc: Dict[str, Any]) -> bool:
+        name = acc["name"]
+        job = main.ExportJob(
+            root=acc["dir"],
+            email=acc["email"],
+            password=acc["password"],
+            label=name,
+            adapter=adapter,
+            text_limiter=text_limiter,
+            image_limiter=image_limiter,
+            scheduler=scheduler,
+        )
+        t0 = time.time()
+        status.update(name, state="running", started=t0)
+        print(f"[batch] {name}: start -> {acc['dir']}")
+        ok = False
+        error: Optional[str] = None
+        try:
+            main.export_account(job)
+            ok = True
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            print(f"[batch] {name}: ERROR {error}", file=sys.stderr)
+        finally:
+            main._write_run_report(job, ok)
+        seconds = time.time() - t0
+        status.update(
+            name,
+            state="ok" if ok else "failed",
+            finished=time.time(),
+            seconds=round(seconds, 3),
+            error=error,
+            requests=scheduler.granted.get(name, 0),
+            report=job.metrics_json_path,
+        )
+        print(f"[batch] {name}: {'ok' if ok else 'FAILED'} in {seconds:.1f}s")
+        return ok
+
+    t0 = time.time()
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, max_accounts), thread_name_prefix="account") as ex:
+            results = list(ex.map(run_one, order))
+    finally:
+        status.finish()
+        adapter.close()
+
+    failed = results.count(False)
+    print(f"[batch] accounts={len(results)} ok={len(results) - failed} failed={failed} in {time.time() - t0:.1f}s")
+    if status_path:
+        print(f"[batch] status: {status_path}")
+    return failed
+
+
+def cli() -> int:
+    parser = argparse.ArgumentParser(description="并发导出多个 nideriji 账号（共享连接池与限速）")
+    parser.add_argument("accounts", nargs="?", default=ACCOUNTS_PATH, help=f"账号列表 JSON（默认 {ACCOUNTS_PATH}）")
+    parser.add_argument("--jobs", type=int, default=BATCH_MAX_ACCOUNTS, help="同时导出的账号数")
+    parser.add_argument("--inflight", type=int, default=BATCH_MAX_INFLIGHT, help="全体账号同时在途的请求数上限")
+    parser.add_argument("--status", default=BATCH_STATUS_PATH, help="状态文件路径")
+    args = parser.parse_args()
+
+    try:
+        accounts = load_accounts(args.accounts)
+    except (OSError, ValueError) as e:
+        print("ERROR:", e, file=sys.stderr)
+        return 2
+    if not accounts:
+        print("ERROR: no accounts", file=sys.stderr)
+        return 2
+    return 1 if run_batch(accounts, args.jobs, args.inflight, args.status) else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(cli())
@@ -0,0 +1,335 @@
+# bench/mock_server.py
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from email.parser import BytesParser
+from email.policy import default as default_policy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+
+from bench.synthetic import SyntheticAccount, account_from_args, add_account_args
+
+
+IMAGE_PATH_RE = re.compile(r"^/api/image/(\d+)/(\d+)/?$")
+ALL_BY_IDS_RE = re.compile(r"^/api/diary/all_by_ids/(\d+)/?$")
+USERID = 10001
+TOKEN = "bench-token"
+
+
+class MockConfig:
+    """
+    运行时可调的故障注入参数（也可以通过 POST /_bench/config 修改）：
+    - latency_ms：每个请求的固定延迟，jitter_ms 为额外的随机延迟上限
+    - error_rate：all_by_ids 与图片请求返回 503（带 Retry-After: 0）的概率
+    - truncate_rate：图片响应只发一半就断开连接的概率（测断点续传）
+    - sync_content：sync 响应里带完整正文的日记比例（0..1）
+    """
+
+    FIELDS = ("latency_ms", "jitter_ms", "error_rate", "truncate_rate", "sync_content")
+
+    def __init__(self, **kw: float) -> None:
+        self.latency_ms = 0.0
+        self.jitter_ms = 0.0
+        self.error_rate = 0.0
+        self.truncate_rate = 0.0
+        self.sync_content = 0.0
+        self.update(kw)
+
+    def update(self, values: Dict[str, Any]) -> None:
+        for k, v in values.items():
+            if k not in self.FIELDS:
+                raise ValueError(f"unknown config field: {k}")
+            setattr(self, k, float(v))
+
+    def as_dict(self) -> Dict[str, float]:
+        return {k: getattr(self, k) for k in self.FIELDS}
+
+
+def _parse_multipart(content_type: str, body: bytes) -> List[Tuple[str, str]]:
+    if not content_type.startswith("multipart/"):
+        return []
+    msg = BytesParser(policy=default_policy).parsebytes(
+        b"content-type: " + content_type.encode("latin-1") + b"\r\n\r\n" + body
+    )
+    return [(part.get_param("name", header="content-disposition"), part.get_content()) for part in msg.iter_parts()]
+
+
+def _as_int(v: Any) -> int:
+    try:
+        return int(v)
+    except (TypeError, ValueError):
+        return 0
+
+
+class MockNiderijiServer:
+    """
+    本地的 nideriji 替身（只实现导出用到的接口），数据来自 SyntheticAccount：
+      POST /api/login/                      -> {"token", "userid"}
+      POST /api/v2/sync/                    -> 按 diaries_ts/images_ts 水位返回 id/ts 索引
+      POST /api/diary/all_by_ids/<uid>/     -> 按 diary_ids 返回完整日记
+      GET  /api/image/<uid>/<image_id>/     -> 图片内容（支持 Range）
+    以及跑分脚本用的控制接口：
+      GET  /_bench/stats、POST /_bench/config、POST /_bench/touch、POST /_bench/reset_stats
+    fail_diaries 里的日记 id 出现在 all_by_ids 请求中时总是返回 503（测失败日记的重试）。
+    每次登录发一个新 token；除登录和控制接口外，请求头 auth 不是有效 token 时返回 401，
+    expire_tokens() 让已发出的 token 全部失效（测 token 缓存与重新登录）。
+    """
+
+    def __init__(self, account: SyntheticAccount, config: Optional[MockConfig] = None,
+                 host: str = "127.0.0.1", port: int = 0) -> None:
+        self.account = account
+        self.config = config or MockConfig()
+        self._lock = threading.Lock()
+        self._rng = random.Random(f"faults-{account.seed}")
+        self.stats: Dict[str, int] = {}
+        self.fail_diaries: set = set()
+        self.tokens: set = set()
+        self._issued = 0
+        self.reset_stats()
+        self.httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        self.httpd.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "MockNiderijiServer":
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="mock-nideriji", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def reset_stats(self) -> None:
+        with self._lock:
+            self.stats = {
+                "requests": 0, "login": 0, "sync": 0, "all_by_ids": 0, "diaries_served": 0,
+                "images": 0, "image_bytes": 0, "errors_injected": 0, "truncated": 0,
+                "unauthorized": 0, "inflight": 0, "max_inflight": 0,
+            }
+
+    def issue_token(self) -> str:
+        with self._lock:
+            self._issued += 1
+            token = f"{TOKEN}-{self._issued}"
+            self.tokens.add(token)
+            return token
+
+    def expire_tokens(self) -> None:
+        with self._lock:
+            self.tokens.clear()
+
+    def auth_headers(self) -> Dict[str, str]:
+        """直接调用接口（不经登录）时用的有效鉴权头。"""
+        return {"auth": f"token {self.issue_token()}"}
+
+    def _count(self, **delta: int) -> None:
+        with self._lock:
+            for k, v in delta.items():
+                self.stats[k] += v
+            self.stats["max_inflight"] = max(self.stats["max_inflight"], self.stats["inflight"])
+
+    def _roll(self, rate: float) -> bool:
+        if rate <= 0:
+            return False
+        with self._lock:
+            return self._rng.random() < rate
+
+    def _delay(self) -> None:
+        cfg = self.config
+        ms = cfg.latency_ms + (self._rng.uniform(0, cfg.jitter_ms) if cfg.jitter_ms else 0.0)
+        if ms > 0:
+            time.sleep(ms / 1000.0)
+
+    def sync(self, fields: Dict[str, str]) -> Dict[str, Any]:
+        acc = self.account
+        dts = _as_int(fields.get("diaries_ts"))
+        its = _as_int(fields.get("images_ts"))
+        diaries = []
+        for did in range(1, acc.n_diaries + 1):
+            ts = acc.diary_ts(did)
+            if ts <= dts:
+                continue
+            # 按 id 哈希决定是否带正文，同一篇日记每次结果一致
+            if self.config.sync_content and (did * 2654435761 % 1000) < self.config.sync_content * 1000:
+                diaries.append(acc.diary(did))
+            else:
+                diaries.append({"id": did, "ts": ts, "createddate": acc.createddate(did)})
+        images = [
+            {"image_id": iid, "ts": acc.image_ts(iid)}
+            for iid in range(1, acc.n_images + 1)
+            if acc.image_ts(iid) > its
+        ]
+        all_ts = [acc.diary_ts(d) for d in range(1, acc.n_diaries + 1)] or [0]
+        return {
+            "user_config": {"userid": USERID, "ts": acc.base_ts},
+            "user_config_ts": acc.base_ts,
+            "diaries": diaries,
+            "diaries_ts": max(all_ts),
+            "images": images,
+            "images_ts": max([acc.image_ts(i) for i in range(1, acc.n_images + 1)] or [0]),
+            "readmark_ts": acc.base_ts,
+        }
+
+    def _handler_class(self) -> type:
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args: Any) -> None:
+                pass
+
+            def _send(self, status: int, body: bytes, ctype: str = "application/json",
+                      headers: Optional[Dict[str, str]] = None, truncate: bool = False) -> None:
+                self.send_response(status)
+                self.send_header("Content-Type", ctype)
+                self.send_header("Content-Length", str(len(body)))
+                for k, v in (headers or {}).items():
+                    self.send_header(k, v)
+                self.end_headers()
+                if truncate:
+                    self.wfile.write(body[: len(body) // 2])
+                    self.wfile.flush()
+                    self.close_connection = True
+                    return
+                self.wfile.write(body)
+
+            def _json(self, obj: Any, status: int = 200) -> None:
+                self._send(status, json.dumps(obj, ensure_ascii=False).encode("utf-8"))
+
+            def _busy(self) -> None:
+                server._count(errors_injected=1)
+                self._send(503, b"busy", "text/plain", {"Retry-After": "0"})
+
+            def _authorized(self) -> bool:
+                auth = self.headers.get("auth") or ""
+                with server._lock:
+                    ok = auth.startswith("token ") and auth[len("token "):] in server.tokens
+                if not ok:
+                    server._count(unauthorized=1)
+                    self._json({"error": 401, "message": "token expired"}, 401)
+                return ok
+
+            def _read_body(self) -> bytes:
+                n = int(self.headers.get("Content-Length") or 0)
+                return self.rfile.read(n) if n else b""
+
+            def _enter(self) -> None:
+                server._count(requests=1, inflight=1)
+                server._delay()
+
+            def do_POST(self) -> None:
+                body = self._read_body()
+                if self.path.startswith("/_bench/"):
+                    return self._control(body)
+                self._enter()
+                try:
+                    fields = _parse_multipart(self.headers.get("Content-Type") or "", body)
+                    if self.path.rstrip("/") == "/api/login":
+                        server._count(login=1)
+                        return self._json({"error": 0, "token": server.issue_token(), "userid": USERID})
+                    if not self._authorized():
+                        return
+                    if self.path.rstrip("/") == "/api/v2/sync":
+                        server._count(sync=1)
+                        return self._json(server.sync(dict(fields)))
+                    if ALL_BY_IDS_RE.match(self.path):
+                        if server._roll(server.config.error_rate):
+                            return self._busy()
+                        ids = [_as_int(v) for k, v in fields if k == "diary_ids"]
+                        if server.fail_diaries.intersection(ids):
+                            return self._busy()
+                        diaries = [server.account.diary(i) for i in ids if 1 <= i <= server.account.n_diaries]
+                        server._count(all_by_ids=1, diaries_served=len(diaries))
+                        return self._json({"error": 0, "diaries": diaries})
+                    self._send(404, b"{}")
+                finally:
+                    server._count(inflight=-1)
+
+            def do_GET(self) -> None:
+                if self.path.startswith("/_bench/stats"):
+                    with server._lock:
+                        return self._json({"stats": dict(server.stats), "config": server.config.as_dict()})
+                self._enter()
+                try:
+                    m = IMAGE_PATH_RE.match(self.path)
+                    if not m:
+                        return self._send(404, b"")
+                    if not self._authorized():
+                        return
+                    if server._roll(server.config.error_rate):
+                        return self._busy()
+                    try:
+                        data, ctype = server.account.image(int(m.group(2)))
+                    except KeyError:
+                        return self._send(404, b"not found", "text/plain")
+                    truncate = server._roll(server.config.truncate_rate)
+                    server._count(images=1, image_bytes=len(data), truncated=int(truncate))
+                    rng = self.headers.get("Range") or ""
+                    rm = re.match(r"bytes=(\d+)-$", rng)
+                    if rm and int(rm.group(1)) < len(data):
+                        start = int(rm.group(1))
+                        return self._send(
+                            206, data[start:], ctype,
+                            {"Content-Range": f"bytes {start}-{len(data) - 1}/{len(data)}"}, truncate,
+                        )
+                    self._send(200, data, ctype, truncate=truncate)
+                finally:
+                    server._count(inflight=-1)
+
+            def _control(self, body: bytes) -> None:
+                payload = json.loads(body or b"{}")
+                if self.path.startswith("/_bench/config"):
+                    try:
+                        server.config.update(payload)
+                    except ValueError as e:
+                        return self._json({"error": str(e)}, 400)
+                    return self._json({"config": server.config.as_dict()})
+                if self.path.startswith("/_bench/touch"):
+                    ids = payload.get("diary_ids") or []
+                    count = int(payload.get("count") or 0)
+                    if count:
+                        rng = random.Random(f"touch-{len(server.account.revisions)}")
+                        ids = rng.sample(range(1, server.account.n_diaries + 1), min(count, server.account.n_diaries))
+                    server.account.touch(int(i) for i in ids)
+                    return self._json({"touched": len(ids)})
+                if self.path.startswith("/_bench/reset_stats"):
+                    server.reset_stats()
+                    return self._json({"ok": True})
+                self._send(404, b"{}")
+
+        return Handler
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="本地 nideriji 替身服务，供跑分和离线调试使用")
+    add_account_args(parser)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=0, help="0 表示随机端口")
+    for field in MockConfig.FIELDS:
+        parser.add_argument("--" + field.replace("_", "-"), type=float, default=0.0)
+    args = parser.parse_args()
+
+    config = MockConfig(**{f: getattr(args, f) for f in MockConfig.FIELDS})
+    server = MockNiderijiServer(account_from_args(args), config, args.host, args.port)
+    # 跑分脚本读这一行拿到地址
+    print(f"READY {server.base_url}", flush=True)
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,310 @@
+# bench/run_bench.py
+"""
+离线跑分：起一个本地 nideriji 替身（bench/mock_server.py），把 main.main 指向它，
+按场景统计每个阶段的耗时、吞吐和峰值内存。
+
+    python -m bench.run_bench                       # 默认场景
+    python -m bench.run_bench --diaries 20000 --images 5000 cold flaky
+    python -m bench.run_bench --list
+
+不会访问 nideriji.cn；每个场景在 --workdir 下的独立目录里运行。
+"""
+import argparse
+import contextlib
+import functools
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.request
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from bench.synthetic import SyntheticAccount, account_from_args, add_account_args, write_archive  # noqa: E402
+
+
+class PhaseRecord(NamedTuple):
+    name: str
+    seconds: float
+    items: int
+    peak_bytes: Optional[int]
+
+
+class PhaseMeter:
+    """
+    给 main 模块里的阶段函数套上计时/计数包装（按名字替换模块属性，结束后还原）。
+    - 峰值内存来自 tracemalloc（只统计 Python 分配），在没有其他阶段进行时才重置峰值；
+      流水线模式下各阶段重叠，嵌套阶段的峰值是从外层阶段开始算起的
+    """
+
+    def __init__(self, trace_memory: bool = True) -> None:
+        self.trace_memory = trace_memory
+        self.records: List[PhaseRecord] = []
+        self._lock = threading.Lock()
+        self._active = 0
+        self._restore: List[Callable[[], None]] = []
+
+    def wrap(self, module: Any, attr: str, name: str, count: Callable[[tuple, Any], int]) -> None:
+        original = getattr(module, attr)
+
+        @functools.wraps(original)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            with self._lock:
+                if self.trace_memory and self._active == 0:
+                    tracemalloc.reset_peak()
+                self._active += 1
+            t0 = time.perf_counter()
+            result = None
+            try:
+                result = original(*args, **kwargs)
+                return result
+            finally:
+                seconds = time.perf_counter() - t0
+                peak = tracemalloc.get_traced_memory()[1] if self.trace_memory else None
+                try:
+                    items = count(args, result)
+                except Exception:
+                    items = 0
+                with self._lock:
+                    self._active -= 1
+                    self.records.append(PhaseRecord(name, seconds, items, peak))
+
+        setattr(module, attr, wrapper)
+        self._restore.append(lambda: setattr(module, attr, original))
+
+    def restore(self) -> None:
+        while self._restore:
+            self._restore.pop()()
+
+
+def install_main_phases(meter: PhaseMeter, main_mod: Any, n_diaries: int) -> None:
+    meter.wrap(main_mod, "login_and_sync_index", "sync", lambda a, r: len(r[3]) + len(r[4]))
+    meter.wrap(main_mod, "run_pipeline", "pipeline", lambda a, r: len(a[3]) + len(a[4]))
+    meter.wrap(main_mod, "_export_text", "text", lambda a, r: len(a[3]))
+    meter.wrap(main_mod, "_export_images", "images", lambda a, r: len(a[3]))
+    meter.wrap(main_mod, "recover_images_from_bin", "recover", lambda a, r: r[0])
+    meter.wrap(main_mod, "export_as_html", "html", lambda a, r: n_diaries)
+
+
+class Scenario(NamedTuple):
+    name: str
+    description: str
+    # 运行期间覆盖的 main 模块配置常量
+    main_overrides: Dict[str, Any]
+    # 发给 mock 服务端的故障注入参数（见 MockConfig）
+    server: Dict[str, float]
+    # "fresh"：空目录；"incremental"：先完整导出一次，再改动 1% 的日记；"offline"：本地备份，不走网络
+    setup: str = "fresh"
+
+
+SCENARIOS = [
+    Scenario("cold", "空目录完整导出（流水线模式）", {"PIPELINE": True}, {}),
+    Scenario("cold-seq", "空目录完整导出（按阶段执行，能看清每个阶段）", {"PIPELINE": False}, {}),
+    Scenario(
+        "sync-content", "一半日记的正文随 sync 下发（少走 all_by_ids）",
+        {"PIPELINE": False}, {"sync_content": 0.5},
+    ),
+    Scenario("incremental", "已有备份，远端改动 1% 的日记后再导出", {"PIPELINE": False}, {}, "incremental"),
+    Scenario(
+        "flaky", "20±20ms 延迟、5% 503、2% 图片断流",
+        {"PIPELINE": False}, {"latency_ms": 20, "jitter_ms": 20, "error_rate": 0.05, "truncate_rate": 0.02},
+    ),
+    Scenario("offline", "本地已有 dairies.txt + 旧版 .bin 图片：main --offline（只跑恢复和 HTML）", {}, {}, "offline"),
+]
+DEFAULT_SCENARIOS = ("cold", "cold-seq", "incremental", "flaky", "offline")
+
+# 跑分测的是客户端代码本身，默认去掉对线上服务的礼貌性限速
+BENCH_MAIN_OVERRIDES = {"TEXT_RATE_RPS": 0, "IMAGE_RATE_RPS": 0}
+
+
+def _control(base_url: str, path: str, payload: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    if payload is None:
+        req = urllib.request.Request(base_url + path)
+    else:
+        req = urllib.request.Request(base_url + path, data=json.dumps(payload).encode("utf-8"), method="POST")
+    opener = urllib.request.build_opener(urllib.request.ProxyHandler({}))
+    with opener.open(req, timeout=30) as r:
+        return json.loads(r.read())
+
+
+def start_mock_server(args: argparse.Namespace) -> "tuple[subprocess.Popen, str]":
+    """在子进程里起 mock 服务（不和被测代码抢 GIL，也不算进被测进程的内存）。"""
+    cmd = [
+        sys.executable, "-m", "bench.mock_server",
+        "--diaries", str(args.diaries), "--images", str(args.images), "--seed", str(args.seed),
+        "--image-kb", str(args.image_kb), "--refs-per-diary", str(args.refs_per_diary),
+    ]
+    proc = subprocess.Popen(cmd, cwd=ROOT, stdout=subprocess.PIPE, text=True)
+    line = proc.stdout.readline() if proc.stdout else ""
+    if not line.startswith("READY "):
+        proc.kill()
+        raise RuntimeError(f"mock server failed to start: {line!r}")
+    return proc, line.split()[1]
+
+
+@contextlib.contextmanager
+def _chdir(path: str):
+    old = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(old)
+
+
+@contextlib.contextmanager
+def _overrides(module: Any, values: Dict[str, Any]):
+    old = {k: getattr(module, k) for k in values}
+    for k, v in values.items():
+        setattr(module, k, v)
+    try:
+        yield
+    finally:
+        for k, v in old.items():
+            setattr(module, k, v)
+
+
+def _run_main_quietly(main_mod: Any, log_path: str, argv: Optional[List[str]] = None) -> int:
+    with open(log_path, "a", encoding="utf-8") as log, contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+        return main_mod.main(argv or [])
+
+
+def run_scenario(
+    sc: Scenario,
+    args: argparse.Namespace,
+    base_url: str,
+    account: SyntheticAccount,
+    main_mod: Any,
+) -> Dict[str, Any]:
+    workdir = os.path.join(args.workdir, sc.name)
+    shutil.rmtree(workdir, ignore_errors=True)
+    os.makedirs(workdir)
+    log_path = os.path.join(workdir, "bench.log")
+    overrides = dict(BENCH_MAIN_OVERRIDES if not args.keep_rate_limits else {}, **sc.main_overrides)
+
+    with _chdir(workdir), _overrides(main_mod, overrides):
+        _control(base_url, "/_bench/config", {"latency_ms": 0, "jitter_ms": 0, "error_rate": 0,
+                                             "truncate_rate": 0, "sync_content": 0})
+        if sc.setup == "incremental":
+            if _run_main_quietly(main_mod, log_path) != 0:
+                raise RuntimeError(f"{sc.name}: initial export failed, see {log_path}")
+            _control(base_url, "/_bench/touch", {"count": max(1, args.diaries // 100)})
+        elif sc.setup == "offline":
+            write_archive(account, workdir)
+        _control(base_url, "/_bench/config", sc.server)
+        _control(base_url, "/_bench/reset_stats", {})
+
+        meter = PhaseMeter(trace_memory=not args.no_tracemalloc)
+        install_main_phases(meter, main_mod, args.diaries)
+        if meter.trace_memory:
+            tracemalloc.start()
+        t0 = time.perf_counter()
+        try:
+            # offline 与用户运行 python main.py --offline 走同一条路径（阶段指纹、recover、html）
+            rc = _run_main_quietly(main_mod, log_path, ["--offline"] if sc.setup == "offline" else None)
+        finally:
+            total = time.perf_counter() - t0
+            total_peak = tracemalloc.get_traced_memory()[1] if meter.trace_memory else None
+            if meter.trace_memory:
+                tracemalloc.stop()
+            meter.restore()
+        server = _control(base_url, "/_bench/stats")["stats"]
+
+    return {
+        "scenario": sc.name,
+        "description": sc.description,
+        "ok": rc == 0,
+        "seconds": total,
+        "peak_bytes": total_peak,
+        "phases": [r._asdict() for r in meter.records],
+        "server": server,
+        "workdir": workdir,
+    }
+
+
+def _mb(n: Optional[int]) -> str:
+    return "-" if n is None else f"{n / 1e6:.1f}"
+
+
+def format_report(result: Dict[str, Any]) -> str:
+    lines = [f"== {result['scenario']}: {result['description']}" + ("" if result["ok"] else " (FAILED)")]
+    lines.append(f"  {'phase':<10}{'seconds':>10}{'items':>10}{'items/s':>12}{'peak MB':>10}")
+    for p in result["phases"]:
+        rate = p["items"] / p["seconds"] if p["seconds"] > 0 else 0.0
+        lines.append(
+            f"  {p['name']:<10}{p['seconds']:>10.2f}{p['items']:>10}{rate:>12.1f}{_mb(p['peak_bytes']):>10}"
+        )
+    s = result["server"]
+    lines.append(f"  {'total':<10}{result['seconds']:>10.2f}{'':>22}{_mb(result['peak_bytes']):>10}")
+    lines.append(
+        f"  server: requests={s['requests']} all_by_ids={s['all_by_ids']} images={s['images']}"
+        f" image_MB={s['image_bytes'] / 1e6:.1f} injected_errors={s['errors_injected']}"
+        f" truncated={s['truncated']} max_inflight={s['max_inflight']}"
+    )
+    return "\n".join(lines)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="nideriji_exporter 离线跑分")
+    add_account_args(parser)
+    parser.add_argument("scenarios", nargs="*", help=f"要跑的场景，默认 {' '.join(DEFAULT_SCENARIOS)}")
+    parser.add_argument("--list", action="store_true", help="列出场景后退出")
+    parser.add_argument("--workdir", default=None, help="场景输出目录，默认临时目录（跑完删除）")
+    parser.add_argument("--json", default=None, help="把结果另存为 JSON")
+    parser.add_argument("--no-tracemalloc", action="store_true", help="不统计内存（tracemalloc 会拖慢运行）")
+    parser.add_argument("--keep-rate-limits", action="store_true", help="保留 main.py 里的限速配置")
+    args = parser.parse_args()
+
+    by_name = {sc.name: sc for sc in SCENARIOS}
+    if args.list:
+        for sc in SCENARIOS:
+            print(f"{sc.name:<14}{sc.description}")
+        return 0
+    unknown = [n for n in args.scenarios if n not in by_name]
+    if unknown:
+        parser.error(f"unknown scenario(s): {', '.join(unknown)}")
+
+    keep_workdir = args.workdir is not None
+    args.workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix="nideriji-bench-"))
+    proc, base_url = start_mock_server(args)
+    try:
+        # fetch_data 在导入时读取服务地址，所以先起服务、设好环境变量再导入 main
+        os.environ.update({
+            "NIDERIJI_API_HOST": base_url,
+            "NIDERIJI_IMAGE_HOST": base_url,
+            "NIDERIJI_EMAIL": "bench@example.com",
+            "NIDERIJI_PASSWORD": "bench",
+            "NO_PROXY": "127.0.0.1,localhost",
+        })
+        import main as main_mod
+
+        account = account_from_args(args)
+        print(f"[bench] mock={base_url} diaries={args.diaries} images={args.images} workdir={args.workdir}")
+        results = []
+        for name in args.scenarios or DEFAULT_SCENARIOS:
+            result = run_scenario(by_name[name], args, base_url, account, main_mod)
+            results.append(result)
+            print(format_report(result), flush=True)
+        print(f"[bench] process max RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB")
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as f:
+                json.dump(results, f, ensure_ascii=False, indent=2)
+        return 0 if all(r["ok"] for r in results) else 1
+    finally:
+        proc.terminate()
+        proc.wait()
+        if not keep_workdir:
+            shutil.rmtree(args.workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
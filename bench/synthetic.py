@@ -0,0 +1,181 @@
+# bench/synthetic.py
+import datetime
+import os
+import random
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+from diary_store import format_diary_text
+
+
+# 图片格式与出现比例；"bin" 表示服务端返回 application/octet-stream（需要按文件头识别），
+# "error" 是伪装成图片的 HTML 错误页
+IMAGE_KINDS = (
+    ("jpg", 0.45),
+    ("png", 0.25),
+    ("gif", 0.05),
+    ("webp", 0.05),
+    ("bin", 0.17),
+    ("error", 0.03),
+)
+
+_MAGIC = {
+    "jpg": (b"\xFF\xD8\xFF\xE0", "image/jpeg"),
+    "png": (b"\x89PNG\r\n\x1a\n", "image/png"),
+    "gif": (b"GIF89a", "image/gif"),
+}
+
+_ERROR_PAGE = b"<!DOCTYPE html><html><head><title>502 Bad Gateway</title></head><body>error</body></html>\n"
+
+_WORDS = (
+    "今天", "天气", "不错", "上班", "下班", "地铁", "朋友", "吃饭", "电影", "散步",
+    "想起", "以前", "周末", "咖啡", "读书", "写字", "雨", "风", "猫", "家",
+    "hello", "todo", "ok", "<b>", "&", "\"quoted\"",
+)
+
+
+class SyntheticAccount:
+    """
+    确定性的合成账号：同样的 (n_diaries, n_images, seed) 在任何进程里都生成同样的数据，
+    mock 服务端和跑分脚本各自生成一份即可，不用传文件。
+    - 日记 id 从 1 开始，每天一篇，正文里按比例穿插 [图N] 引用（含少量引用不存在的图片）
+    - 图片 id 从 1 开始，按 IMAGE_KINDS 的比例分配格式；内容按需生成，不常驻内存
+    """
+
+    def __init__(
+        self,
+        n_diaries: int,
+        n_images: int,
+        seed: int = 0,
+        image_kb: int = 32,
+        refs_per_diary: float = 1.0,
+        start_date: str = "2016-01-01",
+    ) -> None:
+        self.n_diaries = n_diaries
+        self.n_images = n_images
+        self.seed = seed
+        self.image_kb = image_kb
+        self.refs_per_diary = refs_per_diary
+        self.start = datetime.date.fromisoformat(start_date)
+        self.base_ts = 1_500_000_000_000
+        # 被 touch 过的日记：id -> 最近一次修改的序号（影响 ts 和正文）
+        self.revisions: Dict[int, int] = {}
+        self._edits = 0
+
+        rng = random.Random(f"kinds-{seed}")
+        names = [k for k, _ in IMAGE_KINDS]
+        weights = [w for _, w in IMAGE_KINDS]
+        self.kinds: Dict[int, str] = {i: rng.choices(names, weights)[0] for i in range(1, n_images + 1)}
+
+    def diary_ts(self, diary_id: int) -> int:
+        rev = self.revisions.get(diary_id)
+        if rev is None:
+            return self.base_ts + diary_id * 1000
+        # 改过的日记 ts 比所有原始日记都新，和真实服务端一样会越过上次同步的水位
+        return self.base_ts + (self.n_diaries + 1) * 1000 + rev
+
+    def image_ts(self, image_id: int) -> int:
+        return self.base_ts + image_id * 1000
+
+    def touch(self, diary_ids: Any) -> None:
+        """模拟在别的设备上编辑了这些日记：ts 变大，正文变化。"""
+        for did in diary_ids:
+            self._edits += 1
+            self.revisions[did] = self._edits
+
+    def createddate(self, diary_id: int) -> str:
+        return (self.start + datetime.timedelta(days=diary_id - 1)).isoformat()
+
+    def diary(self, diary_id: int) -> Dict[str, Any]:
+        rng = random.Random(f"diary-{self.seed}-{diary_id}")
+        lines = []
+        for _ in range(rng.randint(2, 12)):
+            if rng.random() < 0.3:
+                lines.append(f"[{rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}:{rng.randint(0, 59):02d}]")
+            lines.append("".join(rng.choice(_WORDS) for _ in range(rng.randint(5, 40))))
+        n_refs = int(self.refs_per_diary) + (1 if rng.random() < self.refs_per_diary % 1 else 0)
+        for _ in range(n_refs):
+            if self.n_images and rng.random() < 0.98:
+                ref = rng.randint(1, self.n_images)
+            else:
+                ref = self.n_images + rng.randint(1, 1000)
+            lines.insert(rng.randint(0, len(lines)), f"[图{ref}]")
+        rev = self.revisions.get(diary_id, 0)
+        if rev:
+            lines.append(f"(edited {rev})")
+        return {
+            "id": diary_id,
+            "createddate": self.createddate(diary_id),
+            "ts": self.diary_ts(diary_id),
+            "title": f"第 {diary_id} 篇" if rng.random() < 0.5 else "",
+            "content": "\n".join(lines),
+        }
+
+    def iter_diaries(self) -> Iterator[Dict[str, Any]]:
+        for did in range(1, self.n_diaries + 1):
+            yield self.diary(did)
+
+    def image(self, image_id: int) -> Tuple[bytes, str]:
+        """返回 (内容, 服务端声明的 Content-Type)。"""
+        kind = self.kinds.get(image_id)
+        if kind is None:
+            raise KeyError(image_id)
+        if kind == "error":
+            return _ERROR_PAGE, "application/octet-stream"
+        rng = random.Random(f"image-{self.seed}-{image_id}")
+        size = max(64, int(self.image_kb * 1024 * rng.uniform(0.5, 1.5)))
+        if kind == "webp":
+            head, ctype = b"RIFF" + (size - 8).to_bytes(4, "little") + b"WEBP", "image/webp"
+        else:
+            # bin：真实格式是 jpg/png，只是服务端不告诉你
+            head, ctype = _MAGIC[kind if kind != "bin" else rng.choice(("jpg", "png"))]
+            if kind == "bin":
+                ctype = "application/octet-stream"
+        return head + rng.randbytes(size - len(head)), ctype
+
+
+def write_archive(account: SyntheticAccount, root: str, legacy_bin_ratio: float = 1.0) -> Tuple[int, int]:
+    """
+    在 root 下写出一份"已经导出过"的本地备份：dairies.txt + images/。
+    - Content-Type 是图片的写成 image_<id>.<ext>
+    - octet-stream 的（含错误页）按旧版本的行为写成 image_<id>.bin，
+      legacy_bin_ratio 控制其中多少比例留作 .bin（其余已识别好）
+    供不走网络的恢复 / HTML 场景使用。返回 (日记数, 图片数)。
+    """
+    images_dir = os.path.join(root, "images")
+    os.makedirs(images_dir, exist_ok=True)
+    n = 0
+    with open(os.path.join(root, "dairies.txt"), "w", encoding="utf-8") as f:
+        for d in account.iter_diaries():
+            f.write(format_diary_text(d))
+            n += 1
+    rng = random.Random(f"archive-{account.seed}")
+    exts = {"image/jpeg": ".jpg", "image/png": ".png", "image/gif": ".gif", "image/webp": ".webp"}
+    for iid in range(1, account.n_images + 1):
+        body, ctype = account.image(iid)
+        ext = exts.get(ctype)
+        if ext is None:
+            if body.startswith(_ERROR_PAGE[:9]) or rng.random() < legacy_bin_ratio:
+                ext = ".bin"
+            else:
+                ext = ".jpg" if body.startswith(b"\xFF\xD8") else ".png"
+        with open(os.path.join(images_dir, f"image_{iid}{ext}"), "wb") as f:
+            f.write(body)
+    return n, account.n_images
+
+
+def account_from_args(args: Any, seed: Optional[int] = None) -> SyntheticAccount:
+    return SyntheticAccount(
+        n_diaries=args.diaries,
+        n_images=args.images,
+        seed=args.seed if seed is None else seed,
+        image_kb=args.image_kb,
+        refs_per_diary=args.refs_per_diary,
+    )
+
+
+def add_account_args(parser: Any) -> None:
+    parser.add_argument("--diaries", type=int, default=2000, help="日记篇数")
+    parser.add_argument("--images", type=int, default=500, help="图片张数")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--image-kb", type=int, default=32, help="图片平均大小（KB）")
+    parser.add_argument("--refs-per-diary", type=float, default=1.0, help="每篇日记平均的 [图N] 引用数")
@@ -0,0 +1,177 @@
+# diary_store.py
+import hashlib
+import os
+import sqlite3
+import threading
+from typing import Any, Dict, Iterable, Iterator, Optional
+
+
+def format_diary_text(d: Dict[str, Any]) -> str:
+    """一条日记在 dairies.txt 中的文本块（带 DiaryID + 日期 + TS 头）。"""
+    did = d.get("id")
+    createddate = d.get("createddate", "")
+    ts = d.get("ts", "")
+    title = (d.get("title") or "").strip()
+    content = d.get("content") or ""
+
+    parts = [f"=== DiaryID: {did} | Date: {createddate} | TS: {ts} ===\n"]
+    if title:
+        parts.append(f"Title: {title}\n")
+    parts.append(content)
+    if not content.endswith("\n"):
+        parts.append("\n")
+    parts.append("\n")
+    return "".join(parts)
+
+
+def _as_int(v: Any) -> int:
+    try:
+        return int(v)
+    except (TypeError, ValueError):
+        return 0
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS diaries (
+    id      INTEGER PRIMARY KEY,
+    date    TEXT NOT NULL DEFAULT '',
+    ts      INTEGER NOT NULL DEFAULT 0,
+    title   TEXT NOT NULL DEFAULT '',
+    content TEXT NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS diaries_ts ON diaries(ts);
+CREATE TABLE IF NOT EXISTS images (
+    id   INTEGER PRIMARY KEY,
+    path TEXT NOT NULL,
+    ts   INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+
+class SqliteDiaryStore:
+    """
+    SQLite 日记库，替代/补充 dairies.txt：
+    - diaries(id, date, ts, title, content)：按 id UPSERT，只有 ts 不比库里旧时才覆盖
+    - images(id, path, ts)：图片 ID 对应的本地文件
+    - 支持随机访问、按 ts 查询变化，dairies.txt 可以随时由 export_text 派生
+    线程安全（图片下载回调来自工作线程）。
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+        self._conn.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
+
+    def __enter__(self) -> "SqliteDiaryStore":
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.close()
+
+    def commit(self) -> None:
+        with self._lock:
+            self._conn.commit()
+
+    def upsert_diary(self, d: Dict[str, Any]) -> None:
+        self.upsert_diaries([d])
+
+    def upsert_diaries(self, diaries: Iterable[Dict[str, Any]]) -> None:
+        rows = [
+            (
+                int(d["id"]),
+                str(d.get("createddate") or ""),
+                _as_int(d.get("ts")),
+                (d.get("title") or "").strip(),
+                d.get("content") or "",
+            )
+            for d in diaries
+        ]
+        with self._lock:
+            self._conn.executemany(
+                """
+                INSERT INTO diaries (id, date, ts, title, content) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(id) DO UPDATE SET
+                    date = excluded.date, ts = excluded.ts, title = excluded.title, content = excluded.content
+                WHERE excluded.ts >= diaries.ts
+                """,
+                rows,
+            )
+
+    def set_image_path(self, image_id: int, path: str, ts: int = 0) -> None:
+        with self._lock:
+            self._conn.execute(
+                """
+                INSERT INTO images (id, path, ts) VALUES (?, ?, ?)
+                ON CONFLICT(id) DO UPDATE SET path = excluded.path, ts = MAX(images.ts, excluded.ts)
+                """,
+                (int(image_id), path, int(ts)),
+            )
+
+    def image_paths(self) -> Dict[int, str]:
+        with self._lock:
+            return {row[0]: row[1] for row in self._conn.execute("SELECT id, path FROM images")}
+
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM diaries").fetchone()[0]
+
+    def max_ts(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COALESCE(MAX(ts), 0) FROM diaries").fetchone()[0]
+
+    def signature(self) -> str:
+        """库内容的摘要（每篇日记的 id/ts、每张图片的 id/path），与 WAL/checkpoint 等文件状态无关。"""
+        h = hashlib.sha256()
+        with self._lock:
+            for row in self._conn.execute("SELECT id, ts FROM diaries ORDER BY id"):
+                h.update(b"d%d:%d\n" % row)
+            for image_id, path in self._conn.execute("SELECT id, path FROM images ORDER BY id"):
+                h.update(f"i{image_id}:{path}\n".encode("utf-8"))
+        return h.hexdigest()
+
+    def get(self, diary_id: int) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, date, ts, title, content FROM diaries WHERE id = ?", (int(diary_id),)
+            ).fetchone()
+        return self._row(row) if row else None
+
+    def iter_diaries(self, since_ts: Optional[int] = None, batch: int = 500) -> Iterator[Dict[str, Any]]:
+        """按 id 升序逐条产出（分批取，内存不随总量增长）；since_ts 只取 ts 更新的。"""
+        last_id = -1
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT id, date, ts, title, content FROM diaries"
+                    " WHERE id > ? AND ts > ? ORDER BY id LIMIT ?",
+                    (last_id, -1 if since_ts is None else int(since_ts), batch),
+                ).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield self._row(row)
+            last_id = rows[-1][0]
+
+    @staticmethod
+    def _row(row: Any) -> Dict[str, Any]:
+        return {"id": row[0], "createddate": row[1], "ts": row[2], "title": row[3], "content": row[4]}
+
+    def export_text(self, out_path: str) -> int:
+        """由库派生 dairies.txt，返回写出的日记数。"""
+        tmp = out_path + ".tmp"
+        n = 0
+        with open(tmp, "w", encoding="utf-8") as f:
+            for d in self.iter_diaries():
+                f.write(format_diary_text(d))
+                n += 1
+        os.replace(tmp, out_path)
+        return n
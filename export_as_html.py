@@ -1,53 +1,240 @@
 # export_as_html.py
+import hashlib
 import html
+import json
+import os
 import re
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
 from pathlib import Path
-from typing import Dict, Optional, List
+from typing import IO, Dict, Optional, List, Iterable, Iterator, Tuple, Union
+
+from archive import ArchiveWriter
+from diary_store import SqliteDiaryStore, format_diary_text
+from fragment_cache import FragmentCache
+from image_store import resolve_manifest
+from metrics import RENDER_BUCKETS, RunMetrics
 
 
 DIARY_HEADER_RE = re.compile(
     r"^===\s*DiaryID:\s*(\d+)\s*\|\s*Date:\s*([^|]+)\|\s*TS:\s*([0-9]+)\s*===$"
 )
+ANY_HEADER_RE = re.compile(r"^===\s*DiaryID:")
 TITLE_RE = re.compile(r"^Title:\s*(.*)$")
 IMG_REF_RE = re.compile(r"\[图(\d+)\]")
 TS_LINE_RE = re.compile(r"^\[(\d{1,2}:\d{2}:\d{2})\]$")
 
 
-def build_image_index(images_dir: Path) -> Dict[int, Path]:
+INDEX_NAME_RE = re.compile(r"^image_(\d+)\.[A-Za-z0-9]+$")
+IMAGE_INDEX_VERSION = 1
+# 目录 mtime 离扫描时刻太近时不可信：粗粒度时间戳的文件系统上，同一时刻内新增的文件不会改变 mtime
+MTIME_SLACK_NS = 2_000_000_000
+
+
+def _scan_image_names(images_dir: Path, known: Optional[set] = None) -> List[str]:
+    """os.scandir 列出 image_<id>.<ext> 文件名（目录顺序）；known 中的名字不再做正则/类型判断。"""
+    names: List[str] = []
+    with os.scandir(images_dir) as it:
+        for entry in it:
+            name = entry.name
+            if known is not None and name in known:
+                names.append(name)
+            elif INDEX_NAME_RE.match(name) and entry.is_file():
+                names.append(name)
+    return names
+
+
+def _cached_image_names(images_dir: Path, cache_path: Path) -> List[str]:
+    """
+    带旁路缓存的文件名列表：cache_path 记录目录 mtime 与上次的文件名；
+    mtime 没变（且不在可疑窗口内）直接复用，否则重新列目录，已知的名字只做集合查找。
+    """
+    st = os.stat(images_dir)
+    try:
+        with open(cache_path, "r", encoding="utf-8") as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        cached = None
+
+    known: Optional[set] = None
+    if (
+        isinstance(cached, dict)
+        and cached.get("version") == IMAGE_INDEX_VERSION
+        and cached.get("dir") == os.path.abspath(images_dir)
+    ):
+        if cached.get("mtime_ns") == st.st_mtime_ns and cached.get("scanned_ns", 0) - st.st_mtime_ns > MTIME_SLACK_NS:
+            return cached["names"]
+        known = set(cached["names"])
+
+    scanned_ns = time.time_ns()
+    names = _scan_image_names(images_dir, known)
+    data = {
+        "version": IMAGE_INDEX_VERSION,
+        "dir": os.path.abspath(images_dir),
+        "mtime_ns": st.st_mtime_ns,
+        "scanned_ns": scanned_ns,
+        "names": names,
+    }
+    tmp = cache_path.with_name(cache_path.name + ".tmp")
+    tmp.write_text(json.dumps(data, ensure_ascii=False), encoding="utf-8")
+    tmp.replace(cache_path)
+    return names
+
+
+def build_image_index(images_dir: Path, cache_path: Optional[Path] = None) -> Dict[int, Path]:
+    """
+    image_id -> 图片路径。同一 ID 有多个文件时优先非 .bin。
+    传入 cache_path（放在 images_dir 之外，例如 images.index.json）时目录没变就不重新列目录。
+    """
     index: Dict[int, Path] = {}
     if not images_dir.exists():
         return index
 
-    for p in images_dir.iterdir():
-        if not p.is_file():
-            continue
-        m = re.match(r"^image_(\d+)\.[A-Za-z0-9]+$", p.name)
-        if not m:
-            continue
-        img_id = int(m.group(1))
+    if cache_path is not None:
+        names = _cached_image_names(images_dir, cache_path)
+    else:
+        names = _scan_image_names(images_dir)
+    for name in names:
+        p = images_dir / name
+        img_id = int(INDEX_NAME_RE.match(name).group(1))
         if img_id not in index:
             index[img_id] = p
         else:
             if index[img_id].suffix.lower() == ".bin" and p.suffix.lower() != ".bin":
                 index[img_id] = p
+
+    # 内容寻址布局：没有硬链接的 image_id 通过 manifest 指向仓库中的对象
+    for img_id, p in resolve_manifest(images_dir).items():
+        if img_id not in index and p.exists():
+            index[img_id] = p
     return index
 
 
-def _replace_img_refs(escaped_text: str, img_index: Dict[int, Path], images_dir: Path) -> str:
+FALLBACK_NAME_RE = re.compile(r"^image_(\d+)\.")
+PARTIAL_SUFFIXES = (".part", ".tmp")
+
+
+class ImageResolver:
+    """
+    一次导出共用的图片解析器，代替逐个引用的 glob + exists：
+    - 先查 img_index（目录扫描 / manifest / 日记库得到的路径，导出过程中可被其他线程补充）
+    - 查不到时查兜底表：第一次未命中时用 os.scandir 把 images_dir、旧的 recovery_images/
+      （或 images/）以及它们的 _non_image/ 各扫一遍，收集所有 image_<id>.* 文件
+    - 之后只做字典查找，不再访问文件系统；找不到的 ID 进负缓存并记入 missing，
+      只在 _non_image/ 里出现的另记入 non_image（下载到的不是图片）
+    - link_base 为 HTML 所在目录：相对路径的图片按它换算成页面里的链接（href），
+      不传或为当前目录时原样使用
+    - fallback=False 时不扫描任何目录，只认 img_index（图片写进归档时，本地目录里的文件不算数）
+    """
+
+    def __init__(
+        self,
+        images_dir: Path,
+        img_index: Optional[Dict[int, Path]] = None,
+        extra_dirs: Optional[Iterable[Path]] = None,
+        non_image_subdir: str = "_non_image",
+        link_base: Optional[Path] = None,
+        fallback: bool = True,
+    ) -> None:
+        self.images_dir = images_dir
+        self.link_base = None if link_base is None or link_base == Path(".") else link_base
+        self.index = img_index if img_index is not None else {}
+        if extra_dirs is None:
+            extra_dirs = [images_dir.parent / name for name in ("images", "recovery_images")]
+        self.extra_dirs = [d for d in extra_dirs if d != images_dir]
+        self.non_image_subdir = non_image_subdir
+        self.fallback = fallback
+        self.missing: set = set()
+        self.non_image: set = set()
+        self._fallback: Optional[Dict[int, Path]] = None
+        self._non_image_ids: set = set()
+
+    def _scan(self) -> None:
+        best: Dict[int, Tuple] = {}
+        dirs = [self.images_dir, *self.extra_dirs] if self.fallback else []
+        for rank, d in enumerate(dirs):
+            for entry in _scandir_files(d):
+                m = FALLBACK_NAME_RE.match(entry.name)
+                if not m or entry.name.endswith(PARTIAL_SUFFIXES):
+                    continue
+                img_id = int(m.group(1))
+                # 与原先 glob 兜底的优先级一致：非 .bin 优先，其次按文件名
+                sort_key = (rank, entry.name.lower().endswith(".bin"), entry.name, d / entry.name)
+                if img_id not in best or sort_key < best[img_id]:
+                    best[img_id] = sort_key
+            for entry in _scandir_files(d / self.non_image_subdir):
+                m = FALLBACK_NAME_RE.match(entry.name)
+                if m:
+                    self._non_image_ids.add(int(m.group(1)))
+        self._fallback = {img_id: k[3] for img_id, k in best.items()}
+
+    def prepare(self) -> None:
+        """提前扫描兜底目录（例如在把解析器交给子进程之前）。"""
+        if self._fallback is None:
+            self._scan()
+
+    def resolve(self, img_id: int) -> Optional[Path]:
+        p = self.index.get(img_id)
+        if p is not None:
+            return p
+        if img_id in self.missing:
+            return None
+        if self._fallback is None:
+            self._scan()
+        p = self._fallback.get(img_id)
+        if p is None:
+            self.missing.add(img_id)
+            if img_id in self._non_image_ids:
+                self.non_image.add(img_id)
+        return p
+
+    def href(self, p: Path) -> str:
+        """图片在页面里的链接。"""
+        if self.link_base is None or p.is_absolute():
+            return p.as_posix()
+        return Path(os.path.relpath(p, self.link_base)).as_posix()
+
+    def mark_non_image(self, img_id: int) -> None:
+        """记录一个被判定为非图片的下载（流水线中扫描之后才下载完的情况）。"""
+        self._non_image_ids.add(img_id)
+        if img_id in self.missing:
+            self.non_image.add(img_id)
+
+    def missing_ids(self) -> List[int]:
+        """本次导出中引用了但找不到的图片 ID（之后又被补进 img_index 的不算）。"""
+        return sorted(i for i in self.missing if i not in self.index)
+
+    def report(self) -> List[int]:
+        missing = self.missing_ids()
+        if missing:
+            non_image = sorted(i for i in self.non_image if i not in self.index)
+            sample = ", ".join(str(i) for i in missing[:20])
+            more = " ..." if len(missing) > 20 else ""
+            print(f"[html] missing images: {len(missing)} (non-image downloads: {len(non_image)}) ids: {sample}{more}")
+        return missing
+
+
+def _scandir_files(d: Path) -> Iterator[os.DirEntry]:
+    try:
+        with os.scandir(d) as it:
+            for entry in it:
+                if entry.is_file():
+                    yield entry
+    except OSError:
+        return
+
+
+def _replace_img_refs(escaped_text: str, resolver: ImageResolver) -> str:
     def repl(m: re.Match) -> str:
         img_id = int(m.group(1))
-        p: Optional[Path] = img_index.get(img_id)
+        p = resolver.resolve(img_id)
 
         if p is None:
-            candidates = list(images_dir.glob(f"image_{img_id}.*"))
-            if candidates:
-                candidates.sort(key=lambda x: (x.suffix.lower() == ".bin", x.name))
-                p = candidates[0]
-
-        if p is None or not p.exists():
             return f'<span class="img-missing">图片已丢失（图{img_id}）</span>'
 
-        rel = p.as_posix()
+        rel = resolver.href(p)
         return (
             f'<figure class="img-wrap">'
             f'<img src="{html.escape(rel)}" alt="图{img_id}" loading="lazy" />'
@@ -58,7 +245,7 @@ def _replace_img_refs(escaped_text: str, img_index: Dict[int, Path], images_dir:
     return IMG_REF_RE.sub(repl, escaped_text)
 
 
-def render_content_to_html(raw_text: str, img_index: Dict[int, Path], images_dir: Path) -> str:
+def render_content_to_html(raw_text: str, resolver: ImageResolver) -> str:
     lines = raw_text.splitlines()
     blocks: List[str] = []
     buf: List[str] = []
@@ -69,7 +256,7 @@ def render_content_to_html(raw_text: str, img_index: Dict[int, Path], images_dir
             return
         text = "\n".join(buf).strip("\n")
         esc = html.escape(text).replace("\n", "<br>")
-        esc = _replace_img_refs(esc, img_index, images_dir)
+        esc = _replace_img_refs(esc, resolver)
         blocks.append(f'<p class="p">{esc}</p>')
         buf = []
 
@@ -91,94 +278,99 @@ def render_content_to_html(raw_text: str, img_index: Dict[int, Path], images_dir
     return "\n".join(blocks)
 
 
-def parse_dairies_txt(dairies_path: Path) -> List[Dict]:
-    entries: List[Dict] = []
-    current: Optionallne = None  # type: ignore
-
-    current = None
-    with dairies_path.open("r", encoding="utf-8") as f:
-        for raw in f:
-            line = raw.rstrip("\n")
+def _iter_entries_from_lines(lines: Iterable[str]) -> Iterator[Dict]:
+    current: Optional[Dict] = None
+    for raw in lines:
+        line = raw.rstrip("\n")
+
+        mh = DIARY_HEADER_RE.match(line)
+        if mh:
+            if current is not None:
+                yield current
+            current = {
+                "id": int(mh.group(1)),
+                "date": mh.group(2).strip(),
+                "ts": mh.group(3).strip(),
+                "title": "",
+                "content_lines": [],
+            }
+            continue
 
-            mh = DIARY_HEADER_RE.match(line)
-            if mh:
-                if current is not None:
-                    entries.append(current)
-                current = {
-                    "id": int(mh.group(1)),
-                    "date": mh.group(2).strip(),
-                    "ts": mh.group(3).strip(),
-                    "title": "",
-                    "content_lines": [],
-                }
-                continue
+        if ANY_HEADER_RE.match(line):
+            # "=== DiaryID: x | (no data) ===" 之类的块：结束上一条，本块跳过
+            if current is not None:
+                yield current
+            current = None
+            continue
 
-            if current is None:
-                continue
+        if current is None:
+            continue
 
-            mt = TITLE_RE.match(line)
-            if mt:
-                current["title"] = mt.group(1).strip()
-                continue
+        mt = TITLE_RE.match(line)
+        if mt:
+            current["title"] = mt.group(1).strip()
+            continue
 
-            current["content_lines"].append(line)
+        current["content_lines"].append(line)
 
     if current is not None:
-        entries.append(current)
+        yield current
 
-    entries.sort(key=lambda x: x["id"])
-    return entries
 
+def parse_diary_block(block: str) -> Optional[Dict]:
+    """解析 dairies.txt 中的单条日记文本块；(no data) 等无法解析的块返回 None。"""
+    for e in _iter_entries_from_lines(block.splitlines()):
+        return e
+    return None
 
-def export_as_html(
-    dairies_txt: str = "dairies.txt",
-    images_dir: str = "recovery_images",
-    out_html: str = "dairies.html",
-) -> None:
-    dairies_path = Path(dairies_txt)
-    images_path = Path(images_dir)
-    out_path = Path(out_html)
 
-    if not dairies_path.exists():
-        raise FileNotFoundError(f"Not found: {dairies_path}")
+def iter_dairies_txt(dairies_path: Path) -> Iterator[Dict]:
+    """逐条产出 dairies.txt 中的日记（文件顺序），同一时刻只持有一条。"""
+    with dairies_path.open("r", encoding="utf-8") as f:
+        yield from _iter_entries_from_lines(f)
 
-    img_index = build_image_index(images_path)
-    entries = parse_dairies_txt(dairies_path)
 
-    date_map: Dict[str, List[int]] = {}
-    for e in entries:
-        date_map.setdefault(e["date"], []).append(e["id"])
+def scan_dairies_txt(dairies_path: Path) -> Tuple[int, bool]:
+    """只看 header 行扫一遍：返回 (日记数, 是否已按 DiaryID 升序)。"""
+    count = 0
+    last_id = None
+    ordered = True
+    with dairies_path.open("r", encoding="utf-8") as f:
+        for line in f:
+            mh = DIARY_HEADER_RE.match(line)
+            if not mh:
+                continue
+            did = int(mh.group(1))
+            if last_id is not None and did < last_id:
+                ordered = False
+            last_id = did
+            count += 1
+    return count, ordered
 
-    diary_blocks: List[str] = []
-    last_day = None
-    for e in entries:
-        did = e["id"]
-        ymd = e["date"]
-        title = e["title"] or ""
-        ts = e["ts"]
 
-        day_anchor = ""
-        if ymd != last_day:
-            day_anchor = f'<div class="day-anchor" id="day-{html.escape(ymd)}"></div>'
-            last_day = ymd
+def parse_dairies_txt(dairies_path: Path) -> List[Dict]:
+    entries = list(iter_dairies_txt(dairies_path))
+    entries.sort(key=lambda x: x["id"])
+    return entries
+
 
-        raw_text = "\n".join(e["content_lines"]).strip("\n")
-        merged_html = render_content_to_html(raw_text, img_index, images_path)
+def iter_store_entries(store: SqliteDiaryStore) -> Iterator[Dict]:
+    """按 DiaryID 升序产出库中的日记条目，字段与 parse_dairies_txt 的结果一致。"""
+    for d in store.iter_diaries():
+        e = parse_diary_block(format_diary_text(d))
+        if e is not None:
+            yield e
 
-        diary_blocks.append(
-            f"""
-            {day_anchor}
-            <section class="diary" id="diary-{did}" data-date="{html.escape(ymd)}">
-              <div class="title">{html.escape(title) if title else "（无标题）"}</div>
-              <div class="meta">DiaryID: {did} · Date: {html.escape(ymd)} · TS: {html.escape(ts)}</div>
-              <div class="content">{merged_html}</div>
-            </section>
-            """
-        )
 
-    dates_js_array = "[" + ",".join(f'"{d}"' for d in sorted(date_map.keys())) + "]"
+def merge_store_image_paths(img_index: Dict[int, Path], store: SqliteDiaryStore, non_image_subdir: str = "_non_image") -> None:
+    """把库里记录的图片路径补进 img_index（目录扫描结果优先，非图片文件跳过）。"""
+    for img_id, path in store.image_paths().items():
+        p = Path(path)
+        if p.parent.name != non_image_subdir and img_id not in img_index and p.exists():
+            img_index[img_id] = p
+
 
-    css = """
+CSS = """
     :root { color-scheme: light; }
     body {
       font-family: -apple-system,BlinkMacSystemFont,"Segoe UI",Roboto,Arial,"PingFang SC","Microsoft YaHei",sans-serif;
@@ -293,13 +485,40 @@ def export_as_html(
     .cal-collapsed .cal-body { display: none; }
     """
 
-    js = f"""
+
+def _calendar_js(
+    dates: Iterable[str],
+    shard_files: Optional[Dict[str, str]] = None,
+    shard_key_len: int = 7,
+    before_jump_js: str = "",
+) -> str:
+    """
+    日历脚本。传入 shard_files（分片 key -> 文件名）时用于分页输出：
+    点击的日期不在当前页就跳到对应分片页的锚点，打开带 #day-YYYY-MM-DD 的页面时日历显示该月。
+    before_jump_js 插在 jumpToDate 查找锚点之前（虚拟列表用它先把目标日期的日记放进 DOM）。
+    """
+    dates_js_array = "[" + ",".join(f'"{d}"' for d in sorted(dates)) + "]"
+    initial_js = ""
+    missing_js = 'alert("该日期没有找到对应日记锚点：" + key);'
+    if shard_files is not None:
+        initial_js = """
+      const fromHash = /^#day-(\\d{4})-(\\d{2})/.exec(location.hash);
+      if (fromHash) return {y: Number(fromHash[1]), m: Number(fromHash[2])};"""
+        missing_js = f"""const shardFiles = {json.dumps(shard_files, ensure_ascii=False, sort_keys=True)};
+        const file = shardFiles[key.slice(0, {shard_key_len})];
+        const here = decodeURIComponent(location.pathname.split("/").pop());
+        if (file && file !== here) {{
+          location.href = encodeURIComponent(file) + "#day-" + key;
+        }} else {{
+          alert("该日期没有找到对应日记锚点：" + key);
+        }}"""
+    return f"""
     const diaryDates = new Set({dates_js_array});
     const WEEKDAYS = ["一","二","三","四","五","六","日"];
     function pad2(n) {{ return String(n).padStart(2, "0"); }}
     function ymdStr(y,m,d) {{ return `${{y}}-${{pad2(m)}}-${{pad2(d)}}`; }}
 
-    function getInitialYM() {{
+    function getInitialYM() {{{initial_js}
       const keys = Array.from(diaryDates).sort();
       if (keys.length > 0) {{
         const last = keys[keys.length-1];
@@ -378,7 +597,7 @@ def export_as_html(
       }}
     }}
 
-    function jumpToDate(key) {{
+    function jumpToDate(key) {{{before_jump_js}
       const anchor = document.getElementById("day-" + key);
       if (anchor) {{
         anchor.scrollIntoView({{ behavior: "smooth", block: "start" }});
@@ -390,7 +609,7 @@ def export_as_html(
           }}
         }}, 350);
       }} else {{
-        alert("该日期没有找到对应日记锚点：" + key);
+        {missing_js}
       }}
     }}
 
@@ -450,22 +669,8 @@ def export_as_html(
     renderCalendar();
     """
 
-    html_doc = f"""<!doctype html>
-<html lang="zh-CN">
-<head>
-<meta charset="utf-8" />
-<meta name="viewport" content="width=device-width, initial-scale=1" />
-<title>dairies export</title>
-<style>{css}</style>
-</head>
-<body>
-  <div class="page">
-    <h1>日记导出</h1>
-    <div class="meta">来源：{html.escape(str(dairies_path))} · 图片目录：{html.escape(str(images_path))} · 日记数：{len(entries)} · 已索引图片：{len(img_index)}</div>
-    {''.join(diary_blocks)}
-  </div>
 
-  <div class="calendar-float" id="calendarFloat">
+CALENDAR_HTML = """  <div class="calendar-float" id="calendarFloat">
     <div class="cal-header" id="calHeader">
       <div class="cal-title">日历</div>
       <div class="cal-actions">
@@ -482,11 +687,667 @@ def export_as_html(
       <div class="cal-grid" id="calGrid"></div>
     </div>
   </div>
+"""
+
 
-<script>{js}</script>
+def render_diary_section(e: Dict, resolver: ImageResolver, day_anchor: bool) -> str:
+    did = e["id"]
+    ymd = e["date"]
+    title = e["title"] or ""
+    ts = e["ts"]
+
+    anchor_html = ""
+    if day_anchor:
+        anchor_html = f'<div class="day-anchor" id="day-{html.escape(ymd)}"></div>'
+
+    merged_html = e.get("content_html")
+    if merged_html is None:
+        raw_text = "\n".join(e["content_lines"]).strip("\n")
+        merged_html = render_content_to_html(raw_text, resolver)
+
+    return f"""
+            {anchor_html}
+            <section class="diary" id="diary-{did}" data-date="{html.escape(ymd)}">
+              <div class="title">{html.escape(title) if title else "（无标题）"}</div>
+              <div class="meta">DiaryID: {did} · Date: {html.escape(ymd)} · TS: {html.escape(ts)}</div>
+              <div class="content">{merged_html}</div>
+            </section>
+            """
+
+
+# 渲染逻辑（render_diary_section / render_content_to_html）变化时加一，旧的片段缓存随之全部失效
+FRAGMENT_VERSION = 2
+
+
+def fragment_key(e: Dict, resolver: ImageResolver, day_anchor: bool) -> str:
+    """
+    片段缓存的 key：日记字段 + 正文哈希 + 引用图片解析到的路径 + 是否带日期锚点。
+    解析只查内存中的索引：图片下载/改名后路径变化，key 随之变化；缺图也照常记入 resolver.missing。
+    """
+    raw = "\n".join(e["content_lines"])
+    h = hashlib.blake2b(digest_size=20)
+    h.update(f'{FRAGMENT_VERSION}\x1f{e["id"]}\x1f{e["date"]}\x1f{e["ts"]}\x1f{e["title"]}\x1f{day_anchor:d}\x1f'.encode("utf-8"))
+    for m in IMG_REF_RE.finditer(raw):
+        p = resolver.resolve(int(m.group(1)))
+        h.update(f'{m.group(1)}={resolver.href(p) if p is not None else ""}\x1f'.encode("utf-8"))
+    h.update(raw.encode("utf-8"))
+    return h.hexdigest()
+
+
+_worker_resolver: Optional[ImageResolver] = None
+
+
+def _init_render_worker(resolver: ImageResolver) -> None:
+    global _worker_resolver
+    _worker_resolver = resolver
+
+
+def _render_contents(
+    raw_texts: List[Optional[str]],
+) -> Tuple[List[Optional[str]], List[int], List[int], List[float]]:
+    """子进程里渲染一批正文；顺带交回本批新发现的缺图 ID 和每篇的渲染耗时，由主进程汇总。"""
+    r = _worker_resolver
+    htmls: List[Optional[str]] = []
+    seconds: List[float] = []
+    for raw in raw_texts:
+        if raw is None:
+            htmls.append(None)
+            continue
+        t0 = time.perf_counter()
+        htmls.append(render_content_to_html(raw, r))
+        seconds.append(time.perf_counter() - t0)
+    missing, non_image = list(r.missing), list(r.non_image)
+    r.missing.clear()
+    r.non_image.clear()
+    return htmls, missing, non_image, seconds
+
+
+def render_entries_parallel(
+    entries: Iterable[Dict],
+    resolver: ImageResolver,
+    workers: int,
+    chunk_size: int = 200,
+    cache: Optional[FragmentCache] = None,
+    metrics: Optional[RunMetrics] = None,
+) -> Iterator[Dict]:
+    """
+    用进程池预先渲染正文（render_content_to_html），结果放进 e["content_html"]，按原顺序产出 entries。
+    - 每 chunk_size 篇为一个任务，在途任务不超过 workers * 2（内存有界）
+    - 传入 cache 时，已有缓存片段的日记不再渲染
+    - resolver（含索引和兜底表）在进程启动时传给每个 worker 一次，之后的变化不会同步过去
+    - 传入 metrics 时记录子进程里每篇正文的渲染耗时
+    """
+    def raw_for(e: Dict) -> Optional[str]:
+        if cache is not None:
+            keys = (fragment_key(e, resolver, True), fragment_key(e, resolver, False))
+            if cache.contains(e["id"], keys):
+                return None
+        return "\n".join(e["content_lines"]).strip("\n")
+
+    it = iter(entries)
+    pending: deque = deque()
+    resolver.prepare()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_render_worker, initargs=(resolver,)) as ex:
+        def submit() -> bool:
+            chunk = list(islice(it, chunk_size))
+            if not chunk:
+                return False
+            pending.append((chunk, ex.submit(_render_contents, [raw_for(e) for e in chunk])))
+            return True
+
+        while len(pending) < workers * 2 and submit():
+            pass
+        while pending:
+            chunk, fut = pending.popleft()
+            htmls, missing, non_image, seconds = fut.result()
+            resolver.missing.update(missing)
+            resolver.non_image.update(non_image)
+            if metrics is not None:
+                for dt in seconds:
+                    metrics.observe("render_diary_seconds", dt, RENDER_BUCKETS, where="worker")
+            for e, content_html in zip(chunk, htmls):
+                if content_html is not None:
+                    e["content_html"] = content_html
+                yield e
+            submit()
+
+
+def _page_head(meta_html: str) -> str:
+    return f"""<!doctype html>
+<html lang="zh-CN">
+<head>
+<meta charset="utf-8" />
+<meta name="viewport" content="width=device-width, initial-scale=1" />
+<title>dairies export</title>
+<style>{CSS}</style>
+</head>
+<body>
+  <div class="page">
+    <h1>日记导出</h1>
+    <div class="meta">{meta_html}</div>
+    """
+
+
+def _page_tail(
+    dates: Iterable[str],
+    footer_html: str = "",
+    script_src: Optional[str] = None,
+    script_js: Optional[str] = None,
+) -> str:
+    """script_src 不为空时引用外部日历脚本（分页输出共用一份），否则内联 script_js（默认为日历脚本）。"""
+    if script_src:
+        script = f'<script src="{html.escape(script_src)}"></script>'
+    else:
+        script = f"<script>{_calendar_js(dates) if script_js is None else script_js}</script>"
+    return f"""{footer_html}
+  </div>
+
+{CALENDAR_HTML}
+{script}
 </body>
 </html>
 """
 
-    out_path.write_text(html_doc, encoding="utf-8")
-    print(f"OK: wrote {out_path} (entries={len(entries)}, diary_dates={len(date_map)}, images_indexed={len(img_index)})")
+
+class DiaryHtmlWriter:
+    """
+    流式写出 dairies.html：先写页头，entries 按 DiaryID 升序逐条 write()，
+    日历所需的日期在写出时顺带收集，close() 时写日历脚本并原子替换 out_html。
+    img_index 可以在写的过程中被其他线程补充（例如边下载边渲染）。
+    - 事先知道日记数时可直接传入完整的 meta_html（写在页头，不再写页脚统计）
+    - 传入 cache（FragmentCache）时未变化的日记直接复用上次渲染的片段；
+      close() 时清理本次没用到的缓存（abort() 不清理；evict_cache=False 时由调用方负责）
+    - 写出内容同时计算摘要；close() 时若与 unchanged_digest 相同且文件已存在，则保留旧文件不替换
+    - 图片通过 resolver（ImageResolver，默认按 img_index/images_dir 新建）解析，缺图列表见 resolver.report()
+    - 传入 metrics 时记录每篇日记的渲染耗时、片段来源（缓存/渲染）和写出的文件
+    - 传入 archive（ArchiveWriter）时 out_html 是归档内的成员名，页面直接写进归档（unchanged_digest 不生效）
+    """
+
+    def __init__(
+        self,
+        out_html: str,
+        img_index: Dict[int, Path],
+        images_dir: Path,
+        source_label: str = "",
+        meta_html: Optional[str] = None,
+        buffer_size: int = 1 << 20,
+        cache: Optional[FragmentCache] = None,
+        evict_cache: bool = True,
+        footer: Optional[bool] = None,
+        script_src: Optional[str] = None,
+        unchanged_digest: Optional[str] = None,
+        resolver: Optional[ImageResolver] = None,
+        metrics: Optional[RunMetrics] = None,
+        archive: Optional[ArchiveWriter] = None,
+    ) -> None:
+        self.out_path = Path(out_html)
+        self.tmp_path = self.out_path.with_name(self.out_path.name + ".tmp")
+        self.buffer_size = buffer_size
+        self.archive = archive
+        self.img_index = img_index
+        self.images_dir = images_dir
+        self.resolver = resolver if resolver is not None else ImageResolver(images_dir, img_index)
+        self.dates: Dict[str, int] = {}
+        self.count = 0
+        self._last_day: Optional[str] = None
+        self.cache = cache
+        self.evict_cache = evict_cache
+        self.script_src = script_src
+        self.unchanged_digest = unchanged_digest
+        self.metrics = metrics
+        self.changed = True
+        self._digest = hashlib.blake2b(digest_size=20)
+        self._footer = meta_html is None if footer is None else footer
+        if meta_html is None:
+            meta_html = f"来源：{html.escape(source_label)} · 图片目录：{html.escape(str(images_dir))}"
+        self._f: Optional[IO[str]]
+        if archive is not None:
+            self._f = archive.open(self.out_path.as_posix())
+        else:
+            self._f = self.tmp_path.open("w", encoding="utf-8", buffering=buffer_size)
+        self._write(_page_head(meta_html))
+
+    def _write(self, text: str) -> None:
+        if self._f is None:
+            # suspend() 之后接着写
+            self._f = self.tmp_path.open("a", encoding="utf-8", buffering=self.buffer_size)
+        self._f.write(text)
+        self._digest.update(text.encode("utf-8"))
+
+    def suspend(self) -> None:
+        """关闭文件句柄但保留写出状态，下次 write / close 时以追加方式重新打开（归档模式下不做任何事）。"""
+        if self.archive is None and self._f is not None:
+            self._f.close()
+            self._f = None
+
+    @property
+    def digest(self) -> str:
+        return self._digest.hexdigest()
+
+    def _section(self, e: Dict) -> str:
+        """渲染（或从缓存取出）一篇日记的 <section>，并记录日期。"""
+        ymd = e["date"]
+        day_anchor = ymd != self._last_day
+        if self.cache is None:
+            section = self._render(e, day_anchor)
+        else:
+            key = fragment_key(e, self.resolver, day_anchor)
+            section = self.cache.get(e["id"], key)
+            if section is None:
+                section = self._render(e, day_anchor)
+                self.cache.put(e["id"], key, section)
+            elif self.metrics is not None:
+                self.metrics.inc("html_fragments_total", source="cache")
+        self._last_day = ymd
+        self.dates[ymd] = self.dates.get(ymd, 0) + 1
+        self.count += 1
+        return section
+
+    def _render(self, e: Dict, day_anchor: bool) -> str:
+        if self.metrics is None:
+            return render_diary_section(e, self.resolver, day_anchor)
+        t0 = time.perf_counter()
+        section = render_diary_section(e, self.resolver, day_anchor)
+        self.metrics.observe("render_diary_seconds", time.perf_counter() - t0, RENDER_BUCKETS, where="main")
+        self.metrics.inc("html_fragments_total", source="prerendered" if "content_html" in e else "render")
+        return section
+
+    def write(self, e: Dict) -> None:
+        self._write(self._section(e))
+
+    def _footer_html(self) -> str:
+        if not self._footer:
+            return ""
+        return f'<div class="meta">日记数：{self.count} · 已索引图片：{len(self.img_index)}</div>'
+
+    def _tail(self) -> str:
+        return _page_tail(self.dates.keys(), self._footer_html(), self.script_src)
+
+    def close(self) -> None:
+        self._write(self._tail())
+        self._f.close()
+        if self.archive is not None:
+            if self.metrics is not None:
+                self.metrics.file_written("html", self.archive.members[self.out_path.as_posix()])
+        elif self.unchanged_digest == self.digest and self.out_path.exists():
+            self.changed = False
+            self.tmp_path.unlink()
+        else:
+            self.tmp_path.replace(self.out_path)
+            if self.metrics is not None:
+                self.metrics.file_written("html", self.out_path.stat().st_size)
+        if self.cache is not None and self.evict_cache:
+            evicted = self.cache.evict_stale()
+            print(f"[html] fragment cache: hits={self.cache.hits} misses={self.cache.misses} evicted={evicted}")
+
+    def abort(self) -> None:
+        # 归档模式下半截的成员随整个归档一起丢弃
+        if self._f is not None:
+            self._f.close()
+        if self.archive is None:
+            self.tmp_path.unlink(missing_ok=True)
+
+
+VLIST_CSS = """
+    .vchunk { display: flow-root; overflow-anchor: auto; }
+"""
+
+VLIST_JS = """
+    const vChunks = Array.from(document.querySelectorAll(".vchunk"));
+    const vLoaded = new Set();
+    function vShow(el) {
+      if (vLoaded.has(el)) return;
+      const data = document.getElementById("vdata-" + el.dataset.chunk);
+      el.innerHTML = JSON.parse(data.textContent).join("");
+      el.style.minHeight = "";
+      vLoaded.add(el);
+    }
+    function vHide(el) {
+      if (!vLoaded.has(el)) return;
+      el.style.minHeight = el.offsetHeight + "px";
+      el.innerHTML = "";
+      vLoaded.delete(el);
+    }
+    const vObserver = new IntersectionObserver((items) => {
+      for (const it of items) {
+        if (it.isIntersecting) vShow(it.target); else vHide(it.target);
+      }
+    }, { rootMargin: "2000px 0px" });
+    for (const el of vChunks) vObserver.observe(el);
+    function vlistShow(key) {
+      const i = vDateChunk[key];
+      if (i !== undefined) vShow(vChunks[i]);
+    }
+"""
+
+
+def _estimate_height(e: Dict) -> int:
+    """日记渲染后的大致像素高度，只用作占位；真实高度在展开后由浏览器决定。"""
+    lines = sum(1 for ln in e["content_lines"] if ln.strip())
+    images = sum(len(IMG_REF_RE.findall(ln)) for ln in e["content_lines"])
+    return 150 + 30 * lines + 360 * images
+
+
+class VirtualHtmlWriter(DiaryHtmlWriter):
+    """
+    虚拟列表版的单文件 dairies.html：
+    - 每 chunk_size 篇渲染好的日记存成一段 <script type="application/json">，页面上只有按估算高度占位的空 div
+    - IntersectionObserver 只把视口附近的分块放进 DOM，离开后再移除（保留实际高度），
+      5 万篇以上也能快速首屏、平滑滚动
+    - 日期 -> 分块号的索引写在页尾，日历跳转时先展开目标分块再定位锚点
+    """
+
+    def __init__(self, *args, chunk_size: int = 50, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.chunk_size = chunk_size
+        self._chunk: List[str] = []
+        self._chunk_height = 0
+        self._chunks = 0
+        self._date_chunk: Dict[str, int] = {}
+        self._write(f"<style>{VLIST_CSS}</style>")
+
+    def write(self, e: Dict) -> None:
+        self._date_chunk.setdefault(e["date"], self._chunks)
+        self._chunk.append(self._section(e))
+        self._chunk_height += _estimate_height(e)
+        if len(self._chunk) >= self.chunk_size:
+            self._flush_chunk()
+
+    def _flush_chunk(self) -> None:
+        if not self._chunk:
+            return
+        data = json.dumps(self._chunk, ensure_ascii=False).replace("</", "<\\/")
+        self._write(
+            f'\n<div class="vchunk" data-chunk="{self._chunks}" style="min-height:{self._chunk_height}px"></div>'
+            f'\n<script type="application/json" id="vdata-{self._chunks}">{data}</script>'
+        )
+        self._chunk = []
+        self._chunk_height = 0
+        self._chunks += 1
+
+    def _tail(self) -> str:
+        self._flush_chunk()
+        index = json.dumps(self._date_chunk, ensure_ascii=False, sort_keys=True)
+        calendar = _calendar_js(self.dates.keys(), before_jump_js="\n      vlistShow(key);")
+        script = f"\n    const vDateChunk = {index};" + VLIST_JS + calendar
+        return _page_tail(self.dates.keys(), self._footer_html(), script_js=script)
+
+
+SHARD_MODES = ("month", "year")
+# 分页输出时最多同时打开的分片文件数
+SHARD_MAX_OPEN = 8
+_SHARD_KEY_LEN = {"month": 7, "year": 4}
+SHARD_DATE_RE = re.compile(r"^\d{4}-\d{2}")
+
+
+def shard_key(date: str, mode: str) -> str:
+    """日期所属的分片：month -> "YYYY-MM"，year -> "YYYY"；日期格式不对的归到 "undated"。"""
+    if not SHARD_DATE_RE.match(date):
+        return "undated"
+    return date[:_SHARD_KEY_LEN[mode]]
+
+
+def _replace_if_changed(path: Path, text: str) -> bool:
+    """内容不同才（原子地）重写 path，返回是否写了。"""
+    try:
+        if path.read_text(encoding="utf-8") == text:
+            return False
+    except OSError:
+        pass
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(text, encoding="utf-8")
+    tmp.replace(path)
+    return True
+
+
+def shard_outputs(out_html: str) -> List[str]:
+    """
+    分页输出上次写出的全部文件：索引页、日历脚本、shards.json 和其中记录的每个分片页。
+    还没有 shards.json 时只有索引页和它本身（缺了就说明需要重新生成）。
+    """
+    out_path = Path(out_html)
+    manifest_path = out_path.with_name(f"{out_path.stem}.shards.json")
+    files = [str(out_path), str(out_path.with_name(f"{out_path.stem}-calendar.js")), str(manifest_path)]
+    try:
+        shards = json.loads(manifest_path.read_text(encoding="utf-8")).get("shards", {})
+    except (OSError, ValueError):
+        return files
+    return files + [str(out_path.with_name(info["file"])) for info in shards.values() if info.get("file")]
+
+
+class ShardedHtmlWriter:
+    """
+    分页输出：每月（或每年）一页 <stem>-<分片>.html，out_html 变成只有目录和日历的索引页。
+    - 接口与 DiaryHtmlWriter 相同（write / close / abort / count / dates），可直接替换
+    - 日历脚本放在共用的 <stem>-calendar.js，点击其他月份的日期会跳到对应分片页；
+      新增日期只改这个脚本和索引页，不影响其他分片
+    - <stem>.shards.json 记录每个分片的内容摘要：没变的分片不替换文件，本次没出现的分片被删除
+    - 最多同时打开 max_open 个分片文件（按最近写入），其余暂时关闭（DiaryHtmlWriter.suspend），
+      再写到时追加打开；日记按 DiaryID 顺序到达，日期基本有序，通常只有一两个分片在写
+    - 传入 archive 时所有页面和脚本直接写进归档（每次都是完整的一份，不读写 shards.json）
+    """
+
+    def __init__(
+        self,
+        out_html: str,
+        img_index: Dict[int, Path],
+        images_dir: Path,
+        mode: str = "month",
+        source_label: str = "",
+        cache: Optional[FragmentCache] = None,
+        resolver: Optional[ImageResolver] = None,
+        metrics: Optional[RunMetrics] = None,
+        archive: Optional[ArchiveWriter] = None,
+        max_open: int = SHARD_MAX_OPEN,
+    ) -> None:
+        if mode not in SHARD_MODES:
+            raise ValueError(f"mode must be one of {SHARD_MODES}, got {mode!r}")
+        self.out_path = Path(out_html)
+        self.img_index = img_index
+        self.images_dir = images_dir
+        self.mode = mode
+        self.source_label = source_label
+        self.cache = cache
+        self.resolver = resolver if resolver is not None else ImageResolver(images_dir, img_index)
+        self.metrics = metrics
+        self.archive = archive
+        self.script_name = f"{self.out_path.stem}-calendar.js"
+        self.manifest_path = self.out_path.with_name(f"{self.out_path.stem}.shards.json")
+        self.dates: Dict[str, int] = {}
+        self.count = 0
+        self._old_mode, self._old = self._load_manifest() if archive is None else (None, {})
+        self._writers: Dict[str, DiaryHtmlWriter] = {}
+        self.max_open = max(1, max_open)
+        # 当前打开着文件的分片，按最近写入排序（dict 保持插入顺序）
+        self._open: Dict[str, None] = {}
+
+    def _load_manifest(self) -> Tuple[Optional[str], Dict[str, Dict]]:
+        try:
+            data = json.loads(self.manifest_path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return None, {}
+        return data.get("mode"), data.get("shards", {})
+
+    def shard_file(self, key: str) -> str:
+        return f"{self.out_path.stem}-{key}.html"
+
+    def write(self, e: Dict) -> None:
+        key = shard_key(e["date"], self.mode)
+        w = self._writers.get(key)
+        if w is None:
+            meta_html = (
+                f'<a href="{html.escape(self.out_path.name)}">返回目录</a> · {html.escape(key)} · '
+                f"图片目录：{html.escape(str(self.images_dir))}"
+            )
+            w = DiaryHtmlWriter(
+                str(self.out_path.with_name(self.shard_file(key))),
+                self.img_index,
+                self.images_dir,
+                meta_html=meta_html,
+                buffer_size=1 << 16,
+                cache=self.cache,
+                evict_cache=False,
+                script_src=self.script_name,
+                unchanged_digest=self._old.get(key, {}).get("digest") if self._old_mode == self.mode else None,
+                resolver=self.resolver,
+                metrics=self.metrics,
+                archive=self.archive,
+            )
+            self._writers[key] = w
+        self._open.pop(key, None)
+        self._open[key] = None
+        while len(self._open) > self.max_open:
+            oldest = next(iter(self._open))
+            del self._open[oldest]
+            self._writers[oldest].suspend()
+        w.write(e)
+        ymd = e["date"]
+        self.dates[ymd] = self.dates.get(ymd, 0) + 1
+        self.count += 1
+
+    def _index_html(self, shards: Dict[str, Dict]) -> str:
+        by_group: Dict[str, List[str]] = {}
+        for key, info in sorted(shards.items()):
+            link = (
+                f'<a href="{html.escape(info["file"])}">{html.escape(key)}</a>'
+                f'（{info["count"]} 篇）'
+            )
+            by_group.setdefault(key[:4], []).append(link)
+        sections = "".join(
+            f"""
+            <section class="diary">
+              <div class="title">{html.escape(group)}</div>
+              <div class="content"><p class="p">{" · ".join(links)}</p></div>
+            </section>
+            """
+            for group, links in by_group.items()
+        )
+        meta_html = (
+            f"来源：{html.escape(self.source_label)} · 图片目录：{html.escape(str(self.images_dir))} · "
+            f"日记数：{self.count} · 已索引图片：{len(self.img_index)}"
+        )
+        return _page_head(meta_html) + sections + _page_tail((), script_src=self.script_name)
+
+    def close(self) -> None:
+        shards: Dict[str, Dict] = {}
+        rewritten = 0
+        for key, w in sorted(self._writers.items()):
+            w.close()
+            rewritten += w.changed
+            shards[key] = {"file": self.shard_file(key), "digest": w.digest, "count": w.count}
+
+        # 删掉本次没有出现的分片（含切换 month/year 前的旧分片）
+        removed = 0
+        current = {info["file"] for info in shards.values()}
+        for info in self._old.values():
+            if info.get("file") and info["file"] not in current:
+                self.out_path.with_name(info["file"]).unlink(missing_ok=True)
+                removed += 1
+
+        shard_files = {key: info["file"] for key, info in shards.items()}
+        outputs = (
+            (self.out_path.with_name(self.script_name), _calendar_js(self.dates.keys(), shard_files, _SHARD_KEY_LEN[self.mode])),
+            (self.out_path, self._index_html(shards)),
+        )
+        if self.archive is not None:
+            for path, text in outputs:
+                n = self.archive.add_bytes(path.as_posix(), text.encode("utf-8"))
+                if self.metrics is not None:
+                    self.metrics.file_written("html", n)
+        else:
+            outputs += (
+                (self.manifest_path, json.dumps({"mode": self.mode, "shards": shards}, ensure_ascii=False, indent=1)),
+            )
+            for path, text in outputs:
+                if _replace_if_changed(path, text) and self.metrics is not None:
+                    self.metrics.file_written("html", path.stat().st_size)
+        print(f"[html] shards={len(shards)} rewritten={rewritten} removed={removed}")
+
+        if self.cache is not None:
+            evicted = self.cache.evict_stale()
+            print(f"[html] fragment cache: hits={self.cache.hits} misses={self.cache.misses} evicted={evicted}")
+
+    def abort(self) -> None:
+        for w in self._writers.values():
+            w.abort()
+
+
+def export_as_html(
+    dairies_txt: str = "dairies.txt",
+    images_dir: str = "recovery_images",
+    out_html: str = "dairies.html",
+    dairies_db: Optional[str] = None,
+    cache_path: Optional[str] = None,
+    shard: Optional[str] = None,
+    virtual: bool = False,
+    workers: int = 1,
+    chunk_size: int = 200,
+    image_index_cache: Optional[str] = None,
+    metrics: Optional[RunMetrics] = None,
+) -> List[int]:
+    """
+    - 默认读取 dairies_txt
+    - 传入 dairies_db（SqliteDiaryStore 文件）时改为从库中读取日记与图片路径，不再解析文本文件
+    - 传入 cache_path 时使用片段缓存（FragmentCache），只重新渲染有变化的日记
+    - shard="month"/"year" 时按月/年分页输出（见 ShardedHtmlWriter），out_html 为索引页
+    - virtual=True 时输出虚拟列表版的单文件页面（见 VirtualHtmlWriter）
+    - workers > 1 时用进程池并行渲染正文（每个任务 chunk_size 篇），输出顺序不变
+    - image_index_cache 为图片目录索引的旁路缓存文件（见 build_image_index）
+    - 传入 metrics（RunMetrics）时记录每篇日记的渲染耗时与写出的文件
+    返回引用了但找不到的图片 ID 列表（同时打印摘要）。
+    日记逐条解析、渲染并写入文件，内存占用与日记总数无关；
+    只有 dairies.txt 不是按 DiaryID 升序时才整体读入排序。
+    """
+    dairies_path = Path(dairies_db or dairies_txt)
+    images_path = Path(images_dir)
+
+    if not dairies_path.exists():
+        raise FileNotFoundError(f"Not found: {dairies_path}")
+
+    img_index = build_image_index(images_path, Path(image_index_cache) if image_index_cache else None)
+    store: Optional[SqliteDiaryStore] = None
+    entries: Iterable[Dict]
+    if dairies_db:
+        store = SqliteDiaryStore(dairies_db)
+        merge_store_image_paths(img_index, store)
+        count = store.count()
+        entries = iter_store_entries(store)
+    else:
+        count, ordered = scan_dairies_txt(dairies_path)
+        entries = iter_dairies_txt(dairies_path) if ordered else parse_dairies_txt(dairies_path)
+
+    meta_html = (
+        f"来源：{html.escape(str(dairies_path))} · 图片目录：{html.escape(str(images_path))} · "
+        f"日记数：{count} · 已索引图片：{len(img_index)}"
+    )
+    cache = FragmentCache(cache_path) if cache_path else None
+    resolver = ImageResolver(images_path, img_index, link_base=Path(out_html).parent)
+    writer: Union[DiaryHtmlWriter, ShardedHtmlWriter]
+    if shard:
+        writer = ShardedHtmlWriter(
+            out_html, img_index, images_path, shard, str(dairies_path), cache=cache, resolver=resolver, metrics=metrics
+        )
+    elif virtual:
+        writer = VirtualHtmlWriter(
+            out_html, img_index, images_path, meta_html=meta_html, cache=cache, resolver=resolver, metrics=metrics
+        )
+    else:
+        writer = DiaryHtmlWriter(
+            out_html, img_index, images_path, meta_html=meta_html, cache=cache, resolver=resolver, metrics=metrics
+        )
+    if workers > 1:
+        entries = render_entries_parallel(entries, resolver, workers, chunk_size, cache, metrics)
+    try:
+        for e in entries:
+            writer.write(e)
+        writer.close()
+    except BaseException:
+        writer.abort()
+        raise
+    finally:
+        if store is not None:
+            store.close()
+        if cache is not None:
+            cache.close()
+    print(f"OK: wrote {writer.out_path} (entries={writer.count}, diary_dates={len(writer.dates)}, images_indexed={len(img_index)})")
+    return resolver.report()
@@ -1,14 +1,42 @@
 # fetch_data.py
+import codecs
+import functools
+import hashlib
+import heapq
+import io
+import json
 import os
+import random
 import re
 import time
+import threading
 import requests
-from typing import List, Dict, Any, Tuple, Optional
+from requests.adapters import HTTPAdapter
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import IO, List, Dict, Any, Tuple, Optional, Callable, Iterable, Iterator, TypeVar
 
+from archive import ArchiveWriter
+from diary_store import SqliteDiaryStore, format_diary_text
+from image_store import ImageStore
+from metrics import RunMetrics
+from recovery_image_ext import _sniff_image_ext, _looks_like_text
 
-LOGIN_URL = "https://nideriji.cn/api/login/"
-SYNC_URL = "https://nideriji.cn/api/v2/sync/"
-IMAGE_HOST = "https://f.nideriji.cn"
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+# 可用环境变量指向别的服务（例如 bench/mock_server.py 起的本地替身），只在导入时读取
+API_HOST = os.getenv("NIDERIJI_API_HOST", "https://nideriji.cn").rstrip("/")
+LOGIN_URL = f"{API_HOST}/api/login/"
+SYNC_URL = f"{API_HOST}/api/v2/sync/"
+IMAGE_HOST = os.getenv("NIDERIJI_IMAGE_HOST", "https://f.nideriji.cn").rstrip("/")
+
+SYNC_TS_KEYS = ("user_config_ts", "diaries_ts", "readmark_ts", "images_ts")
 
 UA = (
     "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
@@ -17,63 +45,768 @@ UA = (
 )
 
 
+class _TokenBucket:
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.last = time.monotonic()
+
+    def reserve(self, n: float) -> float:
+        """预留 n 个令牌（允许透支），返回需要等待的秒数。"""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        self.tokens -= n
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+
+class RateLimiter:
+    """
+    全局令牌桶限速器（线程安全），多个下载线程共享同一个实例：
+    - rate_rps：每秒请求数上限（None/0 表示不限）
+    - rate_bps：每秒字节数上限（None/0 表示不限）
+    - burst_*：桶容量，默认等于 1 秒的额度
+    """
+
+    def __init__(
+        self,
+        rate_rps: Optional[float] = None,
+        rate_bps: Optional[float] = None,
+        burst_requests: Optional[float] = None,
+        burst_bytes: Optional[float] = None,
+    ) -> None:
+        self._lock = threading.Lock()
+        self._req: Optional[_TokenBucket] = None
+        self._bytes: Optional[_TokenBucket] = None
+        if rate_rps:
+            self._req = _TokenBucket(rate_rps, burst_requests or max(1.0, rate_rps))
+        if rate_bps:
+            self._bytes = _TokenBucket(rate_bps, burst_bytes or rate_bps)
+
+    def _wait(self, bucket: Optional[_TokenBucket], n: float) -> float:
+        if bucket is None or n <= 0:
+            return 0.0
+        with self._lock:
+            delay = bucket.reserve(n)
+        if delay > 0:
+            time.sleep(delay)
+            return delay
+        return 0.0
+
+    def acquire_request(self) -> float:
+        """发起一次请求前调用，返回为此等待的秒数。"""
+        return self._wait(self._req, 1)
+
+    def consume_bytes(self, n: int) -> float:
+        """每收到 n 字节后调用，返回为此等待的秒数。"""
+        return self._wait(self._bytes, n)
+
+
+class IncompleteDownloadError(RuntimeError):
+    """响应体比 Content-Length 短（连接中途断开等），可重试续传。"""
+
+
+class RetryPolicy:
+    """
+    重试策略：指数退避 + full jitter，遵守 Retry-After。
+    - 可重试：超时、连接错误、读到一半断开、retry_statuses 中的 HTTP 状态
+    - max_attempts 为总尝试次数（含第一次）
+    """
+
+    def __init__(
+        self,
+        max_attempts: int = 5,
+        base_delay_s: float = 0.5,
+        max_delay_s: float = 30.0,
+        retry_statuses: Tuple[int, ...] = (408, 429, 500, 502, 503, 504),
+    ) -> None:
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay_s = base_delay_s
+        self.max_delay_s = max_delay_s
+        self.retry_statuses = retry_statuses
+
+    def is_retryable(self, e: BaseException) -> bool:
+        if isinstance(e, (requests.Timeout, requests.ConnectionError, IncompleteDownloadError)):
+            return True
+        if isinstance(e, requests.exceptions.ChunkedEncodingError):
+            return True
+        return _http_status(e) in self.retry_statuses
+
+    def delay(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        """attempt 从 0 开始计。"""
+        backoff = random.uniform(0, min(self.max_delay_s, self.base_delay_s * (2 ** attempt)))
+        if retry_after is not None:
+            return max(backoff, min(retry_after, self.max_delay_s * 4))
+        return backoff
+
+
+def _retry_after_s(e: BaseException) -> Optional[float]:
+    resp = getattr(e, "response", None)
+    value = resp.headers.get("Retry-After") if resp is not None else None
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class AIMDController:
+    """
+    AIMD（加性增、乘性减）并发控制器，限制同时在途的请求数（线程安全）：
+    - 每次成功：limit += increase / limit（约每轮满窗口 +increase）
+    - 延迟超过 latency_target_s：不再增加；超过两倍视同拥塞
+    - 429 / 5xx / 超时等拥塞信号：limit *= decrease，cooldown_s 内只减一次
+    线程池可以开到 max_limit，实际在途数由 limit 决定。
+    """
+
+    def __init__(
+        self,
+        initial: float = 4,
+        min_limit: float = 1,
+        max_limit: float = 32,
+        increase: float = 1.0,
+        decrease: float = 0.5,
+        latency_target_s: Optional[float] = None,
+        cooldown_s: float = 1.0,
+    ) -> None:
+        self._cond = threading.Condition()
+        self.min_limit = max(1.0, float(min_limit))
+        self.max_limit = max(self.min_limit, float(max_limit))
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_target_s = latency_target_s
+        self.cooldown_s = cooldown_s
+        self._limit = min(max(float(initial), self.min_limit), self.max_limit)
+        self._inflight = 0
+        self._last_decrease = 0.0
+
+    @property
+    def limit(self) -> int:
+        with self._cond:
+            return int(self._limit)
+
+    def acquire(self) -> None:
+        with self._cond:
+            while self._inflight >= int(self._limit):
+                self._cond.wait()
+            self._inflight += 1
+
+    def release(self) -> None:
+        with self._cond:
+            self._inflight -= 1
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self) -> Iterator[None]:
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def on_success(self, latency_s: float) -> None:
+        target = self.latency_target_s
+        if target is not None and latency_s > 2 * target:
+            self.on_congestion()
+            return
+        if target is not None and latency_s > target:
+            return
+        with self._cond:
+            self._limit = min(self.max_limit, self._limit + self.increase / self._limit)
+            self._cond.notify_all()
+
+    def on_congestion(self) -> None:
+        with self._cond:
+            now = time.monotonic()
+            if now - self._last_decrease < self.cooldown_s:
+                return
+            self._last_decrease = now
+            self._limit = max(self.min_limit, self._limit * self.decrease)
+
+
+class FairShareScheduler:
+    """
+    多个账号共用的在途请求名额（线程安全），批量导出时所有账号的请求都先在这里排队：
+    - 全体账号同时在途的请求数不超过 max_inflight
+    - 名额紧张时按账号轮转（round-robin）发放：每轮每个有人排队的账号拿一个，
+      账号内部先来先得；大账号开再多线程也只能和小账号轮流，不会把小账号饿住
+    - 每个账号各自的 AIMD 并发控制照常生效（见 controller()）
+    """
+
+    def __init__(self, max_inflight: int) -> None:
+        self.max_inflight = max(1, int(max_inflight))
+        self._cond = threading.Condition()
+        self._inflight = 0
+        self._queues: Dict[str, deque] = {}
+        self._turns: deque = deque()
+        self.granted: Dict[str, int] = {}
+
+    def acquire(self, account: str) -> None:
+        ticket = [False]
+        with self._cond:
+            q = self._queues.setdefault(account, deque())
+            q.append(ticket)
+            if len(q) == 1:
+                self._turns.append(account)
+            self._dispatch()
+            try:
+                while not ticket[0]:
+                    self._cond.wait()
+            except BaseException:
+                # 等待被打断（KeyboardInterrupt 等）：撤回排队的票；名额已经发下来的还回去
+                if ticket[0]:
+                    self._inflight -= 1
+                    self.granted[account] -= 1
+                else:
+                    q.remove(ticket)
+                    if not q:
+                        self._turns.remove(account)
+                self._dispatch()
+                raise
+
+    def release(self) -> None:
+        with self._cond:
+            self._inflight -= 1
+            self._dispatch()
+
+    def _dispatch(self) -> None:
+        granted = False
+        while self._inflight < self.max_inflight and self._turns:
+            account = self._turns.popleft()
+            q = self._queues[account]
+            q.popleft()[0] = True
+            self._inflight += 1
+            self.granted[account] = self.granted.get(account, 0) + 1
+            granted = True
+            if q:
+                self._turns.append(account)
+        if granted:
+            self._cond.notify_all()
+
+    def controller(self, account: str, **kwargs: Any) -> "SharedAIMDController":
+        """给某个账号用的并发控制器：先过账号自己的 AIMD 上限，再排全局名额。"""
+        return SharedAIMDController(self, account, **kwargs)
+
+
+class SharedAIMDController(AIMDController):
+    """挂在 FairShareScheduler 上的 AIMDController：每个在途名额同时占用账号的和全局的。"""
+
+    def __init__(self, scheduler: FairShareScheduler, account: str, **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        self.scheduler = scheduler
+        self.account = account
+
+    def acquire(self) -> None:
+        super().acquire()
+        try:
+            self.scheduler.acquire(self.account)
+        except BaseException:
+            super().release()
+            raise
+
+    def release(self) -> None:
+        self.scheduler.release()
+        super().release()
+
+
+def _retry_reason(e: BaseException) -> str:
+    status = _http_status(e)
+    return f"http_{status}" if status is not None else type(e).__name__
+
+
+def _call_with_retry(
+    fn: Callable[[], R],
+    retry: Optional[RetryPolicy] = None,
+    controller: Optional[AIMDController] = None,
+    what: str = "request",
+    metrics: Optional[RunMetrics] = None,
+    phase: str = "",
+    rate_limiter: Optional[RateLimiter] = None,
+) -> R:
+    """
+    执行一次完整的请求操作 fn()（包括读取响应体），按 retry 重试；
+    controller 在每次尝试期间占用一个在途名额，并根据结果/延迟调整并发。
+    传入 rate_limiter 时每次尝试前先按请求数限速；等待发生在占用名额之前，
+    批量导出时限速中的账号不会占着全局名额让别的账号干等。
+    传入 metrics 时按 phase 记录重试次数（按原因）与退避时间。
+    """
+    attempt = 0
+    while True:
+        if rate_limiter is not None:
+            slept = rate_limiter.acquire_request()
+            if metrics is not None:
+                metrics.sleep(phase, "rate_limit", slept)
+        t0 = time.monotonic()
+        try:
+            if controller is not None:
+                with controller.slot():
+                    result = fn()
+            else:
+                result = fn()
+        except Exception as e:
+            congested = _is_overload_error(e) or _http_status(e) == 429
+            if controller is not None and congested:
+                controller.on_congestion()
+            attempt += 1
+            if retry is None or attempt >= retry.max_attempts or not retry.is_retryable(e):
+                raise
+            delay = retry.delay(attempt - 1, _retry_after_s(e))
+            if metrics is not None:
+                metrics.retry(phase, _retry_reason(e), delay)
+            print(f"[retry] {what} failed ({e}); attempt {attempt}/{retry.max_attempts - 1}, wait {delay:.1f}s")
+            time.sleep(delay)
+            continue
+
+        if controller is not None:
+            controller.on_success(time.monotonic() - t0)
+        return result
+
+
+def new_sync_state() -> Dict[str, Any]:
+    """
+    增量同步状态：
+    - *_ts：上次同步得到的服务端时间戳水位
+    - diaries / images：已知 ID -> ts（JSON 的 key 为字符串）
+    - retry_diaries：上次抓取失败的日记 ID；水位已经越过它们，sync 不会再返回，
+      下次同步时由 _apply_sync_to_state 并入变化列表
+    - non_image_tries：只下载到非图片（错误页等）的图片 ID -> 已重试的次数（见 missing_image_ids）
+    """
+    state: Dict[str, Any] = {k: 0 for k in SYNC_TS_KEYS}
+    state["diaries"] = {}
+    state["images"] = {}
+    state["retry_diaries"] = []
+    state["non_image_tries"] = {}
+    return state
+
+
+def load_sync_state(path: str) -> Dict[str, Any]:
+    state = new_sync_state()
+    if not os.path.exists(path):
+        return state
+    with open(path, "r", encoding="utf-8") as f:
+        state.update(json.load(f))
+    return state
+
+
+def save_sync_state(path: str, state: Dict[str, Any]) -> None:
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(state, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+def _as_ts(v: Any) -> int:
+    try:
+        return int(v)
+    except (TypeError, ValueError):
+        return 0
+
+
+def _section_ts(v: Any) -> int:
+    if isinstance(v, dict):
+        return _as_ts(v.get("ts"))
+    if isinstance(v, list):
+        return max((_as_ts(x.get("ts")) for x in v if isinstance(x, dict)), default=0)
+    return 0
+
+
+def _apply_sync_to_state(state: Dict[str, Any], sync_data: Dict[str, Any]) -> Tuple[List[int], List[int]]:
+    """
+    用 sync 响应更新 state（原地修改），返回新增或 ts 变化的 (diary_ids, image_ids)。
+    state["retry_diaries"] 里上次失败的日记并入返回的 diary_ids 后清空；这次再失败时由调用方重新记入。
+    """
+    changed: Dict[str, set] = {"diaries": set(), "images": set()}
+    for section, id_key, ts_key in (("diaries", "id", "diaries_ts"), ("images", "image_id", "images_ts")):
+        known: Dict[str, int] = state[section]
+        watermark = max(_as_ts(state.get(ts_key)), _as_ts(sync_data.get(ts_key)))
+        for item in sync_data.get(section) or []:
+            if id_key not in item:
+                continue
+            item_id = int(item[id_key])
+            ts = _as_ts(item.get("ts"))
+            if known.get(str(item_id)) != ts:
+                changed[section].add(item_id)
+                known[str(item_id)] = ts
+            watermark = max(watermark, ts)
+        state[ts_key] = watermark
+    changed["diaries"].update(int(did) for did in state.get("retry_diaries") or [])
+    state["retry_diaries"] = []
+
+    for ts_key, section in (("user_config_ts", "user_config"), ("readmark_ts", "readmark")):
+        state[ts_key] = max(
+            _as_ts(state.get(ts_key)),
+            _as_ts(sync_data.get(ts_key)),
+            _section_ts(sync_data.get(section)),
+        )
+
+    return sorted(changed["diaries"]), sorted(changed["images"])
+
+
+class _StreamingJsonObject:
+    """
+    增量解析一个顶层 JSON 对象，避免把整个响应体读进内存再 json.loads：
+    - 普通字段整体解码后产出 (key, value)
+    - stream_keys 中的数组字段逐个元素产出 (key, item)
+    """
+
+    _WS = " \t\r\n"
+    _NUMBER_CHARS = frozenset("0123456789+-.eE")
+
+    def __init__(self, chunks: Iterable[bytes]) -> None:
+        self._chunks = iter(chunks)
+        self._decoder = codecs.getincrementaldecoder("utf-8")()
+        self._json = json.JSONDecoder()
+        self._buf = ""
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self, min_chars: int = 1) -> bool:
+        """至少再读入 min_chars 个字符；已到末尾返回 False。"""
+        if self._eof:
+            return False
+        if self._pos > 65536:
+            self._buf = self._buf[self._pos:]
+            self._pos = 0
+        parts: List[str] = []
+        got = 0
+        for chunk in self._chunks:
+            text = self._decoder.decode(chunk)
+            parts.append(text)
+            got += len(text)
+            if got >= min_chars:
+                self._buf += "".join(parts)
+                return True
+        parts.append(self._decoder.decode(b"", final=True))
+        self._buf += "".join(parts)
+        self._eof = True
+        return got > 0
+
+    def _peek(self) -> str:
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos] in self._WS:
+                self._pos += 1
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill():
+                return ""
+
+    def _take(self, expected: str) -> str:
+        c = self._peek()
+        if c not in expected:
+            raise ValueError(f"Malformed JSON stream: expected {expected!r}, got {c!r} at {self._pos}")
+        self._pos += 1
+        return c
+
+    def _value(self) -> Any:
+        self._peek()
+        while True:
+            try:
+                obj, end = self._json.raw_decode(self._buf, self._pos)
+            except json.JSONDecodeError:
+                if not self._fill(4096):
+                    raise
+                continue
+            # 数字可能被截断在缓冲区末尾（"12|3"，或停在 "1.|5"、"1e|3" 上时只解出了 1），
+            # 后面直到缓冲区末尾都还是数字字符时多读一块再确认
+            if isinstance(obj, (int, float)) and not isinstance(obj, bool):
+                rest = end
+                while rest < len(self._buf) and self._buf[rest] in self._NUMBER_CHARS:
+                    rest += 1
+                if rest == len(self._buf) and self._fill():
+                    continue
+            self._pos = end
+            return obj
+
+    def items(self, stream_keys: Iterable[str] = ()) -> Iterator[Tuple[str, Any]]:
+        stream_keys = set(stream_keys)
+        self._take("{")
+        if self._peek() == "}":
+            self._pos += 1
+            return
+        while True:
+            key = self._value()
+            self._take(":")
+            if key in stream_keys and self._peek() == "[":
+                self._pos += 1
+                if self._peek() == "]":
+                    self._pos += 1
+                else:
+                    while True:
+                        yield key, self._value()
+                        if self._take(",]") == "]":
+                            break
+            else:
+                yield key, self._value()
+            if self._take(",}") == "}":
+                return
+
+
+DIARY_FIELDS = ("id", "createddate", "ts", "title", "content")
+
+
+def _is_complete_diary(d: Dict[str, Any]) -> bool:
+    """sync 返回的日记条目是否已带齐写 dairies.txt 所需的字段。"""
+    return all(k in d for k in DIARY_FIELDS[1:])
+
+
+@functools.lru_cache(maxsize=8)
+def _api_headers(token: str) -> Dict[str, str]:
+    """nideriji.cn / f.nideriji.cn 共用的鉴权请求头，按 token 缓存，调用方不要修改。"""
+    return {
+        "accept": "*/*",
+        "origin": "https://nideriji.cn",
+        "referer": "https://nideriji.cn/w/",
+        "user-agent": UA,
+        "auth": f"token {token}",
+    }
+
+
+def _request_headers(session: requests.Session, token: str) -> Optional[Dict[str, str]]:
+    """NiderijiSession 已把鉴权头放进 session.headers（重新登录后自动更新），无需每次再传。"""
+    if isinstance(session, NiderijiSession):
+        return None
+    return _api_headers(token)
+
+
+_ENDPOINTS = (
+    ("/api/login/", "login"),
+    ("/api/v2/sync/", "sync"),
+    ("/api/diary/all_by_ids/", "all_by_ids"),
+    ("/api/image/", "image"),
+)
+
+
+def _endpoint_name(url: str) -> str:
+    """指标里用的接口名（不含 ID，避免标签爆炸）。"""
+    path = urlsplit(url).path
+    for prefix, name in _ENDPOINTS:
+        if path.startswith(prefix):
+            return name
+    return "other"
+
+
+class NiderijiSession(requests.Session):
+    """
+    调优过的 HTTP 传输层：
+    - 为 nideriji.cn 与 f.nideriji.cn 各挂一个 HTTPAdapter，连接池大小按并发数设置（keep-alive 复用连接）
+    - 鉴权请求头只构建一次，放在 session.headers 里
+    - token 缓存到 token_cache_path，下次运行直接复用；收到 401 时自动重新登录并重发一次
+    - 传入 metrics 时记录每个请求的延迟（流式请求到收到响应头为止）、状态码与响应字节数（流式响应边读边计）
+    - 传入 adapter 时两个域名都用这个（多个账号共用的）连接池，pool_size 不再生效；close() 不会关闭它
+    """
+
+    def __init__(
+        self,
+        email: str,
+        password: str,
+        pool_size: int = 16,
+        token_cache_path: Optional[str] = None,
+        metrics: Optional[RunMetrics] = None,
+        adapter: Optional[HTTPAdapter] = None,
+    ) -> None:
+        super().__init__()
+        self.email = email
+        self.metrics = metrics
+        self._password = password
+        self.token_cache_path = token_cache_path
+        self.token: Optional[str] = None
+        self.userid: Optional[int] = None
+        self._login_lock = threading.Lock()
+        self._shared_adapter = adapter
+
+        for host in (API_HOST, IMAGE_HOST):
+            self.mount(host + "/", adapter or HTTPAdapter(pool_connections=1, pool_maxsize=max(1, pool_size)))
+
+        self.headers.update({
+            "accept": "*/*",
+            "accept-language": "zh-CN,zh;q=0.9,en;q=0.8",
+            "origin": "https://nideriji.cn",
+            "referer": "https://nideriji.cn/w/",
+            "user-agent": UA,
+        })
+
+    def close(self) -> None:
+        if self._shared_adapter is not None:
+            for prefix in [k for k, v in self.adapters.items() if v is self._shared_adapter]:
+                del self.adapters[prefix]
+        super().close()
+
+    def _set_token(self, token: str, userid: int) -> None:
+        self.token = token
+        self.userid = int(userid)
+        self.headers["auth"] = f"token {token}"
+
+    def _load_cached_token(self) -> bool:
+        if not self.token_cache_path or not os.path.exists(self.token_cache_path):
+            return False
+        try:
+            with open(self.token_cache_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if data.get("email") != self.email or not data.get("token") or not data.get("userid"):
+            return False
+        self._set_token(data["token"], data["userid"])
+        return True
+
+    def _save_cached_token(self) -> None:
+        if not self.token_cache_path:
+            return
+        tmp = self.token_cache_path + ".tmp"
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump({"email": self.email, "token": self.token, "userid": self.userid}, f)
+        os.replace(tmp, self.token_cache_path)
+
+    def login(self) -> None:
+        login_headers: Dict[str, Optional[str]] = {
+            "accept": "*/*",
+            "origin": "https://nideriji.cn",
+            "referer": "https://nideriji.cn/w/login",
+            "user-agent": UA,
+            "auth": None,
+        }
+        login_files = {"email": (None, self.email), "password": (None, self._password)}
+        r = self._send("POST", LOGIN_URL, headers=login_headers, files=login_files, timeout=30)
+        r.raise_for_status()
+        data = r.json()
+
+        token = data.get("token")
+        userid = data.get("userid") or (data.get("user_config") or {}).get("userid")
+        if not token or not userid:
+            raise RuntimeError(f"Login ok but missing token/userid: {data}")
+        self._set_token(token, int(userid))
+        self._save_cached_token()
+
+    def ensure_login(self) -> bool:
+        """优先用缓存的 token；返回是否真的发起了登录请求。"""
+        if self.token or self._load_cached_token():
+            return False
+        self.login()
+        return True
+
+    def relogin(self, stale_token: Optional[str]) -> None:
+        with self._login_lock:
+            # 并发请求同时遇到 401 时只登录一次
+            if self.token == stale_token:
+                print("[login] token rejected, logging in again")
+                self.login()
+
+    def _send(self, method, url, *args, **kwargs) -> requests.Response:
+        metrics = self.metrics
+        if metrics is None:
+            return super().request(method, url, *args, **kwargs)
+        endpoint = _endpoint_name(str(url))
+        t0 = time.perf_counter()
+        try:
+            r = super().request(method, url, *args, **kwargs)
+        except Exception:
+            metrics.request(endpoint, time.perf_counter() - t0, "error")
+            raise
+        stream = kwargs.get("stream", False)
+        metrics.request(endpoint, time.perf_counter() - t0, r.status_code, 0 if stream else len(r.content))
+        if stream:
+            raw_iter = r.iter_content
+
+            def iter_content(*a: Any, **kw: Any) -> Iterator[bytes]:
+                for chunk in raw_iter(*a, **kw):
+                    metrics.inc("http_response_bytes_total", len(chunk), endpoint=endpoint)
+                    yield chunk
+
+            r.iter_content = iter_content  # type: ignore[method-assign]
+        return r
+
+    def request(self, method, url, *args, **kwargs):  # type: ignore[override]
+        token_used = self.token
+        r = self._send(method, url, *args, **kwargs)
+        if r.status_code == 401 and self._password and not str(url).startswith(LOGIN_URL):
+            r.close()
+            self.relogin(token_used)
+            r = self._send(method, url, *args, **kwargs)
+        return r
+
+
 def login_and_sync_index(
     email: Optional[str] = None,
     password: Optional[str] = None,
     sleep_s: float = 0.0,
+    sync_state: Optional[Dict[str, Any]] = None,
+    diary_sink: Optional[Dict[int, Dict[str, Any]]] = None,
+    token_cache_path: Optional[str] = None,
+    pool_size: int = 16,
+    metrics: Optional[RunMetrics] = None,
+    adapter: Optional[HTTPAdapter] = None,
 ) -> Tuple[requests.Session, str, int, List[int], List[int]]:
     """
     返回 (session, token, userid, diary_ids_sorted, image_ids_sorted)
 
     - email/password 若不传则读环境变量 NIDERIJI_EMAIL / NIDERIJI_PASSWORD
+    - 传入 sync_state（见 load_sync_state）时按其中的 *_ts 水位增量同步，
+      只返回新增或 ts 变化的 ID，并原地更新 sync_state；
+      调用方应在导出成功后再 save_sync_state
+    - 传入 diary_sink（dict）时，sync 响应里已带齐 content/title/createddate/ts 的日记
+      （增量模式下仅限有变化的）按 id 存入其中，可交给 export_text_by_diary_ids(prefetched=...)
+      直接写出，省掉 all_by_ids 请求
+    - sync 响应流式解析，只保留 id/ts 索引和需要的正文
+    - 返回的 session 是 NiderijiSession：连接池大小为 pool_size，
+      token 缓存在 token_cache_path（传入时），失效后自动重新登录
+    - 传入 metrics（RunMetrics）时 session 的所有请求都会记入其中
+    - 传入 adapter 时 session 使用这个共享连接池（批量导出多个账号时）
     """
     email = (email or os.getenv("NIDERIJI_EMAIL", "")).strip()
     password = (password or os.getenv("NIDERIJI_PASSWORD", "")).strip()
     if not email or not password:
         raise RuntimeError("Missing email/password. Set env NIDERIJI_EMAIL & NIDERIJI_PASSWORD or pass params.")
 
-    s = requests.Session()
-    s.headers.update({"accept-language": "zh-CN,zh;q=0.9,en;q=0.8"})
-
-    # login
-    login_headers = {
-        "accept": "*/*",
-        "origin": "https://nideriji.cn",
-        "referer": "https://nideriji.cn/w/login",
-        "user-agent": UA,
-    }
-    login_files = {"email": (None, email), "password": (None, password)}
-    r = s.post(LOGIN_URL, headers=login_headers, files=login_files, timeout=30)
-    r.raise_for_status()
-    data = r.json()
+    s = NiderijiSession(
+        email, password, pool_size=pool_size, token_cache_path=token_cache_path, metrics=metrics, adapter=adapter,
+    )
 
-    token = data.get("token")
-    userid = data.get("userid") or (data.get("user_config") or {}).get("userid")
-    if not token or not userid:
+    # login（有缓存的 token 就不登录，token 失效时由 NiderijiSession 在 401 后自动重新登录）
+    try:
+        logged_in = s.ensure_login()
+    except Exception:
         s.close()
-        raise RuntimeError(f"Login ok but missing token/userid: {data}")
-    userid = int(userid)
+        raise
 
-    if sleep_s:
+    if logged_in and sleep_s:
         time.sleep(sleep_s)
+        if metrics is not None:
+            metrics.sleep("sync", "throttle", sleep_s)
 
     # sync
-    sync_headers = {
-        "accept": "*/*",
-        "origin": "https://nideriji.cn",
-        "referer": "https://nideriji.cn/w/",
-        "user-agent": UA,
-        "auth": f"token {token}",
-    }
-    sync_files = {
-        "user_config_ts": (None, "0"),
-        "diaries_ts": (None, "0"),
-        "readmark_ts": (None, "0"),
-        "images_ts": (None, "0"),
-    }
-    r = s.post(SYNC_URL, headers=sync_headers, files=sync_files, timeout=30)
-    r.raise_for_status()
-    sync_data = r.json()
+    sync_files = {k: (None, str(_as_ts((sync_state or {}).get(k)))) for k in SYNC_TS_KEYS}
+    known_diaries: Dict[str, int] = (sync_state or {}).get("diaries") or {}
+    sync_data: Dict[str, Any] = {"diaries": [], "images": []}
+    with s.post(SYNC_URL, files=sync_files, timeout=30, stream=True) as r:
+        r.raise_for_status()
+        for key, value in _StreamingJsonObject(r.iter_content(chunk_size=64 * 1024)).items(("diaries", "images")):
+            if key == "diaries":
+                if not isinstance(value, dict) or "id" not in value:
+                    continue
+                sync_data["diaries"].append({"id": value["id"], "ts": value.get("ts")})
+                if diary_sink is not None and _is_complete_diary(value):
+                    if sync_state is None or known_diaries.get(str(int(value["id"]))) != _as_ts(value.get("ts")):
+                        diary_sink[int(value["id"])] = {k: value.get(k) for k in DIARY_FIELDS}
+            elif key == "images":
+                if isinstance(value, dict) and "image_id" in value:
+                    sync_data["images"].append({"image_id": value["image_id"], "ts": value.get("ts")})
+            else:
+                sync_data[key] = value
+
+    token = s.token or ""
+    userid = int(s.userid or 0)
+
+    if sync_state is not None:
+        changed_diaries, changed_images = _apply_sync_to_state(sync_state, sync_data)
+        return s, token, userid, changed_diaries, changed_images
 
     diary_ids: List[int] = sorted({int(d["id"]) for d in (sync_data.get("diaries") or []) if "id" in d})
     image_ids: List[int] = sorted({int(img["image_id"]) for img in (sync_data.get("images") or []) if "image_id" in img})
@@ -82,16 +815,9 @@ def login_and_sync_index(
 
 
 def _all_by_ids(session: requests.Session, token: str, userid: int, diary_ids: List[int]) -> List[Dict[str, Any]]:
-    url = f"https://nideriji.cn/api/diary/all_by_ids/{userid}/"
-    headers = {
-        "accept": "*/*",
-        "origin": "https://nideriji.cn",
-        "referer": "https://nideriji.cn/w/",
-        "user-agent": UA,
-        "auth": f"token {token}",
-    }
+    url = f"{API_HOST}/api/diary/all_by_ids/{userid}/"
     files = [("diary_ids", (None, str(did))) for did in diary_ids]
-    r = session.post(url, headers=headers, files=files, timeout=60)
+    r = session.post(url, headers=_request_headers(session, token), files=files, timeout=60)
     r.raise_for_status()
     data = r.json()
     if isinstance(data, dict) and data.get("error") not in (0, None):
@@ -104,73 +830,703 @@ def _supports_multi_ids(session: requests.Session, token: str, userid: int, test
     return len(diaries) >= 2
 
 
-def _write_one_diary(f, d: Dict[str, Any]) -> None:
-    did = d.get("id")
-    createddate = d.get("createddate", "")
-    ts = d.get("ts", "")
-    title = (d.get("title") or "").strip()
-    content = d.get("content") or ""
+def _probe_multi_ids(
+    session: requests.Session,
+    token: str,
+    userid: int,
+    diary_ids: List[int],
+    attempts: int = 3,
+    breaker: Optional["CircuitBreaker"] = None,
+) -> bool:
+    """
+    探测 all_by_ids 是否支持多ID；请求出错（而不是只返回一条）时换一组 ID 再试，
+    避免一次偶发错误就让整个导出退化成逐条请求。
+    每次都是连接错误 / 5xx 时说明服务端整体不可用而不是不支持多ID：按支持处理
+    （失败计入 breaker，由它决定何时放弃），不退化成逐条请求。
+    """
+    systemic = False
+    for i in range(attempts):
+        probe = diary_ids[i * 3:i * 3 + 3]
+        if len(probe) < 2:
+            break
+        try:
+            ok = _supports_multi_ids(session, token, userid, probe)
+        except Exception as e:
+            if _is_auth_error(e):
+                raise
+            systemic = _is_systemic_error(e)
+            if systemic and breaker is not None:
+                breaker.on_failure(f"all_by_ids probe: {e}")
+            continue
+        if breaker is not None:
+            breaker.on_success()
+        return ok
+    return systemic
+
+
+def _http_status(e: BaseException) -> Optional[int]:
+    resp = getattr(e, "response", None)
+    return getattr(resp, "status_code", None)
+
+
+def _is_auth_error(e: BaseException) -> bool:
+    return _http_status(e) in (401, 403)
+
+
+def _is_systemic_error(e: BaseException) -> bool:
+    """连接错误、超时、5xx：服务端整体出问题时每个请求都会这样失败。"""
+    if isinstance(e, (requests.Timeout, requests.ConnectionError)):
+        return True
+    status = _http_status(e)
+    return status is not None and status >= 500
+
+
+def _is_bisectable_error(e: BaseException) -> bool:
+    """换成更小的批次可能会好的错误：413、5xx、超时、服务端返回的业务错误；连接不上则拆多小都没用。"""
+    if isinstance(e, requests.ConnectionError) and not isinstance(e, requests.Timeout):
+        return False
+    status = _http_status(e)
+    return status is None or status == 413 or status >= 500
+
+
+def _is_overload_error(e: BaseException) -> bool:
+    """超时、连接错误、413、5xx：说明批次太大或服务端吃不消。"""
+    if isinstance(e, (requests.Timeout, requests.ConnectionError)):
+        return True
+    status = _http_status(e)
+    return status is not None and (status == 413 or status >= 500)
+
+
+class AdaptiveBatchSizer:
+    """
+    根据观测到的延迟和响应大小调整 all_by_ids 的批大小（线程安全）：
+    - 成功且延迟低于 target_latency_s、响应小于 max_response_bytes：乘以 grow 放大
+    - 成功但超出任一阈值：按比例缩小
+    - 超时 / 413 / 5xx：减半
+    """
+
+    def __init__(
+        self,
+        initial: int = 50,
+        min_size: int = 1,
+        max_size: int = 500,
+        target_latency_s: float = 2.0,
+        max_response_bytes: int = 4 * 1024 * 1024,
+        grow: float = 1.25,
+    ) -> None:
+        self._lock = threading.Lock()
+        self.min_size = max(1, min_size)
+        self.max_size = max(self.min_size, max_size)
+        self.target_latency_s = target_latency_s
+        self.max_response_bytes = max_response_bytes
+        self.grow = grow
+        self._size = float(min(max(initial, self.min_size), self.max_size))
+
+    @property
+    def size(self) -> int:
+        with self._lock:
+            return int(self._size)
+
+    def _set(self, value: float) -> None:
+        self._size = min(max(value, float(self.min_size)), float(self.max_size))
+
+    def on_success(self, batch_len: int, latency_s: float, response_bytes: int) -> None:
+        with self._lock:
+            # 只用“满批”的观测来放大，尾部的小批次不代表服务端能力
+            if batch_len < int(self._size) // 2:
+                return
+            ratio = max(
+                latency_s / self.target_latency_s if self.target_latency_s > 0 else 0.0,
+                response_bytes / self.max_response_bytes if self.max_response_bytes > 0 else 0.0,
+            )
+            if ratio <= 1.0:
+                self._set(self._size * self.grow)
+            else:
+                self._set(batch_len / ratio)
+
+    def on_failure(self) -> None:
+        with self._lock:
+            self._set(self._size / 2)
+
 
-    f.write(f"=== DiaryID: {did} | Date: {createddate} | TS: {ts} ===\n")
-    if title:
-        f.write(f"Title: {title}\n")
-    f.write(content)
-    if not content.endswith("\n"):
-        f.write("\n")
-    f.write("\n")
+class CircuitBreaker:
+    """
+    连续失败计数（线程安全）：连接错误 / 超时 / 5xx 连续出现 threshold 次（中间没有任何成功），
+    说明服务端整体不可用而不是某一批有问题；此后 tripped 为 True，调用方不再发请求，
+    把剩下的条目直接记为失败，避免逐条重试把整个阶段拖成几十分钟。
+    """
+
+    def __init__(self, threshold: int = 5) -> None:
+        self._lock = threading.Lock()
+        self.threshold = max(1, threshold)
+        self._failures = 0
+        self.tripped = False
+
+    def on_success(self) -> None:
+        with self._lock:
+            if not self.tripped:
+                self._failures = 0
+
+    def on_failure(self, what: str = "") -> bool:
+        """记一次失败，返回是否已经熔断。"""
+        with self._lock:
+            if self.tripped:
+                return True
+            self._failures += 1
+            if self._failures >= self.threshold:
+                self.tripped = True
+                print(f"[export_text] {self._failures} failures in a row ({what}), server looks down; "
+                      f"skipping the remaining requests")
+            return self.tripped
+
+
+def _iter_adaptive_batches(diary_ids: List[int], sizer: AdaptiveBatchSizer) -> Iterator[List[int]]:
+    """惰性切批：每取一批时才读取当前批大小。"""
+    i = 0
+    while i < len(diary_ids):
+        n = sizer.size
+        yield diary_ids[i:i + n]
+        i += n
+
+
+def _all_by_ids_bisect(
+    session: requests.Session,
+    token: str,
+    userid: int,
+    diary_ids: List[int],
+    sizer: Optional[AdaptiveBatchSizer] = None,
+    retry: Optional[RetryPolicy] = None,
+    controller: Optional[AIMDController] = None,
+    rate_limiter: Optional[RateLimiter] = None,
+    metrics: Optional[RunMetrics] = None,
+    breaker: Optional[CircuitBreaker] = None,
+) -> Tuple[List[Dict[str, Any]], List[int]]:
+    """
+    请求一批日记（每次尝试先经过 rate_limiter，并按 retry 重试）；
+    重试用尽仍失败、且换小批次可能有用时（见 _is_bisectable_error）对半拆分递归，
+    否则整批放弃。放弃的连接错误 / 5xx 计入 breaker，熔断后不再发请求、整批记为失败。
+    返回 (diaries, failed_ids)。鉴权错误直接抛出。
+    """
+    if breaker is not None and breaker.tripped:
+        return [], list(diary_ids)
+    t0 = time.monotonic()
+    try:
+        diaries = _call_with_retry(
+            lambda: _all_by_ids(session, token, userid, diary_ids),
+            retry,
+            controller,
+            what=f"all_by_ids({len(diary_ids)})",
+            metrics=metrics,
+            phase="text",
+            rate_limiter=rate_limiter,
+        )
+    except Exception as e:
+        if _is_auth_error(e):
+            raise
+        if sizer is not None and _is_overload_error(e):
+            sizer.on_failure()
+        if len(diary_ids) == 1 or not _is_bisectable_error(e):
+            if breaker is not None and _is_systemic_error(e):
+                breaker.on_failure(str(e))
+            if len(diary_ids) == 1:
+                print(f"[export_text] give up DiaryID {diary_ids[0]}: {e}")
+            else:
+                print(f"[export_text] give up {len(diary_ids)} diaries ({diary_ids[0]}..{diary_ids[-1]}): {e}")
+            return [], list(diary_ids)
+        mid = len(diary_ids) // 2
+        left, left_failed = _all_by_ids_bisect(
+            session, token, userid, diary_ids[:mid], sizer, retry, controller, rate_limiter, metrics, breaker
+        )
+        right, right_failed = _all_by_ids_bisect(
+            session, token, userid, diary_ids[mid:], sizer, retry, controller, rate_limiter, metrics, breaker
+        )
+        return left + right, left_failed + right_failed
+
+    if breaker is not None:
+        breaker.on_success()
+    if sizer is not None:
+        nbytes = sum(len(d.get("content") or "") + len(d.get("title") or "") for d in diaries)
+        sizer.on_success(len(diary_ids), time.monotonic() - t0, nbytes)
+    return diaries, []
+
+
+DIARY_BLOCK_HEADER_RE = re.compile(r"^===\s*DiaryID:\s*(\d+)\s*\|")
+
+
+def _iter_diary_blocks(path: str) -> Iterator[Tuple[int, str]]:
+    """逐条产出已有 dairies.txt 中的 (DiaryID, 原始文本块)，不做解析。"""
+    did: Optional[int] = None
+    buf: List[str] = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            m = DIARY_BLOCK_HEADER_RE.match(line)
+            if m:
+                if did is not None:
+                    yield did, "".join(buf)
+                did = int(m.group(1))
+                buf = []
+            if did is not None:
+                buf.append(line)
+    if did is not None:
+        yield did, "".join(buf)
+
+
+def _iter_store_blocks(store: SqliteDiaryStore) -> Iterator[Tuple[int, str]]:
+    """按 DiaryID 升序产出库中每条日记的文本块，格式与 dairies.txt 相同。"""
+    for d in store.iter_diaries():
+        yield d["id"], format_diary_text(d)
+
+
+class _ExistingBlocks:
+    """
+    按 DiaryID 升序读取旧文件中的日记块，与新抓取的日记归并写出：
+    新抓取的同 ID 日记覆盖旧块，其余旧块原样保留；write_before 返回被覆盖的旧块，
+    新的抓取失败时由调用方写回旧块。
+    """
+
+    def __init__(self, path: Optional[str], blocks: Optional[Iterable[Tuple[int, str]]] = None) -> None:
+        self._it: Iterator[Tuple[int, str]] = iter(())
+        if blocks is not None:
+            self._it = iter(blocks)
+        elif path and os.path.exists(path):
+            self._it = _iter_diary_blocks(path)
+        self._head = next(self._it, None)
+
+    def write_before(self, write: Callable[[str], Any], did: int) -> Optional[str]:
+        while self._head is not None and self._head[0] < did:
+            write(self._head[1])
+            self._head = next(self._it, None)
+        if self._head is not None and self._head[0] == did:
+            old = self._head[1]
+            self._head = next(self._it, None)
+            return old
+        return None
+
+    def write_rest(self, write: Callable[[str], Any]) -> None:
+        while self._head is not None:
+            write(self._head[1])
+            self._head = next(self._it, None)
 
 
 def _chunked(lst: List[int], size: int) -> List[List[int]]:
     return [lst[i:i + size] for i in range(0, len(lst), size)]
 
 
+def _ordered_map(fn: Callable[[T], R], items: Iterable[T], workers: int, max_pending: int) -> Iterator[R]:
+    """
+    用线程池并发执行 fn(item)，但严格按 items 的原顺序产出结果。
+    - 在途 + 已完成未产出的任务总数不超过 max_pending（有界重排缓冲，内存不随总量增长）
+    - items 是惰性消费的：只有腾出位置时才取下一个
+    """
+    it = iter(items)
+    pending: deque = deque()
+    ex = ThreadPoolExecutor(max_workers=workers)
+    try:
+        for item in it:
+            pending.append(ex.submit(fn, item))
+            if len(pending) >= max_pending:
+                break
+        while pending:
+            res = pending.popleft().result()
+            for item in it:
+                pending.append(ex.submit(fn, item))
+                break
+            yield res
+    finally:
+        for fut in pending:
+            fut.cancel()
+        ex.shutdown(wait=True)
+
+
 def export_text_by_diary_ids(
     session: requests.Session,
     token: str,
     userid: int,
     diary_ids: List[int],
-    out_path: str = "dairies.txt",
+    out_path: Optional[str] = "dairies.txt",
     batch_size: int = 50,
     sleep_s: float = 0.15,
-) -> None:
+    workers: int = 1,
+    max_pending: Optional[int] = None,
+    rate_limiter: Optional[RateLimiter] = None,
+    merge_existing: bool = False,
+    prefetched: Optional[Dict[int, Dict[str, Any]]] = None,
+    batch_sizer: Optional[AdaptiveBatchSizer] = None,
+    retry: Optional[RetryPolicy] = None,
+    controller: Optional[AIMDController] = None,
+    on_block: Optional[Callable[[str], None]] = None,
+    store: Optional[SqliteDiaryStore] = None,
+    metrics: Optional[RunMetrics] = None,
+    archive: Optional[ArchiveWriter] = None,
+    abort_after: Optional[int] = 5,
+) -> List[int]:
     """
     抓取每个日记正文 content，写入 out_path（带日记ID+日期+TS）
     - 自动探测 all_by_ids 是否支持多ID
     - 不支持则逐条请求
+    - workers > 1 时并发发送批次（或单条请求），仍按 DiaryID 升序写出；
+      max_pending 为重排缓冲上限（默认 workers * 4）
+    - 传入 rate_limiter 时由令牌桶统一控速，不再逐次 sleep_s
+    - merge_existing=True 时只抓取 diary_ids（通常是增量同步得到的变化部分），
+      与 out_path 里已有的日记按 DiaryID 归并，同 ID 以新抓取的为准
+    - prefetched（见 login_and_sync_index 的 diary_sink）中已有完整内容的日记直接写出，
+      只对其余的发 all_by_ids 请求；写出后会从 prefetched 中移除
+    - 传入 batch_sizer 时按观测到的延迟/响应大小动态调整批大小（batch_size 被忽略）
+    - 传入 retry / controller 时每个请求按 RetryPolicy 退避重试，
+      并由 AIMDController 根据错误与延迟调节同时在途的请求数（上限仍是 workers）
+    - 重试用尽仍失败的批次对半拆分重试（只对 413 / 5xx 等换小批次可能有用的错误），
+      放弃的日记保留归并前的旧内容，没有旧内容时记为 (no data)
+    - 连续 abort_after 次连接错误 / 5xx 时认为服务端不可用，剩余日记不再请求、全部记为失败（None 表示不熔断）
+    - on_block 会按写出顺序收到每条日记的文本块（含归并保留的旧日记），可用于下游流水线
+    - 传入 store（SqliteDiaryStore）时每条日记同时按 ts UPSERT 进库；
+      out_path=None 时不写 dairies.txt（需要时可用 store.export_text 派生），
+      merge_existing 改为与库中已有日记归并（只影响 on_block 收到的内容）
+    - 传入 metrics 时记录限速/重试/固定间隔的等待时间与写出的 dairies.txt（阶段名 "text"）
+    - 传入 archive（ArchiveWriter）时 out_path 是归档内的成员名，边抓边写进归档；不与本地文件归并
+
+    返回最终仍抓取失败的 DiaryID 列表。
     """
+    if out_path is None and store is None:
+        raise ValueError("export_text_by_diary_ids needs out_path or store")
+
     diary_ids = sorted(diary_ids)
+    if out_path is None:
+        old_blocks: Optional[Iterable[Tuple[int, str]]] = _iter_store_blocks(store) if merge_existing else None
+    elif archive is not None:
+        old_blocks = None
+    else:
+        old_blocks = _iter_diary_blocks(out_path) if merge_existing and os.path.exists(out_path) else None
+    if old_blocks is not None and not diary_ids:
+        print("[export_text] no changed diaries, keep existing", out_path or store.path)
+        if on_block is not None:
+            for _, text in old_blocks:
+                on_block(text)
+        return []
     if not diary_ids:
-        with open(out_path, "w", encoding="utf-8") as f:
-            f.write("No diary_ids provided.\n")
-        return
+        if out_path and archive is not None:
+            archive.add_bytes(out_path, b"No diary_ids provided.\n")
+        elif out_path:
+            with open(out_path, "w", encoding="utf-8") as f:
+                f.write("No diary_ids provided.\n")
+        return []
 
-    probe = diary_ids[:3] if len(diary_ids) >= 3 else diary_ids
-    multi_ok = False
-    if len(probe) >= 2:
-        try:
-            multi_ok = _supports_multi_ids(session, token, userid, probe)
-        except Exception:
-            multi_ok = False
-
-    with open(out_path, "w", encoding="utf-8") as f:
-        if multi_ok:
-            for batch in _chunked(diary_ids, batch_size):
-                diaries = _all_by_ids(session, token, userid, batch)
-                diaries.sort(key=lambda x: int(x.get("id", 0)))
-                for d in diaries:
-                    _write_one_diary(f, d)
-                time.sleep(sleep_s)
+    prefetched = prefetched if prefetched is not None else {}
+    ready_ids = [did for did in diary_ids if did in prefetched]
+    fetch_ids = [did for did in diary_ids if did not in prefetched]
+    if ready_ids:
+        print(f"[export_text] {len(ready_ids)} diaries taken from sync payload, {len(fetch_ids)} to fetch")
+
+    breaker = CircuitBreaker(abort_after) if abort_after else None
+    multi_ok = _probe_multi_ids(session, token, userid, fetch_ids, breaker=breaker)
+
+    units: Iterable[List[int]]
+    if not multi_ok:
+        units = [[did] for did in fetch_ids]
+    elif batch_sizer is not None:
+        units = _iter_adaptive_batches(fetch_ids, batch_sizer)
+    else:
+        units = _chunked(fetch_ids, batch_size)
+
+    failed: List[int] = []
+
+    def fetch(batch: List[int]) -> Tuple[List[int], List[Dict[str, Any]], List[int]]:
+        diaries, batch_failed = _all_by_ids_bisect(
+            session, token, userid, batch, batch_sizer, retry, controller, rate_limiter, metrics, breaker
+        )
+        if rate_limiter is None and not (breaker is not None and breaker.tripped):
+            time.sleep(sleep_s)
+            if metrics is not None:
+                metrics.sleep("text", "throttle", sleep_s)
+        return batch, diaries, batch_failed
+
+    if workers <= 1:
+        results: Iterator[Tuple[List[int], List[Dict[str, Any]], List[int]]] = map(fetch, units)
+    else:
+        results = _ordered_map(fetch, units, workers, max_pending or workers * 4)
+
+    def fetched() -> Iterator[Tuple[int, Optional[Dict[str, Any]]]]:
+        done = 0
+        for idx, (batch, diaries, batch_failed) in enumerate(results, start=1):
+            failed.extend(batch_failed)
+            if multi_ok:
+                rows: List[Tuple[int, Optional[Dict[str, Any]]]] = [(int(d.get("id", 0)), d) for d in diaries]
+                rows.extend((did, None) for did in batch_failed)
+                rows.sort(key=lambda x: x[0])
+                yield from rows
+            elif diaries:
+                yield int(diaries[0].get("id", batch[0])), diaries[0]
+            else:
+                yield batch[0], None
+
+            done += len(batch)
+            if idx % 20 == 0 or done == len(fetch_ids):
+                print(f"[export_text] fetched {done}/{len(fetch_ids)}")
+
+    def ready() -> Iterator[Tuple[int, Optional[Dict[str, Any]]]]:
+        for did in ready_ids:
+            yield did, prefetched.pop(did)
+
+    existing = _ExistingBlocks(None, old_blocks)
+    tmp_path = out_path + ".tmp" if out_path and archive is None else None
+    f: Optional[IO[str]] = None
+    if out_path and archive is not None:
+        f = archive.open(out_path)
+    elif tmp_path:
+        f = open(tmp_path, "w", encoding="utf-8")
+
+    def emit(text: str) -> None:
+        if f is not None:
+            f.write(text)
+        if on_block is not None:
+            on_block(text)
+
+    try:
+        for did, d in heapq.merge(fetched(), ready(), key=lambda x: x[0]):
+            old = existing.write_before(emit, did)
+            if d is None:
+                # 抓取失败：保留上次写出的内容（库里的行也不动），没有旧内容时才记为 (no data)
+                emit(old if old is not None else f"=== DiaryID: {did} | (no data) ===\n\n")
+            else:
+                if store is not None:
+                    store.upsert_diary(d)
+                emit(format_diary_text(d))
+        existing.write_rest(emit)
+    finally:
+        if f is not None:
+            f.close()
+        if store is not None:
+            store.commit()
+    if out_path and tmp_path:
+        os.replace(tmp_path, out_path)
+        if metrics is not None:
+            metrics.file_written("text", os.path.getsize(out_path))
+    elif out_path and archive is not None and metrics is not None:
+        metrics.file_written("text", archive.members[out_path])
+
+    if failed:
+        print(f"[export_text] {len(failed)} diaries failed: {failed[:20]}{' ...' if len(failed) > 20 else ''}")
+    return failed
+
+
+def _image_ext_from_headers(r: requests.Response) -> str:
+    ctype = (r.headers.get("Content-Type") or "").lower()
+    if "jpeg" in ctype or "jpg" in ctype:
+        return ".jpg"
+    if "png" in ctype:
+        return ".png"
+    if "webp" in ctype:
+        return ".webp"
+    if "gif" in ctype:
+        return ".gif"
+
+    cd = r.headers.get("Content-Disposition") or ""
+    m = re.search(r'filename="([^"]+)"', cd)
+    if m:
+        _, ext = os.path.splitext(m.group(1))
+        if ext:
+            return ext
+    return ".bin"
+
+
+PART_SUFFIX = ".part"
+SNIFF_BYTES = 64
+IMAGE_NAME_RE = re.compile(r"^image_(\d+)\.[A-Za-z0-9]+$")
+
+
+def _existing_image_ids(out_dir: str, store: Optional[ImageStore] = None) -> set:
+    """
+    out_dir 中已完整下载的图片 ID（含仓库 manifest 中对象还在的）。
+    .part 为未完成的临时文件，空文件视为损坏，都不算。
+    """
+    done = store.present_ids() if store is not None else set()
+    if not os.path.isdir(out_dir):
+        return done
+    for entry in os.scandir(out_dir):
+        if entry.name.endswith(PART_SUFFIX):
+            continue
+        m = IMAGE_NAME_RE.match(entry.name)
+        if m and entry.is_file() and entry.stat().st_size > 0:
+            done.add(int(m.group(1)))
+    return done
+
+
+def missing_image_ids(
+    image_ids: Iterable[int],
+    out_dir: str,
+    store_dir: Optional[str] = None,
+    non_image_subdir: str = "_non_image",
+    non_image_tries: Optional[Dict[str, int]] = None,
+    max_non_image_tries: int = 3,
+) -> List[int]:
+    """
+    image_ids 中本地已经没有可用文件的 ID（被删掉、只剩空文件或 .part 的），需要重新下载。
+    增量同步只返回服务端有变化的图片，本地丢失的要靠这里补回来；
+    只下载到非图片（out_dir/non_image_subdir，多半是 5xx / CDN 的错误页）的也算缺失。
+    non_image_tries（{id: 次数}，由调用方保存在 sync_state 里）记录这些 ID 重试过几次：
+    每返回一次加 1，到 max_non_image_tries 次后认为它确实不是图片、不再重试；
+    已经有真正图片的 ID 从中移除。
+    """
+    wanted = set(image_ids)
+    store = ImageStore(store_dir, out_dir) if store_dir else None
+    present = _existing_image_ids(out_dir, store)
+    non_images = (_existing_image_ids(os.path.join(out_dir, non_image_subdir)) & wanted) - present
+    if non_image_tries is not None:
+        for key in [k for k in non_image_tries if int(k) not in non_images]:
+            del non_image_tries[key]
+        for image_id in non_images:
+            tries = non_image_tries.get(str(image_id), 0)
+            if tries >= max_non_image_tries:
+                present.add(image_id)
+            else:
+                non_image_tries[str(image_id)] = tries + 1
+    return sorted(wanted - present)
+
+
+def _download_one_image(
+    session: requests.Session,
+    headers: Optional[Dict[str, str]],
+    userid: int,
+    image_id: int,
+    out_dir: str,
+    rate_limiter: Optional[RateLimiter] = None,
+    sniff: bool = True,
+    non_image_subdir: str = "_non_image",
+    store: Optional[ImageStore] = None,
+    metrics: Optional[RunMetrics] = None,
+    archive: Optional[ArchiveWriter] = None,
+    parts: Optional[Dict[int, io.BytesIO]] = None,
+) -> str:
+    """
+    先写入 image_{id}.part，完整后原子重命名为最终文件名。
+    - .part 已有内容时用 Range 续传；服务端不支持（返回 200）则从头写
+    - 下载不完整时抛异常并保留 .part，下次运行接着续传
+    - sniff=True 时用文件头 magic number 决定扩展名（边下边识别，不再需要事后恢复）；
+      识别不出且像错误页/未知类型的，直接放进 out_dir/non_image_subdir
+    - 传入 store 时边下载边算 sha256，图片收进内容寻址仓库（相同内容只存一份），
+      out_dir 里只留硬链接或 manifest 记录
+    - 传入 archive 时 .part 换成 parts 里的内存缓冲（同样可以续传），完成后作为
+      <out_dir>/image_<id>.<ext> 写进归档，返回成员名；不使用 store
+    - rate_limiter 在这里只按字节限速；第一次请求的请求数限速由调用方（_call_with_retry）
+      在占用在途名额之前完成，这里只为续传失败后的重新请求再取一次
+    """
+    def again() -> str:
+        if rate_limiter is not None:
+            slept = rate_limiter.acquire_request()
+            if metrics is not None:
+                metrics.sleep("images", "rate_limit", slept)
+        return _download_one_image(
+            session, headers, userid, image_id, out_dir,
+            rate_limiter=rate_limiter, sniff=sniff, non_image_subdir=non_image_subdir, store=store, metrics=metrics,
+            archive=archive, parts=parts,
+        )
+
+    def discard_part() -> None:
+        if buf is not None:
+            buf.seek(0)
+            buf.truncate()
         else:
-            for idx, did in enumerate(diary_ids, start=1):
-                diaries = _all_by_ids(session, token, userid, [did])
-                if diaries:
-                    _write_one_diary(f, diaries[0])
-                else:
-                    f.write(f"=== DiaryID: {did} | (no data) ===\n\n")
+            os.remove(part_path)
+
+    url = f"{IMAGE_HOST}/api/image/{userid}/{image_id}/"
+    part_path = os.path.join(out_dir, f"image_{image_id}{PART_SUFFIX}")
+    buf: Optional[io.BytesIO] = None
+    if archive is not None:
+        store = None
+        buf = (parts if parts is not None else {}).setdefault(image_id, io.BytesIO())
+        offset = buf.seek(0, io.SEEK_END)
+    else:
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+
+    req_headers = headers
+    if offset:
+        req_headers = dict(headers or {}, range=f"bytes={offset}-")
+
+    with session.get(url, headers=req_headers, stream=True, timeout=60) as r:
+        if r.status_code in (401, 403):
+            raise RuntimeError(f"Unauthorized for image_id={image_id}, status={r.status_code}")
+
+        if r.status_code == 416 and offset:
+            # .part 与服务端文件对不上，丢弃后整张重下
+            discard_part()
+            return again()
+
+        r.raise_for_status()
+
+        resumed = False
+        if offset and r.status_code == 206:
+            m = re.match(r"^bytes\s+(\d+)-\d+/(\d+|\*)", r.headers.get("Content-Range") or "")
+            resumed = (
+                m is not None
+                and int(m.group(1)) == offset
+                and (m.group(2) == "*" or offset < int(m.group(2)))
+            )
+            if not resumed:
+                discard_part()
+                return again()
+
+        head = b""
+        hasher = hashlib.sha256() if store is not None else None
+        if resumed and buf is not None:
+            head = buf.getvalue()[:SNIFF_BYTES]
+        elif resumed:
+            with open(part_path, "rb") as pf:
+                head = pf.read(SNIFF_BYTES)
+                if hasher is not None:
+                    hasher.update(head)
+                    for block in iter(lambda: pf.read(1024 * 1024), b""):
+                        hasher.update(block)
+
+        expected = r.headers.get("Content-Length")
+        written = 0
+        if buf is not None:
+            if not resumed:
+                discard_part()
+            buf.seek(0, io.SEEK_END)
+        with (nullcontext(buf) if buf is not None else open(part_path, "ab" if resumed else "wb")) as f:
+            for chunk in r.iter_content(chunk_size=1024 * 128):
+                if chunk:
+                    if len(head) < SNIFF_BYTES:
+                        head += chunk[:SNIFF_BYTES - len(head)]
+                    f.write(chunk)
+                    written += len(chunk)
+                    if hasher is not None:
+                        hasher.update(chunk)
+                    if rate_limiter is not None:
+                        slept = rate_limiter.consume_bytes(len(chunk))
+                        if metrics is not None:
+                            metrics.sleep("images", "rate_limit", slept)
+
+        if expected is not None and expected.isdigit() and written != int(expected):
+            raise IncompleteDownloadError(
+                f"Incomplete image_id={image_id}: got {written} of {expected} bytes, kept "
+                f"{'the partial body' if buf is not None else part_path} for resume"
+            )
+
+        ext = _image_ext_from_headers(r)
+
+    final_dir = out_dir
+    if sniff:
+        sniffed = _sniff_image_ext(head)
+        if sniffed is not None and not _looks_like_text(head):
+            ext = sniffed
+        elif ext == ".bin" or _looks_like_text(head):
+            final_dir = os.path.join(out_dir, non_image_subdir)
+            if buf is None:
+                os.makedirs(final_dir, exist_ok=True)
+
+    if buf is not None:
+        name = f"{final_dir}/image_{image_id}{ext}".replace(os.sep, "/")
+        archive.add_bytes(name, buf.getvalue())
+        if parts is not None:
+            parts.pop(image_id, None)
+        return name
 
-                if idx % 20 == 0:
-                    print(f"[export_text] fetched {idx}/{len(diary_ids)}")
-                time.sleep(sleep_s)
+    if store is not None and hasher is not None and final_dir == out_dir:
+        return store.add(image_id, part_path, hasher.hexdigest(), ext)
+
+    out_path = os.path.join(final_dir, f"image_{image_id}{ext}")
+    os.replace(part_path, out_path)
+    return out_path
 
 
 def export_images_by_image_ids(
@@ -180,61 +1536,110 @@ def export_images_by_image_ids(
     image_ids: List[int],
     out_dir: str = "images",
     sleep_s: float = 0.1,
+    workers: int = 1,
+    rate_limiter: Optional[RateLimiter] = None,
+    skip_existing: bool = True,
+    sniff: bool = True,
+    retry: Optional[RetryPolicy] = None,
+    controller: Optional[AIMDController] = None,
+    on_done: Optional[Callable[[int, str], None]] = None,
+    store_dir: Optional[str] = None,
+    metrics: Optional[RunMetrics] = None,
+    archive: Optional[ArchiveWriter] = None,
+    on_skip: Optional[Callable[[List[int]], None]] = None,
 ) -> None:
     """
     下载图片：
       https://f.nideriji.cn/api/image/{userid}/{image_id}/
+
+    - workers > 1 时用线程池并发下载
+    - 传入 rate_limiter 时由令牌桶统一控速，不再逐张 sleep_s
+    - skip_existing=True 时跳过 out_dir 里已完整下载的图片；中断留下的 .part 会续传
+    - sniff=True 时边下载边识别真实格式，直接以正确扩展名写入 out_dir，
+      非图片（错误页等）放到 out_dir/_non_image（下次运行会重试，见 missing_image_ids）
+    - 传入 retry 时对超时、断流、429/5xx 退避重试（断流会从 .part 续传）；
+      传入 controller 时由 AIMD 控制同时下载的张数（上限仍是 workers）
+    - on_done(image_id, path) 在每张图片落盘后调用（可能来自工作线程）；
+      on_skip(image_ids) 在开始下载前收到因已存在而跳过的 ID（不会再有 on_done）
+    - 传入 store_dir 时使用内容寻址仓库（见 image_store.ImageStore），相同内容的图片只存一份
+    - 传入 metrics 时记录等待时间、重试与落盘的图片/非图片文件（阶段名 "images"）
+    - 传入 archive（ArchiveWriter）时图片在内存里下载完直接写进归档，out_dir 是归档内的目录，
+      本地不落任何文件；此时 skip_existing / store_dir 不生效
     """
     image_ids = sorted(set(image_ids))
     if not image_ids:
         print("[export_images] No image_ids provided.")
         return
 
-    os.makedirs(out_dir, exist_ok=True)
+    store: Optional[ImageStore] = None
+    parts: Dict[int, io.BytesIO] = {}
+    if archive is None:
+        os.makedirs(out_dir, exist_ok=True)
+        store = ImageStore(store_dir, out_dir) if store_dir else None
 
-    headers = {
-        "accept": "*/*",
-        "origin": "https://nideriji.cn",
-        "referer": "https://nideriji.cn/w/",
-        "user-agent": UA,
-        "auth": f"token {token}",
-    }
+    if skip_existing and archive is None:
+        done = _existing_image_ids(out_dir, store)
+        skipped = [i for i in image_ids if i in done]
+        image_ids = [i for i in image_ids if i not in done]
+        if skipped:
+            print(f"[export_images] skip {len(skipped)} already downloaded")
+            if on_skip is not None:
+                on_skip(skipped)
+        if not image_ids:
+            return
 
-    for idx, image_id in enumerate(image_ids, start=1):
-        url = f"{IMAGE_HOST}/api/image/{userid}/{image_id}/"
-        r = session.get(url, headers=headers, stream=True, timeout=60)
+    headers = _request_headers(session, token)
 
-        if r.status_code in (401, 403):
-            raise RuntimeError(f"Unauthorized for image_id={image_id}, status={r.status_code}")
+    total = len(image_ids)
 
-        r.raise_for_status()
+    def download(image_id: int) -> str:
+        path = _call_with_retry(
+            lambda: _download_one_image(
+                session, headers, userid, image_id, out_dir, rate_limiter, sniff, store=store, metrics=metrics,
+                archive=archive, parts=parts,
+            ),
+            retry,
+            controller,
+            what=f"image_id={image_id}",
+            metrics=metrics,
+            phase="images",
+            rate_limiter=rate_limiter,
+        )
+        if metrics is not None:
+            kind = "non_image" if os.path.basename(os.path.dirname(path)) == "_non_image" else "image"
+            metrics.file_written(kind, archive.members[path] if archive is not None else os.path.getsize(path))
+        if on_done is not None:
+            on_done(image_id, path)
+        return path
 
-        ctype = (r.headers.get("Content-Type") or "").lower()
-        if "jpeg" in ctype or "jpg" in ctype:
-            ext = ".jpg"
-        elif "png" in ctype:
-            ext = ".png"
-        elif "webp" in ctype:
-            ext = ".webp"
-        elif "gif" in ctype:
-            ext = ".gif"
-        else:
-            cd = r.headers.get("Content-Disposition") or ""
-            m = re.search(r'filename="([^"]+)"', cd)
-            if m:
-                _, ext = os.path.splitext(m.group(1))
-                if not ext:
-                    ext = ".bin"
-            else:
-                ext = ".bin"
+    try:
+        if workers <= 1:
+            for idx, image_id in enumerate(image_ids, start=1):
+                download(image_id)
 
-        out_path = os.path.join(out_dir, f"image_{image_id}{ext}")
-        with open(out_path, "wb") as f:
-            for chunk in r.iter_content(chunk_size=1024 * 128):
-                if chunk:
-                    f.write(chunk)
+                if idx % 20 == 0 or idx == total:
+                    print(f"[export_images] downloaded {idx}/{total}")
 
-        if idx % 20 == 0 or idx == len(image_ids):
-            print(f"[export_images] downloaded {idx}/{len(image_ids)}")
+                if rate_limiter is None:
+                    time.sleep(sleep_s)
+                    if metrics is not None:
+                        metrics.sleep("images", "throttle", sleep_s)
+            return
 
-        time.sleep(sleep_s)
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            futures = [
+                ex.submit(download, image_id)
+                for image_id in image_ids
+            ]
+            try:
+                for idx, fut in enumerate(as_completed(futures), start=1):
+                    fut.result()
+                    if idx % 20 == 0 or idx == total:
+                        print(f"[export_images] downloaded {idx}/{total}")
+            except BaseException:
+                for fut in futures:
+                    fut.cancel()
+                raise
+    finally:
+        if store is not None:
+            store.save()
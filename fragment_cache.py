@@ -0,0 +1,106 @@
+# fragment_cache.py
+import sqlite3
+from typing import Any, Iterable, List, Optional, Tuple
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS fragments (
+    id   INTEGER PRIMARY KEY,
+    key  TEXT NOT NULL,
+    html TEXT NOT NULL,
+    run  INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS fragments_run ON fragments(run);
+"""
+
+# UPDATE ... RETURNING 需要 SQLite 3.35+；更老的版本退回 SELECT + 批量 UPDATE
+_HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+
+class FragmentCache:
+    """
+    渲染好的日记 <section> 片段缓存（SQLite），每个 DiaryID 一行：
+    - key 由调用方根据 id/ts/正文哈希/解析到的图片路径等算出，key 不同即视为过期并被覆盖
+    - 每次运行有一个递增的 run 编号，命中或写入的行都会标记为本次；
+      完整导出结束后 evict_stale() 删掉本次没用到的行（已删除的日记）
+    单线程使用；写入攒批提交。
+    """
+
+    def __init__(self, path: str, flush_every: int = 500) -> None:
+        self.path = path
+        self.flush_every = flush_every
+        self.hits = 0
+        self.misses = 0
+        self._conn = sqlite3.connect(path)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+        self.run = self._conn.execute("SELECT COALESCE(MAX(run), 0) + 1 FROM fragments").fetchone()[0]
+        self._touched: List[Tuple[int, int]] = []
+        self._pending = 0
+
+    def __enter__(self) -> "FragmentCache":
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.close()
+
+    def get(self, diary_id: int, key: str) -> Optional[str]:
+        if _HAS_RETURNING:
+            row = self._conn.execute(
+                "UPDATE fragments SET run = ? WHERE id = ? AND key = ? RETURNING html",
+                (self.run, diary_id, key),
+            ).fetchone()
+        else:
+            row = self._conn.execute(
+                "SELECT html FROM fragments WHERE id = ? AND key = ?", (diary_id, key)
+            ).fetchone()
+            if row is not None:
+                self._touched.append((self.run, diary_id))
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._pending += 1
+        if self._pending >= self.flush_every:
+            self.flush()
+        return row[0]
+
+    def contains(self, diary_id: int, keys: Iterable[str]) -> bool:
+        """是否已缓存 keys 中任意一个（只读，不计入命中统计）。"""
+        row = self._conn.execute("SELECT key FROM fragments WHERE id = ?", (diary_id,)).fetchone()
+        return row is not None and row[0] in keys
+
+    def put(self, diary_id: int, key: str, fragment: str) -> None:
+        self._conn.execute(
+            "INSERT OR REPLACE INTO fragments (id, key, html, run) VALUES (?, ?, ?, ?)",
+            (diary_id, key, fragment, self.run),
+        )
+        self._pending += 1
+        if self._pending >= self.flush_every:
+            self.flush()
+
+    def _flush_touched(self) -> None:
+        if self._touched:
+            self._conn.executemany("UPDATE fragments SET run = ? WHERE id = ?", self._touched)
+            self._touched = []
+
+    def flush(self) -> None:
+        self._flush_touched()
+        self._conn.commit()
+        self._pending = 0
+
+    def evict_stale(self) -> int:
+        """删除本次运行没有用到的片段，返回删除的行数。只应在完整导出成功后调用。"""
+        self._flush_touched()
+        n = self._conn.execute("DELETE FROM fragments WHERE run < ?", (self.run,)).rowcount
+        self._conn.commit()
+        return n
+
+    def clear(self) -> None:
+        self._conn.execute("DELETE FROM fragments")
+        self._conn.commit()
+
+    def close(self) -> None:
+        self.flush()
+        self._conn.close()
@@ -0,0 +1,140 @@
+# image_store.py
+import hashlib
+import json
+import os
+import re
+import threading
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+
+MANIFEST_NAME = "_manifest.json"
+IMAGE_NAME_RE = re.compile(r"^image_(\d+)(\.[A-Za-z0-9]+)$")
+
+
+def file_sha256(path: str, chunk_size: int = 1024 * 1024) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def load_manifest(images_dir: str) -> Dict[int, str]:
+    """读取 images_dir/_manifest.json：image_id -> 相对 images_dir 的对象路径。"""
+    path = os.path.join(images_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    return {int(k): v for k, v in data.items()}
+
+
+def resolve_manifest(images_dir: Path) -> Dict[int, Path]:
+    """manifest 中的条目解析为可直接引用的路径（相对 images_dir 的父目录，和 build_image_index 一致）。"""
+    return {img_id: images_dir / rel for img_id, rel in load_manifest(str(images_dir)).items()}
+
+
+class ImageStore:
+    """
+    内容寻址的图片仓库：对象按 sha256 存在 root/<前2位>/<sha256><ext>，相同内容只存一份。
+    - images_dir 里的 image_<id><ext> 是指向对象的硬链接；无法硬链接（跨设备等）时只记 manifest
+    - manifest（images_dir/_manifest.json）记录每个 image_id 对应的对象，供索引与 HTML 解析
+    - root 可以放在多个账号/多次备份共用的位置，线程安全
+    """
+
+    def __init__(self, root: str, images_dir: str, flush_every: int = 50) -> None:
+        self.root = root
+        self.images_dir = images_dir
+        self.flush_every = flush_every
+        self._lock = threading.Lock()
+        self._manifest = load_manifest(images_dir)
+        self._dirty = 0
+
+    def object_path(self, digest: str, ext: str) -> str:
+        return os.path.join(self.root, digest[:2], digest + ext.lower())
+
+    def known_ids(self) -> set:
+        with self._lock:
+            return set(self._manifest)
+
+    def present_ids(self) -> set:
+        """manifest 中对象文件还在的 image_id（仓库里的对象被删掉的不算）。"""
+        with self._lock:
+            items = list(self._manifest.items())
+        return {image_id for image_id, rel in items if os.path.isfile(os.path.join(self.images_dir, rel))}
+
+    def add(self, image_id: int, src_path: str, digest: str, ext: str) -> str:
+        """
+        把 src_path（下载完成的临时文件）收进仓库并为 image_id 建立引用；
+        已有相同内容时直接丢弃 src_path。返回 image_id 可用的文件路径。
+        """
+        obj = self.object_path(digest, ext)
+        os.makedirs(os.path.dirname(obj), exist_ok=True)
+        if os.path.exists(obj):
+            os.remove(src_path)
+        else:
+            os.replace(src_path, obj)
+
+        per_id = os.path.join(self.images_dir, f"image_{image_id}{ext}")
+        result = self._link(obj, per_id)
+
+        with self._lock:
+            self._manifest[image_id] = os.path.relpath(obj, self.images_dir).replace(os.sep, "/")
+            self._dirty += 1
+            if self._dirty >= self.flush_every:
+                self._save_locked()
+        return result
+
+    def _link(self, obj: str, per_id: str) -> str:
+        try:
+            if os.path.lexists(per_id):
+                if os.path.samefile(obj, per_id):
+                    return per_id
+                os.remove(per_id)
+            os.link(obj, per_id)
+            return per_id
+        except OSError:
+            return obj
+
+    def _save_locked(self) -> None:
+        os.makedirs(self.images_dir, exist_ok=True)
+        path = os.path.join(self.images_dir, MANIFEST_NAME)
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({str(k): v for k, v in sorted(self._manifest.items())}, f, ensure_ascii=False)
+        os.replace(tmp, path)
+        self._dirty = 0
+
+    def save(self) -> None:
+        with self._lock:
+            self._save_locked()
+
+
+def dedupe_images_dir(images_dir: str, store_root: Optional[str] = None) -> Tuple[int, int]:
+    """
+    把已有的 images_dir 改造成内容寻址布局：逐个 image_<id>.* 算哈希、收进仓库并换成硬链接。
+    已经链接到仓库的文件会跳过。返回 (处理的文件数, 省下的字节数)。
+    """
+    store = ImageStore(store_root or os.path.join(images_dir, "_store"), images_dir)
+    processed = 0
+    saved = 0
+    for entry in os.scandir(images_dir):
+        m = IMAGE_NAME_RE.match(entry.name)
+        if not m or not entry.is_file():
+            continue
+        if entry.stat().st_nlink > 1:
+            continue
+        digest = file_sha256(entry.path)
+        ext = m.group(2)
+        size = entry.stat().st_size
+        existed = os.path.exists(store.object_path(digest, ext))
+        store.add(int(m.group(1)), entry.path, digest, ext)
+        processed += 1
+        if existed:
+            saved += size
+    store.save()
+    return processed, saved
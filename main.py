@@ -1,12 +1,53 @@
 # main.py
 from __future__ import annotations
 
-from typing import Optional
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+import argparse
+import copy
+import hashlib
+import os
+import queue
 import sys
+import threading
+import time
 
-from fetch_data import login_and_sync_index, export_text_by_diary_ids, export_images_by_image_ids
+from requests.adapters import HTTPAdapter
+
+from fetch_data import (
+    AdaptiveBatchSizer,
+    AIMDController,
+    FairShareScheduler,
+    RateLimiter,
+    RetryPolicy,
+    load_sync_state,
+    new_sync_state,
+    save_sync_state,
+    login_and_sync_index,
+    export_text_by_diary_ids,
+    export_images_by_image_ids,
+    missing_image_ids,
+)
+from archive import ArchiveWriter, archive_format
+from diary_store import SqliteDiaryStore
+from fragment_cache import FragmentCache
+from image_store import IMAGE_NAME_RE
+from metrics import RunMetrics
+from phases import Phase, PhaseGraph
 from recovery_image_ext import recover_images_from_bin
-from export_as_html import export_as_html
+from export_as_html import (
+    IMG_REF_RE,
+    DiaryHtmlWriter,
+    ImageResolver,
+    ShardedHtmlWriter,
+    VirtualHtmlWriter,
+    build_image_index,
+    export_as_html,
+    merge_store_image_paths,
+    parse_diary_block,
+    shard_outputs,
+)
+import export_as_html as html_module
 
 
 # =========================
@@ -16,62 +57,748 @@ from export_as_html import export_as_html
 EMAIL: Optional[str] = None
 PASSWORD: Optional[str] = None
 
+# =========================
+# 图片下载并发与限速（对 f.nideriji.cn 保持克制）
+# 实际并发由 AIMD 控制器在 1..IMAGE_WORKERS 之间按错误与延迟自动调节
+# =========================
+IMAGE_WORKERS = 8
+IMAGE_RATE_RPS = 5.0
+IMAGE_RATE_BPS: Optional[float] = None
+# 下载到非图片（5xx / CDN 错误页等）的图片在之后几次运行中重新下载；超过次数就当作确实不是图片
+NON_IMAGE_RETRIES = 3
+
+# 内容寻址图片仓库（相同内容只存一份，images/ 里是硬链接）；None 表示不启用
+# 例如 "images/_store"，也可以指向多个账号/多次备份共用的目录（同一文件系统才能硬链接）
+IMAGE_STORE_DIR: Optional[str] = None
+
+# 登录 token 缓存（只存 token/userid，不存密码）；失效时会自动重新登录
+TOKEN_CACHE_PATH = ".nideriji_token.json"
+
+# SQLite 日记库（日记正文 + 图片路径，按 ts UPSERT）；None 表示只用 dairies.txt
+# 启用后 HTML 直接从库生成，dairies.txt 变成可选的派生输出（WRITE_DAIRIES_TXT）
+DIARY_DB_PATH: Optional[str] = None
+WRITE_DAIRIES_TXT = True
+
+# HTML 片段缓存：未变化的日记直接复用上次渲染结果；None 表示每次全部重新渲染
+HTML_CACHE_PATH: Optional[str] = ".dairies_html_cache.db"
+
+# HTML 分页："month" / "year" 时每月/每年一页，dairies.html 只是目录 + 日历；None 为单个大页面
+HTML_SHARD: Optional[str] = None
+
+# 单文件虚拟列表：日记以 JSON 分块内嵌，只把视口附近的放进 DOM（5 万篇以上也流畅）；HTML_SHARD 优先
+HTML_VIRTUAL = False
+
+# 按阶段执行（PIPELINE = False）时导出 HTML 的并行渲染进程数与每个任务的日记篇数；
+# 设为 os.cpu_count() 可用满多核。流水线模式边下边渲染，不使用进程池
+HTML_RENDER_WORKERS = 1
+HTML_RENDER_CHUNK = 200
+
+# 图片目录索引的旁路缓存（记录目录 mtime）；目录没变时导出 HTML 不再重新列目录。None 表示每次都扫描
+IMAGE_INDEX_CACHE: Optional[str] = "images.index.json"
+
+# 增量同步状态文件：记录上次的 *_ts 水位与已知 ID；删除它即可强制全量导出
+SYNC_STATE_PATH = "sync_state.json"
+
+# 日记正文抓取并发与限速；批大小从 TEXT_BATCH_SIZE 起按服务端表现自动调整
+TEXT_WORKERS = 8
+TEXT_RATE_RPS = 5.0
+TEXT_BATCH_SIZE = 50
+TEXT_BATCH_MAX = 500
+
+# 超时、断流、429/5xx 的重试次数（含第一次）
+MAX_ATTEMPTS = 5
+# 正文抓取连续这么多次连接错误 / 5xx 就认为服务端不可用，剩下的日记不再请求（留到下次运行）；None 表示不放弃
+TEXT_ABORT_AFTER: Optional[int] = 5
+
+# 运行报告：每次运行结束写出 JSON（各阶段耗时与等待时间、HTTP 延迟分布、重试、写出的文件、单篇渲染耗时）；
+# None 表示不写
+METRICS_JSON_PATH: Optional[str] = "run_report.json"
+# 同一份指标的 Prometheus textfile（给 node_exporter 的 textfile collector，文件名需以 .prom 结尾）；None 表示不写
+METRICS_PROM_PATH: Optional[str] = None
+
+# 阶段指纹：记录各阶段（text / images / recover / html）上次运行后的输入状态，
+# 输入和产物都没变的阶段直接跳过；None 表示每次全部执行
+PHASE_STATE_PATH: Optional[str] = ".nideriji_phases.json"
+
+# 归档输出：设为 "nideriji.tar.zst" / ".tar.gz" / ".tar" / ".zip" 时，正文、图片和 HTML 直接流式写进这一个文件，
+# 不在本地生成 dairies.txt / images/ / dairies.html；每次都是完整导出（不做增量、不跳过阶段）。
+# .tar.zst 需要 pip install zstandard。None 表示照常输出目录树
+ARCHIVE_PATH: Optional[str] = None
+
+# 流水线模式：正文抓取、图片下载、HTML 渲染同时进行，通过有界队列衔接；
+# 每篇日记在正文和它引用的图片都就绪后立即渲染。False 则按阶段依次执行
+PIPELINE = True
+PIPELINE_QUEUE_SIZE = 256
+
+
+class ExportJob:
+    """
+    一个账号的一次导出：输出位置、账号，以及（批量导出时）多个账号共享的资源。
+    - 这个账号的全部输出与状态文件（dairies.txt、images/、dairies.html、sync_state.json、token 缓存……）
+      都放在 root 下；root="." 就是单账号运行时的当前目录，文件位置与以前完全一致
+    - 上面配置里写成绝对路径的（例如多个账号共用的 IMAGE_STORE_DIR）不受 root 影响
+    - adapter / text_limiter / image_limiter / scheduler 由 batch_export.py 传入，单账号运行时都是 None
+    - archive_path（默认 ARCHIVE_PATH）非空时为归档模式：dairies_txt / images_dir / html 是归档内的成员名，
+      导出期间打开的 ArchiveWriter 放在 archive 上
+    - refetch=True（--force）时全量同步，正文和图片都重新下载，不跳过本地已有的
+    - text_failed：本次要抓取的日记一篇都没抓到时记下篇数，导出结束后以失败退出（见 _check_text_fetched）
+    """
+
+    def __init__(
+        self,
+        root: str = ".",
+        email: Optional[str] = None,
+        password: Optional[str] = None,
+        label: str = "",
+        metrics: Optional[RunMetrics] = None,
+        adapter: Optional[HTTPAdapter] = None,
+        text_limiter: Optional[RateLimiter] = None,
+        image_limiter: Optional[RateLimiter] = None,
+        scheduler: Optional[FairShareScheduler] = None,
+        archive_path: Optional[str] = None,
+    ) -> None:
+        self.root = root
+        self.email = email
+        self.password = password
+        self.label = label
+        self.metrics = metrics or RunMetrics(labels={"account": label} if label else None)
+        self.adapter = adapter
+        self.text_limiter = text_limiter
+        self.image_limiter = image_limiter
+        self.scheduler = scheduler
+        self.archive_path = self.path(archive_path or ARCHIVE_PATH)
+        self.archive: Optional[ArchiveWriter] = None
+        self.refetch = False
+        self.text_failed = 0
+
+        if self.archive_path:
+            self.dairies_txt, self.images_dir, self.html = "dairies.txt", "images", "dairies.html"
+        else:
+            self.dairies_txt = self.path("dairies.txt")
+            self.images_dir = self.path("images")
+            self.html = self.path("dairies.html")
+        self.sync_state_path = self.path(SYNC_STATE_PATH)
+        self.token_cache_path = self.path(TOKEN_CACHE_PATH)
+        self.diary_db_path = self.path(DIARY_DB_PATH)
+        self.html_cache_path = self.path(HTML_CACHE_PATH)
+        self.image_index_cache = self.path(IMAGE_INDEX_CACHE)
+        self.image_store_dir = self.path(IMAGE_STORE_DIR)
+        self.phase_state_path = self.path(PHASE_STATE_PATH)
+        self.metrics_json_path = self.path(METRICS_JSON_PATH)
+        self.metrics_prom_path = self.path(METRICS_PROM_PATH)
+        if self.metrics_prom_path and label:
+            # 多个账号的 .prom 可能指向同一个 textfile 目录，按账号区分文件名
+            base, ext = os.path.splitext(self.metrics_prom_path)
+            self.metrics_prom_path = f"{base}-{label}{ext}"
+
+    def path(self, name: Optional[str]) -> Optional[str]:
+        if name is None or self.root == "." or os.path.isabs(name):
+            return name
+        return os.path.join(self.root, name)
+
+    def text_rate_limiter(self) -> RateLimiter:
+        return self.text_limiter or RateLimiter(rate_rps=TEXT_RATE_RPS)
+
+    def image_rate_limiter(self) -> RateLimiter:
+        return self.image_limiter or RateLimiter(rate_rps=IMAGE_RATE_RPS, rate_bps=IMAGE_RATE_BPS)
+
+    def controller(self, max_limit: int) -> AIMDController:
+        if self.scheduler is not None:
+            return self.scheduler.controller(self.label, initial=2, max_limit=max_limit)
+        return AIMDController(initial=2, max_limit=max_limit)
+
+
+def _export_text(
+    session,
+    token: str,
+    userid: int,
+    diary_ids: List[int],
+    synced_diaries: Dict[int, Dict[str, Any]],
+    sync_state: Dict[str, Any],
+    on_block: Optional[Callable[[str], None]] = None,
+    store: Optional[SqliteDiaryStore] = None,
+    metrics: Optional[RunMetrics] = None,
+    job: Optional[ExportJob] = None,
+) -> None:
+    job = job or ExportJob()
+    to_fetch = [did for did in diary_ids if did not in synced_diaries]
+    failed_diaries = export_text_by_diary_ids(
+        session=session,
+        token=token,
+        userid=userid,
+        diary_ids=diary_ids,
+        out_path=job.dairies_txt if store is None else None,
+        batch_size=TEXT_BATCH_SIZE,
+        sleep_s=0.15,
+        workers=TEXT_WORKERS,
+        rate_limiter=job.text_rate_limiter(),
+        merge_existing=True,
+        prefetched=synced_diaries,
+        batch_sizer=AdaptiveBatchSizer(initial=TEXT_BATCH_SIZE, max_size=TEXT_BATCH_MAX),
+        retry=RetryPolicy(max_attempts=MAX_ATTEMPTS),
+        controller=job.controller(TEXT_WORKERS),
+        on_block=on_block,
+        store=store,
+        metrics=metrics,
+        archive=job.archive,
+        abort_after=TEXT_ABORT_AFTER,
+    )
+    if to_fetch and set(to_fetch) <= set(failed_diaries):
+        job.text_failed = len(to_fetch)
+    if store is not None and WRITE_DAIRIES_TXT:
+        n = store.export_text(job.dairies_txt)
+        print(f"[export_text] derived {job.dairies_txt} from {store.path} (diaries={n})")
+    # 水位已经越过抓取失败的日记，sync 不会再返回它们；记下来，下次同步时一并重新抓取
+    sync_state["retry_diaries"] = sorted(set(failed_diaries))
+
+
+def _export_images(
+    session,
+    token: str,
+    userid: int,
+    image_ids: List[int],
+    on_done: Optional[Callable[[int, str], None]] = None,
+    metrics: Optional[RunMetrics] = None,
+    job: Optional[ExportJob] = None,
+    on_skip: Optional[Callable[[List[int]], None]] = None,
+) -> None:
+    job = job or ExportJob()
+    export_images_by_image_ids(
+        session=session,
+        token=token,
+        userid=userid,
+        image_ids=image_ids,
+        out_dir=job.images_dir,
+        sleep_s=0.10,
+        workers=IMAGE_WORKERS,
+        rate_limiter=job.image_rate_limiter(),
+        skip_existing=not job.refetch,
+        retry=RetryPolicy(max_attempts=MAX_ATTEMPTS),
+        controller=job.controller(IMAGE_WORKERS),
+        on_done=on_done,
+        store_dir=job.image_store_dir,
+        metrics=metrics,
+        archive=job.archive,
+        on_skip=on_skip,
+    )
+
+
+def _record_image(store: Optional[SqliteDiaryStore]) -> Optional[Callable[[int, str], None]]:
+    if store is None:
+        return None
+    return lambda image_id, path: store.set_image_path(image_id, path)
+
+
+def _recover_legacy_bin(
+    store: Optional[SqliteDiaryStore] = None,
+    metrics: Optional[RunMetrics] = None,
+    job: Optional[ExportJob] = None,
+) -> None:
+    job = job or ExportJob()
+
+    # 下载时已按文件头识别格式；这里只原地修正旧版本留下的 .bin
+    def on_result(src_path: str, dst_path: str, is_image: bool) -> None:
+        m = IMAGE_NAME_RE.match(os.path.basename(dst_path))
+        if store is not None and m:
+            store.set_image_path(int(m.group(1)), dst_path)
+        if metrics is not None:
+            metrics.file_written("recovered" if is_image else "non_image", os.path.getsize(dst_path))
+
+    processed, recovered, non_images = recover_images_from_bin(
+        src_dir=job.images_dir,
+        dst_dir=job.images_dir,
+        mode="rename",
+        on_result=on_result,
+    )
+    print(f"[recover] processed={processed} recovered={recovered} non_images={non_images}")
+
+
+class _Stage(threading.Thread):
+    """流水线中的一个阶段：在后台线程里运行 fn，记录异常，结束时调用 on_exit。"""
+
+    def __init__(self, name: str, fn: Callable[[], None], on_exit: Callable[[], None]) -> None:
+        super().__init__(name=name, daemon=True)
+        self.fn = fn
+        self.on_exit = on_exit
+        self.error: Optional[BaseException] = None
+
+    def run(self) -> None:
+        try:
+            self.fn()
+        except BaseException as e:
+            self.error = e
+        finally:
+            self.on_exit()
+
+
+def _export_html(job: ExportJob, metrics: Optional[RunMetrics] = None) -> None:
+    export_as_html(
+        dairies_txt=job.dairies_txt,
+        images_dir=job.images_dir,
+        out_html=job.html,
+        dairies_db=job.diary_db_path,
+        cache_path=job.html_cache_path,
+        shard=HTML_SHARD,
+        virtual=HTML_VIRTUAL,
+        workers=HTML_RENDER_WORKERS,
+        chunk_size=HTML_RENDER_CHUNK,
+        image_index_cache=job.image_index_cache,
+        metrics=metrics,
+    )
+
+
+def run_pipeline(
+    session, token, userid, diary_ids, image_ids, synced_diaries, sync_state, store=None, metrics=None, job=None,
+    recover=True,
+) -> None:
+    """
+    流水线：
+      正文抓取线程 --(有界队列, 按 DiaryID 升序)--> 渲染（主线程）--> dairies.html
+      图片下载线程 --(下载完成事件)--------------↗
+    渲染一篇日记前只等待它引用、且本次还在下载的图片（本地已有而跳过的立即放行）；格式识别在下载时完成。
+    渲染线程等正文、等图片的时间分别记为 html 阶段的 wait_text / wait_image。
+    job.archive 非空时三路输出都写进归档，页面里的图片链接是归档内的相对路径。
+    recover=False 时不修正旧版 .bin（--only 没有选 recover）。
+    """
+    job = job or ExportJob(metrics=metrics)
+    metrics = job.metrics
+    archive = job.archive
+    images_path = Path(job.images_dir)
+    if archive is None:
+        os.makedirs(job.images_dir, exist_ok=True)
+        if recover:
+            with metrics.phase("recover"):
+                _recover_legacy_bin(store, metrics, job)
+        img_index = build_image_index(images_path, Path(job.image_index_cache) if job.image_index_cache else None)
+    else:
+        # 归档里只有本次下载的图片，下载时已识别格式，没有要恢复的 .bin
+        img_index = {}
+    if store is not None:
+        merge_store_image_paths(img_index, store)
+    record_image = _record_image(store)
+    resolver = ImageResolver(images_path, img_index, link_base=Path(job.html).parent, fallback=archive is None)
+    pending = {iid: threading.Event() for iid in image_ids}
+    entries: "queue.Queue[Optional[Dict]]" = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    stop = threading.Event()
+
+    def on_block(text: str) -> None:
+        e = parse_diary_block(text)
+        if e is None:
+            return
+        while not stop.is_set():
+            try:
+                entries.put(e, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+        raise RuntimeError("pipeline aborted")
+
+    def on_image(image_id: int, path: str) -> None:
+        if record_image is not None:
+            record_image(image_id, path)
+        p = Path(path)
+        if p.parent != images_path / "_non_image":
+            img_index[image_id] = p
+        else:
+            resolver.mark_non_image(image_id)
+        ev = pending.get(image_id)
+        if ev is not None:
+            ev.set()
+
+    def on_skip(skipped: List[int]) -> None:
+        # 本地已有、不会再下载的图片：马上放行，不要等整个图片阶段结束
+        for image_id in skipped:
+            ev = pending.get(image_id)
+            if ev is not None:
+                ev.set()
+
+    def end_of_text() -> None:
+        while True:
+            try:
+                entries.put(None, timeout=0.5)
+                return
+            except queue.Full:
+                if stop.is_set():
+                    return
+
+    def release_images() -> None:
+        for ev in pending.values():
+            ev.set()
 
-def main() -> int:
+    def text_fn() -> None:
+        with metrics.phase("text"):
+            _export_text(session, token, userid, diary_ids, synced_diaries, sync_state, on_block, store, metrics, job)
+
+    def images_fn() -> None:
+        with metrics.phase("images"):
+            _export_images(session, token, userid, image_ids, on_image, metrics, job, on_skip)
+
+    text_stage = _Stage("text", text_fn, end_of_text)
+    image_stage = _Stage("images", images_fn, release_images)
+
+    source_label = store.path if store is not None else job.dairies_txt
+    cache = FragmentCache(job.html_cache_path) if job.html_cache_path else None
+    writer: Any
+    if HTML_SHARD:
+        writer = ShardedHtmlWriter(
+            job.html, img_index, images_path, HTML_SHARD, source_label,
+            cache=cache, resolver=resolver, metrics=metrics, archive=archive,
+        )
+    elif HTML_VIRTUAL:
+        writer = VirtualHtmlWriter(
+            job.html, img_index, images_path, source_label=source_label,
+            cache=cache, resolver=resolver, metrics=metrics, archive=archive,
+        )
+    else:
+        writer = DiaryHtmlWriter(
+            job.html, img_index, images_path, source_label=source_label,
+            cache=cache, resolver=resolver, metrics=metrics, archive=archive,
+        )
+    text_stage.start()
+    image_stage.start()
     try:
-        session, token, userid, diary_ids, image_ids = login_and_sync_index(
-            email=EMAIL,
-            password=PASSWORD,
+        try:
+            with metrics.phase("html"):
+                while True:
+                    t0 = time.perf_counter()
+                    e = entries.get()
+                    metrics.sleep("html", "wait_text", time.perf_counter() - t0)
+                    if e is None:
+                        break
+                    for m in IMG_REF_RE.finditer("\n".join(e["content_lines"])):
+                        ev = pending.get(int(m.group(1)))
+                        if ev is not None and not ev.is_set():
+                            t0 = time.perf_counter()
+                            ev.wait()
+                            metrics.sleep("html", "wait_image", time.perf_counter() - t0)
+                    writer.write(e)
+        except BaseException:
+            stop.set()
+            writer.abort()
+            raise
+        finally:
+            text_stage.join()
+            image_stage.join()
+
+        for stage in (text_stage, image_stage):
+            if stage.error is not None:
+                writer.abort()
+                raise stage.error
+
+        writer.close()
+    finally:
+        if cache is not None:
+            cache.close()
+    print(f"OK: wrote {job.html} (entries={writer.count}, diary_dates={len(writer.dates)}, images_indexed={len(img_index)})")
+    resolver.report()
+
+
+def _write_run_report(job: ExportJob, ok: bool) -> None:
+    metrics = job.metrics
+    metrics.finish(ok)
+    for name, p in sorted(metrics.report()["phases"].items(), key=lambda kv: kv[1]["first_start"]):
+        waits = ", ".join(f"{k} {v:.1f}s" for k, v in sorted(p.get("sleep_seconds", {}).items()))
+        print(f"[metrics] {name}: {p['seconds']:.1f}s" + (f" (waits: {waits})" if waits else ""))
+    try:
+        if job.metrics_json_path:
+            metrics.write_json(job.metrics_json_path)
+            print(f"[metrics] wrote {job.metrics_json_path}")
+        if job.metrics_prom_path:
+            metrics.write_prometheus(job.metrics_prom_path)
+            print(f"[metrics] wrote {job.metrics_prom_path}")
+    except OSError as e:
+        print("[metrics] failed to write report:", e, file=sys.stderr)
+
+
+PHASES = ("sync", "text", "images", "recover", "html")
+
+
+def select_phases(only: Optional[List[str]] = None, offline: bool = False) -> List[str]:
+    """
+    要执行的阶段（按流程顺序）：
+    - only 为空表示全部；text / images 需要 sync 提供 token 和变化列表，会自动带上 sync
+    - offline=True 时去掉所有联网的阶段（sync / text / images）
+    """
+    names = set(only or PHASES)
+    unknown = names - set(PHASES)
+    if unknown:
+        raise ValueError(f"unknown phase(s): {', '.join(sorted(unknown))} (choose from {', '.join(PHASES)})")
+    if names & {"text", "images"}:
+        names.add("sync")
+    if offline:
+        names -= {"sync", "text", "images"}
+    return [p for p in PHASES if p in names]
+
+
+def _keep_previous_sync(sync_state: Dict[str, Any], previous: Dict[str, Any], section: str) -> None:
+    # 本次不导出的部分不推进水位，下次同步还会返回这些变化
+    ts_key = {"diaries": "diaries_ts", "images": "images_ts"}[section]
+    sync_state[section] = previous[section]
+    sync_state[ts_key] = previous[ts_key]
+    if section == "diaries":
+        sync_state["retry_diaries"] = previous["retry_diaries"]
+
+
+def _html_inputs(job: ExportJob) -> List[str]:
+    # 日记库不按文件签名比较（打开库、WAL checkpoint 都会改文件），内容摘要见 _html_params
+    sources = [] if job.diary_db_path else [job.dairies_txt]
+    recovery_dir = job.path("recovery_images")
+    image_dirs = [job.images_dir, os.path.join(job.images_dir, "_non_image"),
+                  recovery_dir, os.path.join(recovery_dir, "_non_image")]
+    return sources + image_dirs
+
+
+def _html_outputs(job: ExportJob) -> List[str]:
+    # 分页时上次写出的每个分片页、日历脚本和 shards.json 都算产物，缺一个就重新生成
+    return shard_outputs(job.html) if HTML_SHARD else [job.html]
+
+
+def _html_params(job: ExportJob) -> Dict[str, Any]:
+    # 渲染代码（含 CSS / JS 模板）改了也要重新生成
+    with open(html_module.__file__, "rb") as f:
+        renderer = hashlib.sha256(f.read()).hexdigest()
+    db = None
+    if job.diary_db_path and os.path.exists(job.diary_db_path):
+        with SqliteDiaryStore(job.diary_db_path) as store:
+            db = store.signature()
+    return {"renderer": renderer, "shard": HTML_SHARD, "virtual": HTML_VIRTUAL, "db": db}
+
+
+def _check_text_fetched(job: ExportJob) -> None:
+    """正文一篇都没抓到（服务端不可用等）时让这次导出失败；已有的内容都保留，日记 ID 留在 retry_diaries。"""
+    if job.text_failed:
+        raise RuntimeError(
+            f"text phase fetched none of the {job.text_failed} diaries it needed; "
+            "kept the previous content, they will be fetched again next run"
         )
 
+
+def _export_to_archive(job: ExportJob) -> None:
+    """
+    归档模式：全量同步，正文、图片、HTML 经流水线直接写进 job.archive_path（见 archive.ArchiveWriter）。
+    不读写 sync_state.json 和阶段指纹；token 缓存、HTML 片段缓存、运行报告照常留在本地。
+    日记库（DIARY_DB_PATH）和图片仓库（IMAGE_STORE_DIR）不参与。
+    """
+    metrics = job.metrics
+    synced_diaries: Dict[int, Dict[str, Any]] = {}
+    # 先打开归档：格式不支持、缺 zstandard 时在登录前就报错
+    try:
+        with ArchiveWriter(job.archive_path) as archive:
+            job.archive = archive
+            with metrics.phase("sync"):
+                session, token, userid, diary_ids, image_ids = login_and_sync_index(
+                    email=job.email,
+                    password=job.password,
+                    diary_sink=synced_diaries,
+                    token_cache_path=job.token_cache_path,
+                    pool_size=max(TEXT_WORKERS, IMAGE_WORKERS),
+                    metrics=metrics,
+                    adapter=job.adapter,
+                )
+
+            print("[index] userid:", userid)
+            print("[index] diary_ids:", len(diary_ids))
+            print("[index] image_ids:", len(image_ids))
+
+            try:
+                run_pipeline(
+                    session, token, userid, diary_ids, image_ids, synced_diaries, new_sync_state(), None, metrics, job,
+                )
+            finally:
+                session.close()
+            # 在归档关闭之前检查：没有正文的归档直接丢弃
+            _check_text_fetched(job)
+    finally:
+        job.archive = None
+    print(f"All done. Output: {job.archive_path} (files={len(archive.members)})")
+
+
+def export_account(
+    job: ExportJob,
+    only: Optional[List[str]] = None,
+    force: bool = False,
+    offline: bool = False,
+) -> None:
+    """
+    导出一个账号，失败时抛出异常；运行报告由调用方写出。
+    各阶段按 PhaseGraph 执行：sync 总是联网检查变化，text / images 只在有变化时运行，
+    recover / html 只在输入（文件、配置、渲染代码）变化时运行。only / offline 见 select_phases；
+    force 忽略指纹，选了 sync 时还会全量同步、重新下载全部正文和图片（见 ExportJob.refetch）。
+    """
+    if job.root != ".":
+        os.makedirs(job.root, exist_ok=True)
+    if job.archive_path:
+        if only or offline:
+            raise ValueError("archive output always runs a full export; --only / --offline are not supported")
+        _export_to_archive(job)
+        return
+
+    metrics = job.metrics
+    selected = select_phases(only, offline)
+    graph = PhaseGraph(job.phase_state_path, force=force, metrics=metrics)
+    job.refetch = force and "sync" in selected
+
+    session = None
+    token: Optional[str] = None
+    userid: Optional[int] = None
+    diary_ids: List[int] = []
+    image_ids: List[int] = []
+    # 服务端没有变化、只是本地丢失（或只下载到错误页）的已知图片
+    missing_images: List[int] = []
+    sync_state: Optional[Dict[str, Any]] = None
+    # sync 响应里自带完整正文的日记，导出时直接写出，不再走 all_by_ids
+    synced_diaries: Dict[int, Dict[str, Any]] = {}
+
+    if "sync" in selected:
+        # 输出文件（或日记库）不在了就没法增量合并，退回全量
+        if os.path.exists(job.diary_db_path or job.dairies_txt):
+            previous = load_sync_state(job.sync_state_path)
+        else:
+            previous = new_sync_state()
+        # --force 也全量同步；本次没有选的部分仍保留上次的状态（见 _keep_previous_sync）
+        sync_state = new_sync_state() if job.refetch else copy.deepcopy(previous)
+
+        with metrics.phase("sync"):
+            session, token, userid, diary_ids, image_ids = login_and_sync_index(
+                email=job.email,
+                password=job.password,
+                sync_state=sync_state,
+                diary_sink=synced_diaries,
+                token_cache_path=job.token_cache_path,
+                pool_size=max(TEXT_WORKERS, IMAGE_WORKERS),
+                metrics=metrics,
+                adapter=job.adapter,
+            )
+
         print("[index] userid:", userid)
         print("[index] diary_ids:", len(diary_ids))
         print("[index] image_ids:", len(image_ids))
+        if "images" in selected:
+            # sync 只返回服务端有变化的图片；本地被删掉或损坏的已知图片在这里补回下载列表
+            # 只下载到错误页的也重新下载，最多 NON_IMAGE_RETRIES 次
+            missing_images = missing_image_ids(
+                (int(i) for i in sync_state["images"]), job.images_dir, job.image_store_dir,
+                non_image_tries=sync_state.setdefault("non_image_tries", {}), max_non_image_tries=NON_IMAGE_RETRIES,
+            )
+            missing_images = sorted(set(missing_images) - set(image_ids))
+            if missing_images:
+                print(f"[index] {len(missing_images)} known images missing locally, fetching again")
+                image_ids = sorted(set(image_ids) | set(missing_images))
+        if "text" not in selected:
+            _keep_previous_sync(sync_state, previous, "diaries")
+            diary_ids, synced_diaries = [], {}
+        if "images" not in selected:
+            _keep_previous_sync(sync_state, previous, "images")
+            image_ids = []
 
-        # 1) 导出日记文本
-        export_text_by_diary_ids(
-            session=session,
-            token=token,
-            userid=userid,
-            diary_ids=diary_ids,
-            out_path="dairies.txt",
-            batch_size=50,
-            sleep_s=0.15,
-        )
+    store = SqliteDiaryStore(job.diary_db_path) if job.diary_db_path else None
 
-        # 2) 下载图片（原始）
-        export_images_by_image_ids(
-            session=session,
-            token=token,
-            userid=userid,
-            image_ids=image_ids,
-            out_dir="images",
-            sleep_s=0.10,
-        )
+    def close_store() -> None:
+        # 日记库的改动落盘（WAL checkpoint）之后再记录 html 的指纹
+        nonlocal store
+        if store is not None:
+            store.close()
+            store = None
 
-        session.close()
+    def run_text() -> None:
+        with metrics.phase("text"):
+            _export_text(session, token, userid, diary_ids, synced_diaries, sync_state, store=store,
+                         metrics=metrics, job=job)
 
-        # 3) 恢复 .bin 图片后缀到 recovery_images
-        processed, recovered, non_images = recover_images_from_bin(
-            src_dir="images",
-            dst_dir="recovery_images",
-        )
-        print(f"[recover] processed={processed} recovered={recovered} non_images={non_images}")
+    def run_images() -> None:
+        with metrics.phase("images"):
+            _export_images(session, token, userid, image_ids, _record_image(store), metrics, job)
+
+    def run_recover() -> None:
+        os.makedirs(job.images_dir, exist_ok=True)
+        with metrics.phase("recover"):
+            _recover_legacy_bin(store, metrics, job)
 
-        # 4) 导出 HTML（合并文本 + 图片）
-        export_as_html(
-            dairies_txt="dairies.txt",
-            images_dir="recovery_images",
-            out_html="dairies.html",
+    def run_html() -> None:
+        close_store()
+        with metrics.phase("html"):
+            _export_html(job, metrics)
+
+    def run_fused() -> None:
+        run_pipeline(
+            session, token, userid, diary_ids, image_ids, synced_diaries, sync_state, store, metrics, job,
+            recover="recover" in selected,
         )
+        close_store()
+
+    text = Phase("text", run_text, outputs=[job.diary_db_path or job.dairies_txt], pending=lambda: len(diary_ids))
+    images = Phase(
+        "images", run_images, outputs=[job.images_dir],
+        pending=lambda: len(image_ids) - len(missing_images), missing_local=lambda: len(missing_images),
+    )
+    recover = Phase("recover", run_recover, inputs=[job.images_dir])
+    html = Phase(
+        "html", run_html, inputs=_html_inputs(job), outputs=_html_outputs(job), params=lambda: _html_params(job),
+    )
+
+    try:
+        network = [p for p in (text, images) if p.name in selected]
+        stale = {p.name: graph.stale_reason(p) for p in network}
+        if PIPELINE and "html" in selected and any(stale.values()):
+            # 流水线：正文、图片、恢复、HTML 一起跑（HTML 需要全部正文，没变化的 text 也会重新流过一遍）
+            fused = network + [p for p in (recover, html) if p.name in selected]
+            reason = "; ".join(f"{name}: {r}" for name, r in stale.items() if r)
+            graph.run_together(fused, run_fused, reason)
+            save_sync_state(job.sync_state_path, sync_state)
+        else:
+            for p in network:
+                graph.run(p)
+            if sync_state is not None:
+                save_sync_state(job.sync_state_path, sync_state)
+            if "recover" in selected:
+                graph.run(recover)
+            if "html" in selected:
+                graph.run(html)
+        _check_text_fetched(job)
+        print(f"All done. Output: {job.html}")
+    finally:
+        if session is not None:
+            session.close()
+        close_store()
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="导出你的日记：dairies.txt + images/ + dairies.html")
+    parser.add_argument(
+        "--only", action="append", metavar="PHASE",
+        help=f"只执行这些阶段（可重复，或用逗号分隔）：{','.join(PHASES)}；text/images 会自动带上 sync",
+    )
+    parser.add_argument("--offline", action="store_true", help="不访问网络，只执行过期的 recover / html")
+    parser.add_argument("--force", action="store_true", help="忽略阶段指纹，所选阶段全部重新执行")
+    parser.add_argument(
+        "--archive", metavar="PATH",
+        help="把结果直接写进一个归档（.tar / .tar.gz / .tar.zst / .zip），覆盖 ARCHIVE_PATH",
+    )
+    args = parser.parse_args(argv or [])
+    only = [name.strip() for value in args.only or [] for name in value.split(",") if name.strip()]
+    try:
+        select_phases(only, args.offline)
+        if args.archive or ARCHIVE_PATH:
+            archive_format(args.archive or ARCHIVE_PATH)
+            if only or args.offline:
+                raise ValueError("--archive always runs a full export; it cannot be combined with --only / --offline")
+    except ValueError as e:
+        parser.error(str(e))
 
-        print("All done. Output: dairies.html")
+    job = ExportJob(email=EMAIL, password=PASSWORD, archive_path=args.archive)
+    ok = False
+    try:
+        export_account(job, only=only, force=args.force, offline=args.offline)
+        ok = True
         return 0
 
     except Exception as e:
         print("ERROR:", e, file=sys.stderr)
         return 1
 
+    finally:
+        _write_run_report(job, ok)
+
 
 if __name__ == "__main__":
-    raise SystemExit(main())
+    raise SystemExit(main(sys.argv[1:]))
@@ -0,0 +1,229 @@
+# metrics.py
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+
+# HTTP 延迟（秒）
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# 单篇日记渲染耗时（秒）
+RENDER_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+PROM_PREFIX = "nideriji_"
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: Dict[str, Any]) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+class Histogram:
+    """固定分桶的直方图（与 Prometheus histogram 语义一致，counts 为非累计计数）。"""
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q: float) -> float:
+        """按桶上界估计分位数（不超过观测到的最大值）。"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return min(self.buckets[i], self.max) if i < len(self.buckets) else self.max
+        return self.max
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "max": round(self.max, 6),
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99),
+            "buckets": {str(b): n for b, n in zip(self.buckets + ("+Inf",), self.counts)},  # type: ignore[operator]
+        }
+
+
+class RunMetrics:
+    """
+    一次导出运行的指标（线程安全），由 main 创建并传给各阶段：
+    - phase(name)：阶段墙钟耗时（流水线模式下阶段互相重叠，各自计时）
+    - request()：每个 HTTP 请求的延迟直方图、状态码计数、传输字节数（按接口分类）
+    - retry() / sleep()：重试次数与退避、限速、固定间隔等等待时间（按阶段和原因，多线程累加）
+    - file_written()：写出的文件数与字节数（按类型）
+    - observe()：其他耗时分布，例如单篇日记的渲染时间
+    结束时 report() 生成 JSON 报告，write_prometheus() 写 node_exporter textfile collector 格式。
+    labels 会附加到每条 Prometheus 指标上（例如多账号时的 account）。
+    """
+
+    def __init__(self, labels: Optional[Dict[str, Any]] = None) -> None:
+        self.labels = dict(labels or {})
+        self.started = time.time()
+        self.finished: Optional[float] = None
+        self.ok: Optional[bool] = None
+        self._t0 = time.perf_counter()
+        self._lock = threading.Lock()
+        self._counters: Dict[Tuple[str, Labels], float] = {}
+        self._histograms: Dict[Tuple[str, Labels], Histogram] = {}
+        self._phases: Dict[str, Dict[str, float]] = {}
+
+    def inc(self, name: str, value: float = 1, **labels: Any) -> None:
+        key = (name, _labels(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, buckets: Tuple[float, ...] = LATENCY_BUCKETS, **labels: Any) -> None:
+        key = (name, _labels(labels))
+        with self._lock:
+            h = self._histograms.get(key)
+            if h is None:
+                h = self._histograms[key] = Histogram(buckets)
+            h.observe(value)
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            with self._lock:
+                p = self._phases.setdefault(name, {"seconds": 0.0, "runs": 0, "first_start": start - self._t0})
+                p["seconds"] += end - start
+                p["runs"] += 1
+                p["last_end"] = end - self._t0
+
+    def request(self, endpoint: str, seconds: float, status: Any, nbytes: int = 0) -> None:
+        self.observe("http_request_seconds", seconds, endpoint=endpoint)
+        self.inc("http_requests_total", endpoint=endpoint, status=status)
+        if nbytes:
+            self.inc("http_response_bytes_total", nbytes, endpoint=endpoint)
+
+    def retry(self, phase: str, reason: str, delay_s: float) -> None:
+        self.inc("retries_total", phase=phase, reason=reason)
+        self.sleep(phase, "retry", delay_s)
+
+    def sleep(self, phase: str, reason: str, seconds: float) -> None:
+        if seconds > 0:
+            self.inc("sleep_seconds_total", seconds, phase=phase, reason=reason)
+
+    def file_written(self, kind: str, nbytes: int) -> None:
+        self.inc("files_written_total", kind=kind)
+        self.inc("file_bytes_written_total", nbytes, kind=kind)
+
+    def finish(self, ok: bool) -> None:
+        self.ok = ok
+        self.finished = time.time()
+
+    def report(self) -> Dict[str, Any]:
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {k: h.as_dict() for k, h in self._histograms.items()}
+            phases = {k: dict(v) for k, v in self._phases.items()}
+
+        for (name, labels), value in counters.items():
+            d = dict(labels)
+            if name == "sleep_seconds_total" and d.get("phase") in phases:
+                sleeps = phases[d["phase"]].setdefault("sleep_seconds", {})
+                sleeps[d["reason"]] = round(value, 6)
+        for p in phases.values():
+            p["seconds"] = round(p["seconds"], 6)
+            p["first_start"] = round(p["first_start"], 6)
+            p["last_end"] = round(p.get("last_end", 0.0), 6)
+
+        def rows(items: Dict[Tuple[str, Labels], Any], field: str) -> List[Dict[str, Any]]:
+            return [
+                {"name": name, "labels": dict(labels), field: value}
+                for (name, labels), value in sorted(items.items())
+            ]
+
+        return {
+            "labels": self.labels,
+            "started": self.started,
+            "finished": self.finished,
+            "seconds": round((self.finished or time.time()) - self.started, 6),
+            "ok": self.ok,
+            "phases": phases,
+            "counters": rows({k: round(v, 6) for k, v in counters.items()}, "value"),
+            "histograms": rows(histograms, "histogram"),
+        }
+
+    def write_json(self, path: str) -> None:
+        _atomic_write(path, json.dumps(self.report(), ensure_ascii=False, indent=1))
+
+    def prometheus_text(self) -> str:
+        out: List[str] = []
+        typed: set = set()
+
+        def series(name: str, labels: Labels, value: float, kind: str) -> None:
+            full = PROM_PREFIX + name
+            if full not in typed:
+                out.append(f"# TYPE {full} {kind}")
+                typed.add(full)
+            all_labels = _labels(self.labels) + labels
+            label_text = ",".join(f'{k}="{_prom_escape(v)}"' for k, v in all_labels)
+            out.append(f"{full}{{{label_text}}} {value:.10g}" if label_text else f"{full} {value:.10g}")
+
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items(), key=lambda kv: kv[0])
+            phases = sorted(self._phases.items())
+
+        for (name, labels), value in counters:
+            series(name, labels, value, "counter")
+        for (name, labels), h in histograms:
+            full = PROM_PREFIX + name
+            if full not in typed:
+                out.append(f"# TYPE {full} histogram")
+                typed.add(full)
+            base = _labels(self.labels) + labels
+            cumulative = 0
+            for bound, n in zip(h.buckets + (float("inf"),), h.counts):
+                cumulative += n
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                text = ",".join(f'{k}="{_prom_escape(v)}"' for k, v in base + (("le", le),))
+                out.append(f"{full}_bucket{{{text}}} {cumulative}")
+            text = ",".join(f'{k}="{_prom_escape(v)}"' for k, v in base)
+            out.append(f"{full}_sum{{{text}}} {h.sum:.10g}")
+            out.append(f"{full}_count{{{text}}} {h.count}")
+        for name, p in phases:
+            series("phase_seconds", (("phase", name),), p["seconds"], "gauge")
+        series("run_start_timestamp_seconds", (), self.started, "gauge")
+        if self.finished is not None:
+            series("run_duration_seconds", (), self.finished - self.started, "gauge")
+            series("run_success", (), 1 if self.ok else 0, "gauge")
+        return "\n".join(out) + "\n"
+
+    def write_prometheus(self, path: str) -> None:
+        # textfile collector 只读 *.prom，写临时文件再改名避免读到半截
+        _atomic_write(path, self.prometheus_text())
+
+
+def _prom_escape(v: str) -> str:
+    return v.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _atomic_write(path: str, text: str) -> None:
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp, path)
@@ -0,0 +1,141 @@
+# phases.py
+import json
+import os
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence
+
+from metrics import RunMetrics
+
+
+def path_signature(path: str) -> Any:
+    """
+    文件：[size, mtime_ns]；目录：["dir", mtime_ns]（目录里增删、改名文件都会改变它）；不存在：None。
+    只看元数据，不读内容。
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    if os.path.isdir(path):
+        return ["dir", st.st_mtime_ns]
+    return [st.st_size, st.st_mtime_ns]
+
+
+class Phase:
+    """
+    导出流程中的一个阶段（类似 Makefile 里的一条规则）：
+    - inputs：输入文件/目录，按 path_signature 计入指纹
+    - params：其他影响产物的东西（配置、渲染代码的哈希……），调用后得到可 JSON 化的值计入指纹
+    - outputs：产物；任何一个不存在都视为过期
+    - pending：联网阶段用，返回服务端有多少待处理的变化（来自本次 sync）；
+      这类阶段不记指纹，有变化或产物缺失时才运行
+    - missing_local：联网阶段用，返回本地丢失、需要重新下载的条目数（不是服务端的变化，单独报告）
+    """
+
+    def __init__(
+        self,
+        name: str,
+        run: Callable[[], None],
+        inputs: Sequence[str] = (),
+        outputs: Sequence[str] = (),
+        params: Optional[Callable[[], Any]] = None,
+        pending: Optional[Callable[[], int]] = None,
+        missing_local: Optional[Callable[[], int]] = None,
+    ) -> None:
+        self.name = name
+        self.run = run
+        self.inputs = [p for p in inputs if p]
+        self.outputs = [p for p in outputs if p]
+        self.params = params
+        self.pending = pending
+        self.missing_local = missing_local
+
+    def fingerprint(self) -> Dict[str, Any]:
+        fp = {
+            "inputs": {p: path_signature(p) for p in self.inputs},
+            "params": self.params() if self.params is not None else None,
+        }
+        # 与从 JSON 读回的旧指纹比较（tuple/list 等差异）
+        return json.loads(json.dumps(fp, sort_keys=True))
+
+
+class PhaseGraph:
+    """
+    按顺序执行各阶段，跳过输入没有变化的：
+    - 每个阶段运行成功后记录它的指纹（运行之后的输入状态），保存在 state_path
+    - 下次运行时指纹相同且产物都在就跳过；上游阶段改了文件，下游的指纹自然不同
+    - force=True 时忽略指纹，全部运行；state_path 为 None 时不记录、也不跳过
+    """
+
+    def __init__(self, state_path: Optional[str], force: bool = False, metrics: Optional[RunMetrics] = None) -> None:
+        self.state_path = state_path
+        self.force = force or not state_path
+        self.metrics = metrics
+        self.state: Dict[str, Any] = {}
+        if state_path and os.path.exists(state_path):
+            try:
+                with open(state_path, "r", encoding="utf-8") as f:
+                    self.state = json.load(f)
+            except (OSError, ValueError):
+                self.state = {}
+
+    def stale_reason(self, phase: Phase) -> Optional[str]:
+        """过期的原因；None 表示可以跳过。"""
+        if self.force:
+            return "forced"
+        missing = [p for p in phase.outputs if not os.path.exists(p)]
+        if missing:
+            return "missing " + ", ".join(missing)
+        if phase.pending is not None:
+            n = phase.pending()
+            m = phase.missing_local() if phase.missing_local is not None else 0
+            parts = [f"{n} remote changes"] if n else []
+            if m:
+                parts.append(f"{m} missing locally")
+            return ", ".join(parts) or None
+        prev = self.state.get(phase.name)
+        if prev is None:
+            return "no previous run"
+        cur = phase.fingerprint()
+        changed = [p for p, sig in cur["inputs"].items() if (prev.get("inputs") or {}).get(p) != sig]
+        if cur["params"] != prev.get("params"):
+            changed.append("params")
+        return "changed " + ", ".join(changed) if changed else None
+
+    def run(self, phase: Phase) -> bool:
+        """需要时运行 phase，返回是否运行了。"""
+        reason = self.stale_reason(phase)
+        if reason is None:
+            self._skipped(phase)
+            return False
+        print(f"[phases] {phase.name}: run ({reason})")
+        phase.run()
+        self.record([phase])
+        return True
+
+    def run_together(self, phases: Iterable[Phase], fn: Callable[[], None], reason: str) -> None:
+        """把几个阶段合在一起运行（流水线模式），成功后一起记录指纹。"""
+        phases = list(phases)
+        print(f"[phases] {'+'.join(p.name for p in phases)}: run ({reason})")
+        fn()
+        self.record(phases)
+
+    def _skipped(self, phase: Phase) -> None:
+        print(f"[phases] {phase.name}: up to date, skipped")
+        if self.metrics is not None:
+            self.metrics.inc("phases_skipped_total", phase=phase.name)
+
+    def record(self, phases: List[Phase]) -> None:
+        for phase in phases:
+            if self.metrics is not None:
+                self.metrics.inc("phases_run_total", phase=phase.name)
+            if phase.pending is None:
+                self.state[phase.name] = phase.fingerprint()
+        self._save()
+
+    def _save(self) -> None:
+        if not self.state_path:
+            return
+        tmp = self.state_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.state, f, ensure_ascii=False, indent=1, sort_keys=True)
+        os.replace(tmp, self.state_path)
@@ -1,7 +1,11 @@
 # recovery_image_ext.py
+import filecmp
+import json
 import os
 import shutil
-from typing import Optional, Tuple
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple
 
 
 def _sniff_image_ext(header: bytes) -> Optional[str]:
@@ -40,62 +44,201 @@ def _looks_like_text(header: bytes) -> bool:
     )
 
 
-def recover_images_from_bin(
+RECOVERY_MODES = ("copy", "hardlink", "rename")
+
+
+def _place(src_path: str, dst_path: str, mode: str) -> None:
+    """把 src_path 放到 dst_path（已有别的文件则覆盖）；dst_path 已经是它的硬链接时什么都不用做。"""
+    if os.path.exists(dst_path) and os.path.samefile(src_path, dst_path):
+        # 上次以 hardlink 放过（manifest 丢了或源文件被原地改过时会再走到这里）
+        if mode == "rename":
+            os.remove(src_path)
+        return
+    if mode == "rename":
+        os.replace(src_path, dst_path)
+        return
+    if mode == "hardlink":
+        try:
+            if os.path.lexists(dst_path):
+                os.remove(dst_path)
+            os.link(src_path, dst_path)
+            return
+        except OSError:
+            # 跨设备/文件系统不支持硬链接时退回复制
+            pass
+    shutil.copy2(src_path, dst_path)
+
+
+class RecoveryResult(NamedTuple):
+    src_path: str
+    dst_path: str
+    is_image: bool
+    skipped: bool  # manifest 中已有且源文件没变，本次没有动它
+
+
+RECOVERY_MANIFEST = "_recovery.json"
+
+
+def _load_recovery_manifest(path: str) -> Dict[str, Dict[str, Any]]:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+def _save_recovery_manifest(path: str, manifest: Dict[str, Dict[str, Any]]) -> None:
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def _same_content(a: str, b: str) -> bool:
+    try:
+        if os.path.samefile(a, b):
+            return True
+        return os.path.getsize(a) == os.path.getsize(b) and filecmp.cmp(a, b, shallow=False)
+    except OSError:
+        return False
+
+
+def iter_recover_images(
     src_dir: str = "images",
     dst_dir: str = "recovery_images",
     non_image_subdir: str = "_non_image",
     read_bytes: int = 64,
-) -> Tuple[int, int, int]:
+    mode: str = "copy",
+    workers: int = 4,
+) -> Iterator[RecoveryResult]:
     """
-    识别 src_dir 下的 .bin 文件真实图片格式，复制到 dst_dir 并改后缀。
-    返回 (processed, recovered_images, non_images)
+    recover_images_from_bin 的生成器版本：每处理完（或跳过）一个 .bin 产出一个 RecoveryResult。
+    - 识别与放置在线程池中进行（workers 个线程），结果按完成顺序产出，调用方在自己的线程里消费
+    - dst_dir/_recovery.json 记录每个源文件的 (大小, mtime) 与恢复结果：没变且目标还在的直接跳过
+    - 目标名已存在时，内容相同视为已恢复（不再生成 _2、_3…），不同才另起新名字
     """
     if not os.path.isdir(src_dir):
         raise FileNotFoundError(f"src_dir not found: {src_dir}")
+    if mode not in RECOVERY_MODES:
+        raise ValueError(f"mode must be one of {RECOVERY_MODES}, got {mode!r}")
 
     os.makedirs(dst_dir, exist_ok=True)
     non_img_dir = os.path.join(dst_dir, non_image_subdir)
     os.makedirs(non_img_dir, exist_ok=True)
 
-    processed = 0
-    recovered = 0
-    non_images = 0
-
-    for name in os.listdir(src_dir):
-        if not name.lower().endswith(".bin"):
-            continue
-
-        processed += 1
-        src_path = os.path.join(src_dir, name)
+    manifest_path = os.path.join(dst_dir, RECOVERY_MANIFEST)
+    manifest = _load_recovery_manifest(manifest_path)
+    new_manifest: Dict[str, Dict[str, Any]] = {}
+    lock = threading.Lock()
+    reserved: set = set()
 
+    def choose_dst(src_path: str, base: str, ext: str) -> Tuple[str, bool]:
+        """返回 (目标路径, 是否已经是同内容的文件)；在锁内选名，避免并发时两个文件抢同一个名字。"""
+        with lock:
+            i = 1
+            while True:
+                name = base + ext if i == 1 else f"{base}_{i}{ext}"
+                i += 1
+                if name in reserved:
+                    continue
+                dst_path = os.path.join(dst_dir, name)
+                if not os.path.exists(dst_path):
+                    reserved.add(name)
+                    return dst_path, False
+                if _same_content(src_path, dst_path):
+                    reserved.add(name)
+                    return dst_path, True
+
+    def recover_one(name: str, src_path: str, sig: List[int]) -> Tuple[str, List[int], RecoveryResult]:
         try:
             with open(src_path, "rb") as f:
                 header = f.read(read_bytes)
         except OSError:
-            non_images += 1
-            shutil.copy2(src_path, os.path.join(non_img_dir, name))
-            continue
+            header = b""
 
         ext = _sniff_image_ext(header)
 
         if ext is None or _looks_like_text(header):
-            non_images += 1
-            shutil.copy2(src_path, os.path.join(non_img_dir, name))
-            continue
+            dst_path = os.path.join(non_img_dir, name)
+            _place(src_path, dst_path, mode)
+            return name, sig, RecoveryResult(src_path, dst_path, False, False)
+
+        dst_path, done = choose_dst(src_path, os.path.splitext(name)[0], ext)
+        if not done:
+            _place(src_path, dst_path, mode)
+        elif mode == "rename":
+            os.remove(src_path)
+        return name, sig, RecoveryResult(src_path, dst_path, True, False)
+
+    todo: List[Tuple[str, str, List[int]]] = []
+    with os.scandir(src_dir) as it:
+        for entry in it:
+            if not entry.name.lower().endswith(".bin") or not entry.is_file():
+                continue
+            st = entry.stat()
+            sig = [st.st_size, st.st_mtime_ns]
+            rec = manifest.get(entry.name)
+            if rec is not None and rec.get("sig") == sig:
+                dst_path = os.path.join(dst_dir, rec["dst"])
+                if os.path.exists(dst_path):
+                    new_manifest[entry.name] = rec
+                    yield RecoveryResult(entry.path, dst_path, bool(rec.get("image")), True)
+                    continue
+            todo.append((entry.name, entry.path, sig))
+
+    try:
+        if todo:
+            with ThreadPoolExecutor(max_workers=max(1, workers)) as ex:
+                futures = [ex.submit(recover_one, *job) for job in todo]
+                for fut in as_completed(futures):
+                    name, sig, result = fut.result()
+                    # rename 模式下源文件已经不在了，不需要记
+                    if mode != "rename":
+                        new_manifest[name] = {
+                            "sig": sig,
+                            "dst": os.path.relpath(result.dst_path, dst_dir).replace(os.sep, "/"),
+                            "image": result.is_image,
+                        }
+                    yield result
+    finally:
+        # 源目录里已经没有的条目一并清掉；没有变化时不写文件
+        if new_manifest != manifest:
+            _save_recovery_manifest(manifest_path, new_manifest)
 
-        base = os.path.splitext(name)[0]
-        dst_path = os.path.join(dst_dir, base + ext)
 
-        if os.path.exists(dst_path):
-            i = 2
-            while True:
-                dst_path2 = os.path.join(dst_dir, f"{base}_{i}{ext}")
-                if not os.path.exists(dst_path2):
-                    dst_path = dst_path2
-                    break
-                i += 1
+def recover_images_from_bin(
+    src_dir: str = "images",
+    dst_dir: str = "recovery_images",
+    non_image_subdir: str = "_non_image",
+    read_bytes: int = 64,
+    mode: str = "copy",
+    on_result: Optional[Callable[[str, str, bool], None]] = None,
+    workers: int = 4,
+) -> Tuple[int, int, int]:
+    """
+    识别 src_dir 下的 .bin 文件真实图片格式，放到 dst_dir 并改后缀。
+    - mode="copy"：复制（默认，保留原文件）
+    - mode="hardlink"：硬链接，不额外占用空间也不重写数据；不支持时退回复制
+    - mode="rename"：直接移动/改名，dst_dir 可以等于 src_dir（原地修正后缀）
+    - 并发与跳过规则见 iter_recover_images；重复运行不会产生重复文件
+    on_result(src_path, dst_path, is_image) 在每个文件放置完成后（在调用线程里）调用，
+    如同步更新 SqliteDiaryStore 的图片路径；跳过的文件不回调
+    返回 (processed, recovered_images, non_images)，都不含跳过的文件
+    """
+    processed = 0
+    recovered = 0
+    non_images = 0
 
-        shutil.copy2(src_path, dst_path)
-        recovered += 1
+    for r in iter_recover_images(src_dir, dst_dir, non_image_subdir, read_bytes, mode, workers):
+        if r.skipped:
+            continue
+        processed += 1
+        if r.is_image:
+            recovered += 1
+        else:
+            non_images += 1
+        if on_result is not None:
+            on_result(r.src_path, r.dst_path, r.is_image)
 
     return processed, recovered, non_images
@@ -0,0 +1,54 @@
+# tests/conftest.py
+import os
+import sys
+from typing import Any, Callable, Iterator
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+import fetch_data  # noqa: E402
+import main  # noqa: E402
+from bench.mock_server import MockNiderijiServer  # noqa: E402
+from bench.synthetic import SyntheticAccount  # noqa: E402
+
+
+@pytest.fixture
+def account() -> SyntheticAccount:
+    return SyntheticAccount(n_diaries=40, n_images=12, image_kb=4)
+
+
+@pytest.fixture
+def mock_server(account: SyntheticAccount, monkeypatch: pytest.MonkeyPatch) -> Iterator[MockNiderijiServer]:
+    """进程内的 nideriji 替身；fetch_data 的服务地址指向它。"""
+    server = MockNiderijiServer(account).start()
+    base = server.base_url
+    monkeypatch.setattr(fetch_data, "API_HOST", base)
+    monkeypatch.setattr(fetch_data, "LOGIN_URL", f"{base}/api/login/")
+    monkeypatch.setattr(fetch_data, "SYNC_URL", f"{base}/api/v2/sync/")
+    monkeypatch.setattr(fetch_data, "IMAGE_HOST", base)
+    monkeypatch.setenv("NO_PROXY", "127.0.0.1,localhost")
+    monkeypatch.setenv("NIDERIJI_EMAIL", "test@example.com")
+    monkeypatch.setenv("NIDERIJI_PASSWORD", "test")
+    try:
+        yield server
+    finally:
+        server.stop()
+
+
+@pytest.fixture
+def run_main(
+    mock_server: MockNiderijiServer, tmp_path: Any, monkeypatch: pytest.MonkeyPatch
+) -> Callable[..., int]:
+    """在 tmp_path 里运行 main.main(argv)，去掉限速，返回退出码。"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(main, "TEXT_RATE_RPS", 0)
+    monkeypatch.setattr(main, "IMAGE_RATE_RPS", 0)
+
+    def run(*argv: str) -> int:
+        mock_server.reset_stats()
+        return main.main(list(argv))
+
+    return run
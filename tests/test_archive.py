@@ -0,0 +1,56 @@
+# tests/test_archive.py
+import re
+import tarfile
+import zipfile
+
+import pytest
+
+from archive import ArchiveWriter, archive_format
+
+
+def _members(path):
+    if path.endswith(".zip"):
+        with zipfile.ZipFile(path) as z:
+            return {name: z.read(name) for name in z.namelist()}
+    with tarfile.open(path) as t:
+        return {m.name: t.extractfile(m).read() for m in t.getmembers()}
+
+
+@pytest.mark.parametrize("name", ["out.tar", "out.tar.gz", "out.zip"])
+def test_archive_round_trip(tmp_path, name):
+    path = str(tmp_path / name)
+    with ArchiveWriter(path) as archive:
+        archive.add_bytes("images/image_1.jpg", b"\xFF\xD8\xFFjpg")
+        with archive.open("dairies.txt") as f:
+            f.write("日记\n" * 1000)
+    assert _members(path) == {
+        "images/image_1.jpg": b"\xFF\xD8\xFFjpg",
+        "dairies.txt": ("日记\n" * 1000).encode("utf-8"),
+    }
+    assert not (tmp_path / (name + ".tmp")).exists()
+
+
+def test_duplicate_member_raises_and_abort_removes_tmp(tmp_path):
+    path = tmp_path / "out.zip"
+    with pytest.raises(ValueError, match="duplicate"):
+        with ArchiveWriter(str(path)) as archive:
+            archive.add_bytes("a.jpg", b"1")
+            archive.add_bytes("a.jpg", b"2")
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_archive_format_rejects_unknown_suffix():
+    assert archive_format("x.TGZ") == "tar.gz"
+    with pytest.raises(ValueError):
+        archive_format("x.rar")
+
+
+def test_archive_export_links_match_members(run_main, tmp_path, account):
+    assert run_main("--archive", "out.zip") == 0
+    members = _members(str(tmp_path / "out.zip"))
+    assert not (tmp_path / "images").exists()
+    html = members["dairies.html"].decode("utf-8")
+    srcs = set(re.findall(r'src="([^"]+)"', html))
+    images = {name for name in members if name.startswith("images/")}
+    assert srcs and srcs <= images
+    assert len([name for name in images if "/_non_image/" not in name]) >= len(srcs)
@@ -0,0 +1,18 @@
+# tests/test_bench.py
+import argparse
+
+import main
+from bench import run_bench
+
+
+def test_offline_scenario_runs_main_offline(mock_server, account, tmp_path):
+    sc = next(s for s in run_bench.SCENARIOS if s.name == "offline")
+    args = argparse.Namespace(
+        workdir=str(tmp_path), keep_rate_limits=False, no_tracemalloc=True, diaries=account.n_diaries,
+    )
+    result = run_bench.run_scenario(sc, args, mock_server.base_url, account, main)
+    assert result["ok"]
+    assert result["server"]["requests"] == 0
+    assert {p["name"] for p in result["phases"]} == {"recover", "html"}
+    log = (tmp_path / "offline" / "bench.log").read_text(encoding="utf-8")
+    assert "[phases] html: run" in log
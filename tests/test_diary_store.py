@@ -0,0 +1,53 @@
+# tests/test_diary_store.py
+from pathlib import Path
+
+import main
+from diary_store import SqliteDiaryStore
+from export_as_html import parse_dairies_txt
+
+
+def _diary(did, ts, content="正文"):
+    return {"id": did, "createddate": f"2020-01-{did:02d}", "ts": ts, "title": f"标题{did}", "content": content}
+
+
+def test_upsert_keeps_newest_ts(tmp_path):
+    with SqliteDiaryStore(str(tmp_path / "d.db")) as store:
+        store.upsert_diaries([_diary(1, 100, "旧"), _diary(2, 100)])
+        store.upsert_diary(_diary(1, 200, "新"))
+        store.upsert_diary(_diary(1, 150, "过期"))
+        assert store.get(1)["content"] == "新"
+        assert store.count() == 2
+        assert store.max_ts() == 200
+        assert [d["id"] for d in store.iter_diaries(since_ts=100, batch=1)] == [1]
+        assert [d["id"] for d in store.iter_diaries(batch=1)] == [1, 2]
+
+
+def test_export_text_round_trips_through_parser(tmp_path):
+    with SqliteDiaryStore(str(tmp_path / "d.db")) as store:
+        store.upsert_diaries([_diary(2, 20, "第二篇\n[图13]"), _diary(1, 10, "第一篇")])
+        assert store.export_text(str(tmp_path / "dairies.txt")) == 2
+    entries = parse_dairies_txt(Path(tmp_path / "dairies.txt"))
+    assert [(e["id"], e["title"]) for e in entries] == [(1, "标题1"), (2, "标题2")]
+
+
+def test_signature_tracks_content_not_files(tmp_path):
+    path = str(tmp_path / "d.db")
+    with SqliteDiaryStore(path) as store:
+        store.upsert_diary(_diary(1, 10))
+        before = store.signature()
+    with SqliteDiaryStore(path) as store:
+        assert store.signature() == before
+        store.set_image_path(5, "images/image_5.jpg")
+        assert store.signature() != before
+        assert store.image_paths() == {5: "images/image_5.jpg"}
+
+
+def test_export_with_diary_db_matches_text_mode(run_main, tmp_path, monkeypatch, account):
+    monkeypatch.setattr(main, "DIARY_DB_PATH", "diaries.db")
+    monkeypatch.setattr(main, "WRITE_DAIRIES_TXT", True)
+    assert run_main() == 0
+    with SqliteDiaryStore(str(tmp_path / "diaries.db")) as store:
+        assert store.count() == account.n_diaries
+        assert len(store.image_paths()) > 0
+    assert len(parse_dairies_txt(tmp_path / "dairies.txt")) == account.n_diaries
+    assert "image_" in (tmp_path / "dairies.html").read_text(encoding="utf-8")
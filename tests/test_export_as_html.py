@@ -0,0 +1,103 @@
+# tests/test_export_as_html.py
+import os
+import random
+from pathlib import Path
+
+from diary_store import format_diary_text
+from export_as_html import (
+    DiaryHtmlWriter,
+    ShardedHtmlWriter,
+    export_as_html,
+    iter_dairies_txt,
+    parse_diary_block,
+    scan_dairies_txt,
+)
+
+
+def _entries(n, seed=15):
+    """DiaryID 升序、日期在 24 个月里乱序（补记的旧日记），让分片反复切换。"""
+    rng = random.Random(seed)
+    for did in range(1, n + 1):
+        month = rng.randint(0, 23)
+        d = {
+            "id": did,
+            "createddate": f"{2016 + month // 12}-{month % 12 + 1:02d}-{rng.randint(1, 28):02d}",
+            "ts": 1000 + did,
+            "title": "",
+            "content": f"第 {did} 篇 [图{did}]",
+        }
+        yield parse_diary_block(format_diary_text(d))
+
+
+def _write_shards(out_dir, max_open, entries):
+    out_dir.mkdir()
+    writer = ShardedHtmlWriter(str(out_dir / "dairies.html"), {}, Path("images"), "month", max_open=max_open)
+    peak = 0
+    for e in entries:
+        writer.write(e)
+        peak = max(peak, sum(w._f is not None for w in writer._writers.values()))
+    writer.close()
+    return peak, {name: (out_dir / name).read_bytes() for name in sorted(os.listdir(out_dir))}
+
+
+def test_sharded_writer_bounds_open_files(tmp_path):
+    entries = list(_entries(300))
+    peak, bounded = _write_shards(tmp_path / "bounded", 2, entries)
+    _, unbounded = _write_shards(tmp_path / "unbounded", 1000, entries)
+    assert peak <= 2
+    assert len([n for n in bounded if n.startswith("dairies-2")]) == 24
+    assert bounded == unbounded
+
+
+def _write_txt(path, ids):
+    entries = {e["id"]: e for e in _entries(max(ids))}
+    with open(path, "w", encoding="utf-8") as f:
+        for did in ids:
+            f.write(format_diary_text({
+                "id": did, "createddate": entries[did]["date"], "ts": 1000 + did, "title": "", "content": f"第 {did} 篇",
+            }))
+
+
+def test_scan_dairies_txt_counts_and_detects_order(tmp_path):
+    _write_txt(tmp_path / "sorted.txt", [1, 2, 5, 9])
+    _write_txt(tmp_path / "unsorted.txt", [1, 5, 2, 9])
+    assert scan_dairies_txt(tmp_path / "sorted.txt") == (4, True)
+    assert scan_dairies_txt(tmp_path / "unsorted.txt") == (4, False)
+    assert [e["id"] for e in iter_dairies_txt(tmp_path / "unsorted.txt")] == [1, 5, 2, 9]
+
+
+def test_streamed_page_matches_sorted_fallback(tmp_path, monkeypatch):
+    pages = []
+    for name, ids in (("sorted", list(range(1, 51))), ("unsorted", list(range(50, 0, -1)))):
+        os.makedirs(tmp_path / name / "images")
+        monkeypatch.chdir(tmp_path / name)
+        _write_txt("dairies.txt", ids)
+        export_as_html("dairies.txt", "images", "dairies.html")
+        pages.append((tmp_path / name / "dairies.html").read_bytes())
+    assert pages[0] == pages[1]
+    assert pages[0].count(b"<section") == 50
+
+
+def test_diary_html_writer_abort_and_unchanged_digest(tmp_path):
+    out = tmp_path / "dairies.html"
+    entries = list(_entries(5))
+
+    writer = DiaryHtmlWriter(str(out), {}, Path("images"))
+    for e in entries:
+        writer.write(e)
+    writer.close()
+    assert writer.count == 5 and sum(writer.dates.values()) == 5
+    mtime = out.stat().st_mtime_ns
+
+    writer = DiaryHtmlWriter(str(out), {}, Path("images"), unchanged_digest=writer.digest)
+    for e in entries:
+        writer.write(e)
+    writer.close()
+    assert not writer.changed
+    assert out.stat().st_mtime_ns == mtime
+
+    writer = DiaryHtmlWriter(str(out), {}, Path("images"))
+    writer.write(entries[0])
+    writer.abort()
+    assert out.stat().st_mtime_ns == mtime
+    assert sorted(os.listdir(tmp_path)) == ["dairies.html"]
@@ -0,0 +1,467 @@
+# tests/test_fetch_data.py
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import requests
+
+import fetch_data
+from fetch_data import (
+    AdaptiveBatchSizer,
+    AIMDController,
+    CircuitBreaker,
+    FairShareScheduler,
+    NiderijiSession,
+    RetryPolicy,
+    _all_by_ids_bisect,
+    _apply_sync_to_state,
+    _call_with_retry,
+    _download_one_image,
+    _ordered_map,
+    _StreamingJsonObject,
+    export_images_by_image_ids,
+    missing_image_ids,
+    new_sync_state,
+)
+from image_store import ImageStore
+
+
+def _touch(path, data=b"\xFF\xD8\xFFdata"):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def test_missing_image_ids_counts_deleted_empty_and_partial(tmp_path):
+    images = tmp_path / "images"
+    _touch(str(images / "image_1.jpg"))
+    _touch(str(images / "image_2.png"), b"")
+    _touch(str(images / "image_3.part"))
+    _touch(str(images / "_non_image" / "image_4.bin"), b"<html>")
+    assert missing_image_ids([1, 2, 3, 4, 5], str(images)) == [2, 3, 4, 5]
+
+
+def test_missing_image_ids_caps_non_image_retries(tmp_path):
+    images = tmp_path / "images"
+    _touch(str(images / "_non_image" / "image_4.bin"), b"<html>")
+    _touch(str(images / "_non_image" / "image_6.bin"), b"<html>")
+    _touch(str(images / "image_6.jpg"))
+    tries = {"6": 1}
+    assert missing_image_ids([4, 6], str(images), non_image_tries=tries, max_non_image_tries=2) == [4]
+    assert missing_image_ids([4, 6], str(images), non_image_tries=tries, max_non_image_tries=2) == [4]
+    assert missing_image_ids([4, 6], str(images), non_image_tries=tries, max_non_image_tries=2) == []
+    assert tries == {"4": 2}
+
+
+def test_missing_image_ids_checks_store_objects(tmp_path):
+    images = str(tmp_path / "images")
+    os.makedirs(images)
+    store = ImageStore(str(tmp_path / "store"), images)
+    for image_id, body in ((1, b"one"), (2, b"two")):
+        src = str(tmp_path / f"src{image_id}")
+        _touch(src, body)
+        store.add(image_id, src, f"{image_id:064x}", ".jpg")
+    store.save()
+    # 硬链接没了、仓库对象还在：仍然可用；对象也没了：需要重新下载
+    os.remove(os.path.join(images, "image_1.jpg"))
+    os.remove(os.path.join(images, "image_2.jpg"))
+    os.remove(store.object_path(f"{2:064x}", ".jpg"))
+    assert missing_image_ids([1, 2], images, str(tmp_path / "store")) == [2]
+
+
+def _stream_items(text, cuts, stream_keys=("diaries", "images")):
+    data = text.encode("utf-8")
+    bounds = [0] + sorted(cuts) + [len(data)]
+    chunks = [data[a:b] for a, b in zip(bounds, bounds[1:])]
+    return list(_StreamingJsonObject(chunks).items(stream_keys))
+
+
+def _expected_items(text, stream_keys=("diaries", "images")):
+    items = []
+    for key, value in json.loads(text).items():
+        if key in stream_keys and isinstance(value, list):
+            items.extend((key, v) for v in value)
+        else:
+            items.append((key, value))
+    return items
+
+
+SYNC_SAMPLE = (
+    '{"user_config_ts": 1500000000000.5, "diaries": [{"id": 1, "ts": 1.25e3, "title": "雨"},'
+    ' 3.5, -0.125e-2, 12345, 6E+2], "diaries_ts": 1500000001000.75,'
+    ' "images": [], "readmark_ts": 2.5e10, "flag": true, "none": null, "last": -7.0}'
+)
+
+
+def test_streaming_json_every_single_cut():
+    expected = _expected_items(SYNC_SAMPLE)
+    for cut in range(1, len(SYNC_SAMPLE.encode("utf-8"))):
+        assert _stream_items(SYNC_SAMPLE, [cut]) == expected, cut
+
+
+def test_streaming_json_random_cuts():
+    rng = random.Random(6)
+    size = len(SYNC_SAMPLE.encode("utf-8"))
+    expected = _expected_items(SYNC_SAMPLE)
+    for _ in range(3000):
+        cuts = rng.sample(range(1, size), rng.randint(1, 12))
+        assert _stream_items(SYNC_SAMPLE, cuts) == expected, cuts
+
+
+def test_streaming_json_rejects_malformed():
+    with pytest.raises(ValueError):
+        _stream_items('{"a": 1.}', [])
+
+
+def test_apply_sync_merges_and_clears_retry_diaries():
+    state = new_sync_state()
+    state["diaries"] = {"5": 100, "7": 200}
+    state["diaries_ts"] = 200
+    state["retry_diaries"] = [5]
+    diaries, images = _apply_sync_to_state(state, {"diaries": [{"id": 9, "ts": 300}], "diaries_ts": 300})
+    assert diaries == [5, 9]
+    assert images == []
+    assert state["retry_diaries"] == []
+    assert state["diaries_ts"] == 300
+
+
+def test_scheduler_interrupted_acquire_does_not_leak_ticket():
+    sched = FairShareScheduler(1)
+    sched.acquire("a")
+
+    def interrupted(*args, **kwargs):
+        raise KeyboardInterrupt
+
+    sched._cond.wait = interrupted
+    with pytest.raises(KeyboardInterrupt):
+        sched.acquire("b")
+    del sched._cond.wait
+
+    sched.release()
+    got = threading.Event()
+    t = threading.Thread(target=lambda: (sched.acquire("b"), got.set()), daemon=True)
+    t.start()
+    assert got.wait(2)
+    assert sched.granted == {"a": 1, "b": 1}
+
+
+def test_rate_limit_wait_happens_before_taking_shared_slot():
+    sched = FairShareScheduler(4)
+    seen = []
+
+    class Limiter:
+        def acquire_request(self):
+            seen.append(sched._inflight)
+            return 0.0
+
+    assert _call_with_retry(lambda: "ok", controller=sched.controller("a"), rate_limiter=Limiter()) == "ok"
+    assert seen == [0]
+    assert sched._inflight == 0
+
+
+def _jpg_image_id(account):
+    return next(i for i, kind in sorted(account.kinds.items()) if kind == "jpg")
+
+
+def test_truncated_image_is_not_left_looking_complete(mock_server, account, tmp_path):
+    image_id = _jpg_image_id(account)
+    mock_server.config.truncate_rate = 1.0
+    with pytest.raises(Exception):
+        _download_one_image(requests.Session(), mock_server.auth_headers(), 1, image_id, str(tmp_path))
+    assert os.listdir(tmp_path) in ([], [f"image_{image_id}.part"])
+
+
+def test_partial_image_resumes_with_range(mock_server, account, tmp_path):
+    image_id = _jpg_image_id(account)
+    data, _ = account.image(image_id)
+    # 改掉 .part 里魔数之后的一个字节：续传时这个字节会保留下来，整张重下则不会
+    marked = bytearray(data[: len(data) // 2])
+    marked[8] ^= 0xFF
+    part = tmp_path / f"image_{image_id}.part"
+    part.write_bytes(bytes(marked))
+
+    path = _download_one_image(requests.Session(), mock_server.auth_headers(), 1, image_id, str(tmp_path))
+    assert path == str(tmp_path / f"image_{image_id}.jpg")
+    assert open(path, "rb").read() == bytes(marked) + data[len(marked):]
+    assert not part.exists()
+
+
+def test_export_images_skips_complete_files(mock_server, account, tmp_path):
+    image_id = _jpg_image_id(account)
+    other = next(i for i in sorted(account.kinds) if i != image_id and account.kinds[i] != "error")
+    (tmp_path / f"image_{image_id}.jpg").write_bytes(account.image(image_id)[0])
+    export_images_by_image_ids(requests.Session(), mock_server.issue_token(), 1, [image_id, other], str(tmp_path), sleep_s=0)
+    assert mock_server.stats["images"] == 1
+    assert not any(name.endswith(".part") for name in os.listdir(tmp_path))
+
+
+def _http_error(status):
+    resp = requests.Response()
+    resp.status_code = status
+    return requests.HTTPError(f"{status}", response=resp)
+
+
+def _count_all_by_ids(monkeypatch, error, bad=None):
+    calls = []
+
+    def fake(session, token, userid, diary_ids):
+        calls.append(list(diary_ids))
+        if bad is None or bad in diary_ids:
+            raise error
+        return [{"id": did} for did in diary_ids]
+
+    monkeypatch.setattr(fetch_data, "_all_by_ids", fake)
+    return calls
+
+
+def test_bisect_only_on_errors_a_smaller_batch_can_fix(monkeypatch):
+    retry = RetryPolicy(max_attempts=1)
+    calls = _count_all_by_ids(monkeypatch, requests.ConnectionError("refused"))
+    assert _all_by_ids_bisect(None, "t", 1, list(range(8)), retry=retry) == ([], list(range(8)))
+    assert len(calls) == 1
+
+    calls = _count_all_by_ids(monkeypatch, _http_error(413), bad=5)
+    diaries, failed = _all_by_ids_bisect(None, "t", 1, list(range(8)), retry=retry)
+    assert failed == [5] and len(diaries) == 7
+
+
+def test_circuit_breaker_stops_requests_when_server_is_down(monkeypatch):
+    breaker = CircuitBreaker(threshold=3)
+    calls = _count_all_by_ids(monkeypatch, _http_error(503))
+    for start in range(0, 40, 4):
+        _all_by_ids_bisect(None, "t", 1, list(range(start, start + 4)), retry=RetryPolicy(max_attempts=1),
+                           breaker=breaker)
+    assert breaker.tripped
+    # 第一批拆到单条后失败 3 次就熔断，之后的批次不再请求
+    assert len(calls) <= 6
+
+
+def test_circuit_breaker_resets_on_success():
+    breaker = CircuitBreaker(threshold=2)
+    assert not breaker.on_failure()
+    breaker.on_success()
+    assert not breaker.on_failure()
+    assert breaker.on_failure()
+    breaker.on_success()
+    assert breaker.tripped
+
+
+def _cached_token(tmp_path):
+    return json.loads((tmp_path / ".nideriji_token.json").read_text(encoding="utf-8"))["token"]
+
+
+def test_cached_token_is_reused(run_main, mock_server, tmp_path):
+    assert run_main() == 0
+    assert mock_server.stats["login"] == 1
+    token = _cached_token(tmp_path)
+
+    assert run_main() == 0
+    assert mock_server.stats["login"] == 0
+    assert mock_server.stats["unauthorized"] == 0
+    assert _cached_token(tmp_path) == token
+
+
+def test_stale_token_logs_in_again_and_rewrites_cache(run_main, mock_server, tmp_path):
+    assert run_main() == 0
+    stale = _cached_token(tmp_path)
+    mock_server.expire_tokens()
+    mock_server.account.touch([3])
+
+    assert run_main() == 0
+    assert mock_server.stats["login"] == 1
+    assert mock_server.stats["unauthorized"] == 1
+    assert mock_server.stats["diaries_served"] == 1
+    assert _cached_token(tmp_path) not in ("", stale)
+
+
+def test_concurrent_401s_log_in_once(mock_server, tmp_path):
+    session = NiderijiSession("test@example.com", "test", token_cache_path=str(tmp_path / "token.json"))
+    session.ensure_login()
+    mock_server.expire_tokens()
+    mock_server.reset_stats()
+    url = f"{fetch_data.IMAGE_HOST}/api/image/1/{{}}/"
+    with ThreadPoolExecutor(max_workers=8) as ex:
+        statuses = list(ex.map(lambda i: session.get(url.format(i), timeout=10).status_code, range(1, 9)))
+    assert statuses == [200] * 8
+    assert mock_server.stats["login"] == 1
+
+
+def test_ordered_map_keeps_input_order():
+    rng = random.Random(2)
+    delays = [rng.uniform(0, 0.01) for _ in range(60)]
+
+    def fn(i):
+        time.sleep(delays[i])
+        return i * i
+
+    assert list(_ordered_map(fn, range(60), workers=8, max_pending=16)) == [i * i for i in range(60)]
+
+
+def test_ordered_map_bounds_pending_items():
+    pulled = []
+    release = threading.Event()
+
+    def items():
+        for i in range(100):
+            pulled.append(i)
+            yield i
+
+    def fn(i):
+        # 第一个任务卡住：后面的做完了也只能在缓冲里等
+        if i == 0:
+            release.wait(5)
+        return i
+
+    results = _ordered_map(fn, items(), workers=4, max_pending=6)
+    waiter = threading.Thread(target=lambda: (time.sleep(0.2), release.set()))
+    waiter.start()
+    first = next(results)
+    assert first == 0
+    assert len(pulled) <= 7
+    assert list(results) == list(range(1, 100))
+    waiter.join()
+
+
+def test_ordered_map_propagates_errors_and_stops():
+    calls = []
+
+    def fn(i):
+        calls.append(i)
+        if i == 3:
+            raise ValueError("boom")
+        return i
+
+    with pytest.raises(ValueError):
+        list(_ordered_map(fn, range(1000), workers=2, max_pending=4))
+    assert len(calls) < 20
+
+
+def test_aimd_grows_additively_and_halves_once_per_cooldown():
+    ctl = AIMDController(initial=4, max_limit=8, cooldown_s=60)
+    # 每次成功 +1/limit：约一整窗口的成功 +1
+    for _ in range(5):
+        ctl.on_success(0.01)
+    assert ctl.limit == 5
+    ctl.on_congestion()
+    ctl.on_congestion()
+    assert ctl.limit == 2
+    for _ in range(100):
+        ctl.on_success(0.01)
+    assert ctl.limit == 8
+
+
+def test_aimd_latency_target():
+    ctl = AIMDController(initial=4, latency_target_s=1.0, cooldown_s=0)
+    ctl.on_success(1.5)
+    assert ctl.limit == 4
+    ctl.on_success(2.5)
+    assert ctl.limit == 2
+
+
+def test_aimd_limits_inflight():
+    ctl = AIMDController(initial=2, max_limit=2)
+    ctl.acquire()
+    ctl.acquire()
+    entered = threading.Event()
+    t = threading.Thread(target=lambda: (ctl.acquire(), entered.set()))
+    t.start()
+    assert not entered.wait(0.1)
+    ctl.release()
+    assert entered.wait(5)
+    t.join()
+
+
+def test_retry_policy_honours_retry_after_and_classifies_errors():
+    policy = RetryPolicy(base_delay_s=0.01, max_delay_s=1.0)
+    assert policy.delay(0, retry_after=3.0) == 3.0
+    assert policy.delay(0, retry_after=100.0) == 4.0
+    assert 0 <= policy.delay(10) <= 1.0
+    assert policy.is_retryable(_http_error(429))
+    assert policy.is_retryable(requests.ConnectionError())
+    assert not policy.is_retryable(_http_error(404))
+
+
+def test_call_with_retry_backs_off_on_503_and_reports_congestion(monkeypatch):
+    monkeypatch.setattr(time, "sleep", lambda s: None)
+    ctl = AIMDController(initial=8, cooldown_s=0)
+    errors = [_http_error(503), _http_error(503)]
+
+    def fn():
+        if errors:
+            raise errors.pop()
+        return "ok"
+
+    assert _call_with_retry(fn, RetryPolicy(max_attempts=3), ctl) == "ok"
+    assert ctl.limit == 2
+
+    errors = [_http_error(404)]
+    with pytest.raises(requests.HTTPError):
+        _call_with_retry(fn, RetryPolicy(max_attempts=3), ctl)
+    assert ctl.limit == 2
+
+
+def test_adaptive_batch_sizer_grows_and_shrinks():
+    sizer = AdaptiveBatchSizer(initial=40, max_size=100, target_latency_s=2.0, max_response_bytes=1000)
+    sizer.on_success(40, 0.5, 100)
+    assert sizer.size == 50
+    # 延迟是目标的两倍：按比例缩到能在目标内完成的大小
+    sizer.on_success(50, 4.0, 100)
+    assert sizer.size == 25
+    # 响应太大同样按比例缩
+    sizer.on_success(25, 0.1, 5000)
+    assert sizer.size == 5
+    sizer.on_failure()
+    assert sizer.size == 2
+    for _ in range(3):
+        sizer.on_failure()
+    assert sizer.size == 1
+
+
+def test_adaptive_batch_sizer_ignores_tail_batches_and_caps():
+    sizer = AdaptiveBatchSizer(initial=40, max_size=60)
+    sizer.on_success(3, 0.01, 10)
+    assert sizer.size == 40
+    for _ in range(10):
+        sizer.on_success(sizer.size, 0.01, 10)
+    assert sizer.size == 60
+
+
+def _acquire_in_thread(ctl):
+    done = threading.Event()
+    t = threading.Thread(target=lambda: (ctl.acquire(), done.set()), daemon=True)
+    t.start()
+    return done
+
+
+def test_shared_controller_takes_account_and_global_slots():
+    sched = FairShareScheduler(2)
+    a = sched.controller("a", initial=4, max_limit=4)
+    b = sched.controller("b", initial=1, max_limit=1)
+    a.acquire()
+    a.acquire()
+    # 全局名额用完：b 有自己的名额也得等
+    b_done = _acquire_in_thread(b)
+    assert not b_done.wait(0.1)
+    a.release()
+    assert b_done.wait(5)
+    # b 自己的上限是 1
+    assert not _acquire_in_thread(b).wait(0.1)
+    assert sched.granted == {"a": 2, "b": 1}
+
+
+def test_shared_controller_releases_account_slot_when_scheduler_fails(monkeypatch):
+    sched = FairShareScheduler(1)
+    ctl = sched.controller("a", initial=1, max_limit=1)
+
+    def interrupted(account):
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(sched, "acquire", interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        ctl.acquire()
+    monkeypatch.undo()
+    assert _acquire_in_thread(ctl).wait(1)
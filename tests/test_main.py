@@ -0,0 +1,221 @@
+# tests/test_main.py
+import json
+import os
+import time
+
+import pytest
+
+import main
+
+
+def _image_files(images_dir):
+    return sorted(n for n in os.listdir(images_dir) if n.startswith("image_"))
+
+
+def test_incremental_run_refetches_deleted_image(run_main, mock_server, tmp_path):
+    assert run_main() == 0
+    images = _image_files(tmp_path / "images")
+    victim = images[0]
+    os.remove(tmp_path / "images" / victim)
+
+    assert run_main() == 0
+    assert mock_server.stats["images"] == 1
+    assert _image_files(tmp_path / "images") == images
+
+
+def test_incremental_run_refetches_empty_image(run_main, mock_server, tmp_path):
+    assert run_main() == 0
+    victim = tmp_path / "images" / _image_files(tmp_path / "images")[0]
+    victim.write_bytes(b"")
+
+    assert run_main() == 0
+    assert mock_server.stats["images"] == 1
+    assert victim.stat().st_size > 0
+
+
+@pytest.mark.parametrize("pipeline", [True, False])
+def test_failed_diary_is_retried_next_run(run_main, mock_server, tmp_path, monkeypatch, pipeline):
+    monkeypatch.setattr(main, "PIPELINE", pipeline)
+    monkeypatch.setattr(main, "MAX_ATTEMPTS", 1)
+    mock_server.fail_diaries = {17}
+    assert run_main() == 0
+    assert "=== DiaryID: 17 | (no data) ===" in (tmp_path / "dairies.txt").read_text(encoding="utf-8")
+
+    mock_server.fail_diaries = set()
+    assert run_main() == 0
+    assert mock_server.stats["diaries_served"] == 1
+    text = (tmp_path / "dairies.txt").read_text(encoding="utf-8")
+    assert "(no data)" not in text
+    assert "=== DiaryID: 17 | Date:" in text
+    assert "(no data)" not in (tmp_path / "dairies.html").read_text(encoding="utf-8")
+
+    # 成功之后不再重复抓取
+    assert run_main() == 0
+    assert mock_server.stats["all_by_ids"] == 0
+
+
+def _block(text, did):
+    start = text.index(f"=== DiaryID: {did} |")
+    return text[start:text.index("=== DiaryID:", start + 1)]
+
+
+@pytest.mark.parametrize("diary_db", [None, "diaries.db"])
+def test_failed_refetch_keeps_previous_content(run_main, mock_server, tmp_path, monkeypatch, capsys, diary_db):
+    monkeypatch.setattr(main, "DIARY_DB_PATH", diary_db)
+    monkeypatch.setattr(main, "MAX_ATTEMPTS", 1)
+    assert run_main() == 0
+    old = _block((tmp_path / "dairies.txt").read_text(encoding="utf-8"), 3)
+
+    mock_server.account.touch([3, 4])
+    mock_server.fail_diaries = {3}
+    capsys.readouterr()
+    assert run_main() == 0
+    assert _block((tmp_path / "dairies.txt").read_text(encoding="utf-8"), 3) == old
+    assert "OK: wrote dairies.html (entries=40," in capsys.readouterr().out
+    sync_state = json.loads((tmp_path / "sync_state.json").read_text(encoding="utf-8"))
+    assert sync_state["retry_diaries"] == [3]
+
+    mock_server.fail_diaries = set()
+    assert run_main() == 0
+    assert "(edited 1)" in _block((tmp_path / "dairies.txt").read_text(encoding="utf-8"), 3)
+
+
+def test_text_phase_gives_up_and_fails_when_all_by_ids_is_down(run_main, mock_server, tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "MAX_ATTEMPTS", 2)
+    assert run_main() == 0
+    old = (tmp_path / "dairies.txt").read_text(encoding="utf-8")
+
+    ids = range(1, mock_server.account.n_diaries + 1)
+    mock_server.account.touch(ids)
+    mock_server.fail_diaries = set(ids)
+    assert run_main() == 1
+    # 熔断：不会对每篇日记都重试一遍
+    assert mock_server.stats["errors_injected"] < 30
+    assert (tmp_path / "dairies.txt").read_text(encoding="utf-8") == old
+    sync_state = json.loads((tmp_path / "sync_state.json").read_text(encoding="utf-8"))
+    assert sync_state["retry_diaries"] == list(ids)
+
+    mock_server.fail_diaries = set()
+    assert run_main() == 0
+    assert "(edited" in _block((tmp_path / "dairies.txt").read_text(encoding="utf-8"), 3)
+
+
+def _phase_sleeps(tmp_path, phase):
+    report = json.loads((tmp_path / "run_report.json").read_text(encoding="utf-8"))
+    return report["phases"][phase].get("sleep_seconds", {})
+
+
+def test_pipeline_does_not_wait_for_skipped_images(run_main, tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "PIPELINE", True)
+    assert run_main() == 0
+    # 正文全部重新导出，图片都已在本地；图片阶段拖到最后才结束
+    os.remove(tmp_path / "dairies.txt")
+    original = main._export_images
+
+    def slow_export_images(*args, **kwargs):
+        original(*args, **kwargs)
+        time.sleep(1.0)
+
+    monkeypatch.setattr(main, "_export_images", slow_export_images)
+    assert run_main() == 0
+    assert _phase_sleeps(tmp_path, "html").get("wait_image", 0) < 0.5
+
+
+def _phase_log(capsys):
+    return [line for line in capsys.readouterr().out.splitlines() if line.startswith("[phases]")]
+
+
+def test_html_with_diary_db_is_skipped_when_nothing_changed(run_main, monkeypatch, capsys):
+    monkeypatch.setattr(main, "DIARY_DB_PATH", "diaries.db")
+    assert run_main() == 0
+    capsys.readouterr()
+
+    assert run_main() == 0
+    assert "[phases] html: up to date, skipped" in _phase_log(capsys)
+    assert run_main("--offline") == 0
+    assert _phase_log(capsys) == ["[phases] recover: up to date, skipped", "[phases] html: up to date, skipped"]
+
+
+def test_html_with_diary_db_reruns_after_remote_change(run_main, mock_server, monkeypatch, capsys):
+    monkeypatch.setattr(main, "DIARY_DB_PATH", "diaries.db")
+    monkeypatch.setattr(main, "PIPELINE", False)
+    assert run_main() == 0
+    mock_server.account.touch([3])
+    capsys.readouterr()
+    assert run_main() == 0
+    log = _phase_log(capsys)
+    assert "[phases] text: run (1 remote changes)" in log
+    assert any(line.startswith("[phases] html: run (changed") for line in log)
+
+
+def test_deleted_image_makes_images_phase_run(run_main, mock_server, tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(main, "PIPELINE", False)
+    assert run_main() == 0
+    os.remove(tmp_path / "images" / _image_files(tmp_path / "images")[0])
+    capsys.readouterr()
+    assert run_main() == 0
+    out = capsys.readouterr().out
+    assert "[phases] images: run (1 missing locally)" in out
+    assert mock_server.stats["images"] == 1
+
+
+def test_pipeline_does_not_recover_unless_selected(run_main, mock_server, tmp_path):
+    assert run_main() == 0
+    legacy = tmp_path / "images" / "image_999.bin"
+    legacy.write_bytes(b"\xFF\xD8\xFF\xE0legacy")
+    mock_server.account.touch([3])
+    assert run_main("--only", "text,html") == 0
+    assert legacy.exists()
+    assert run_main() == 0
+    assert not legacy.exists()
+
+
+def test_force_refetches_text_and_images(run_main, mock_server, account):
+    assert run_main() == 0
+    assert run_main("--force") == 0
+    assert mock_server.stats["diaries_served"] >= account.n_diaries
+    assert mock_server.stats["images"] == account.n_images
+
+
+def test_deleted_shard_page_is_regenerated(run_main, tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "HTML_SHARD", "month")
+    assert run_main() == 0
+    shard = tmp_path / "dairies-2016-01.html"
+    content = shard.read_bytes()
+    shard.unlink()
+    assert run_main("--offline") == 0
+    assert shard.read_bytes() == content
+
+
+def test_error_page_image_is_downloaded_again(run_main, mock_server, tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(main, "NON_IMAGE_RETRIES", 2)
+    assert run_main() == 0
+    images = tmp_path / "images"
+    victim = _image_files(images)[0]
+    os.makedirs(images / "_non_image", exist_ok=True)
+    os.remove(images / victim)
+    (images / "_non_image" / (os.path.splitext(victim)[0] + ".bin")).write_bytes(b"<html>502 Bad Gateway</html>")
+
+    capsys.readouterr()
+    assert run_main() == 0
+    assert mock_server.stats["images"] == 1
+    assert victim in _image_files(images)
+    assert "missing images" not in capsys.readouterr().out
+
+    assert run_main() == 0
+    assert mock_server.stats["images"] == 0
+    sync_state = json.loads((tmp_path / "sync_state.json").read_text(encoding="utf-8"))
+    assert sync_state["non_image_tries"] == {}
+
+
+def test_non_image_retries_are_capped(run_main, mock_server, tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "NON_IMAGE_RETRIES", 2)
+    # 服务端对这张图一直返回错误页
+    mock_server.account.kinds[1] = "error"
+    assert run_main() == 0
+    assert os.listdir(tmp_path / "images" / "_non_image") == ["image_1.bin"]
+    requested = []
+    for _ in range(3):
+        assert run_main() == 0
+        requested.append(mock_server.stats["images"])
+    assert requested == [1, 1, 0]
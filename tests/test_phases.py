@@ -0,0 +1,63 @@
+# tests/test_phases.py
+import os
+
+from metrics import RunMetrics
+from phases import Phase, PhaseGraph
+
+
+def _graph(tmp_path, **kw):
+    return PhaseGraph(str(tmp_path / "phases.json"), metrics=RunMetrics(), **kw)
+
+
+def _phase(tmp_path, runs, params=None, pending=None):
+    src = tmp_path / "src.txt"
+    out = tmp_path / "out.txt"
+
+    def run():
+        runs.append(1)
+        out.write_text(src.read_text())
+
+    return Phase("build", run, inputs=[str(src)], outputs=[str(out)], params=params, pending=pending)
+
+
+def test_phase_skips_until_input_changes(tmp_path):
+    runs = []
+    (tmp_path / "src.txt").write_text("a")
+    assert _graph(tmp_path).run(_phase(tmp_path, runs))
+    assert not _graph(tmp_path).run(_phase(tmp_path, runs))
+
+    (tmp_path / "src.txt").write_text("bb")
+    graph = _graph(tmp_path)
+    assert graph.stale_reason(_phase(tmp_path, runs)) == f"changed {tmp_path / 'src.txt'}"
+    assert graph.run(_phase(tmp_path, runs))
+    assert len(runs) == 2
+
+
+def test_phase_reruns_for_missing_output_params_and_force(tmp_path):
+    runs = []
+    (tmp_path / "src.txt").write_text("a")
+    _graph(tmp_path).run(_phase(tmp_path, runs, params=lambda: {"v": 1}))
+
+    os.remove(tmp_path / "out.txt")
+    assert _graph(tmp_path).stale_reason(_phase(tmp_path, runs)).startswith("missing ")
+    _graph(tmp_path).run(_phase(tmp_path, runs, params=lambda: {"v": 1}))
+
+    assert _graph(tmp_path).stale_reason(_phase(tmp_path, runs, params=lambda: {"v": 2})) == "changed params"
+    assert _graph(tmp_path, force=True).stale_reason(_phase(tmp_path, runs, params=lambda: {"v": 1})) == "forced"
+
+
+def test_pending_phase_runs_only_with_remote_changes(tmp_path):
+    runs = []
+    (tmp_path / "src.txt").write_text("a")
+    (tmp_path / "out.txt").write_text("a")
+    graph = _graph(tmp_path)
+    assert not graph.run(_phase(tmp_path, runs, pending=lambda: 0))
+    assert graph.stale_reason(_phase(tmp_path, runs, pending=lambda: 3)) == "3 remote changes"
+    missing = _phase(tmp_path, runs, pending=lambda: 0)
+    missing.missing_local = lambda: 2
+    assert graph.stale_reason(missing) == "2 missing locally"
+    missing.pending = lambda: 1
+    assert graph.stale_reason(missing) == "1 remote changes, 2 missing locally"
+    # 联网阶段不记指纹
+    graph.run(_phase(tmp_path, runs, pending=lambda: 3))
+    assert "build" not in graph.state
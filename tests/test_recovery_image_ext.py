@@ -0,0 +1,72 @@
+# tests/test_recovery_image_ext.py
+import json
+import os
+
+import pytest
+
+from recovery_image_ext import RECOVERY_MANIFEST, iter_recover_images
+
+JPG = b"\xFF\xD8\xFF\xE0" + bytes(range(60))
+HTML = b"<!DOCTYPE html><html>502 Bad Gateway</html>"
+
+
+def _bins(src):
+    os.makedirs(src)
+    for name, data in (("image_1.bin", JPG), ("image_2.bin", HTML), ("image_3.bin", JPG[::-1])):
+        with open(os.path.join(src, name), "wb") as f:
+            f.write(data)
+
+
+def _tree(root):
+    return sorted(os.path.relpath(os.path.join(d, n), root) for d, _, names in os.walk(root) for n in names)
+
+
+@pytest.mark.parametrize("mode", ["copy", "hardlink"])
+def test_rerun_without_manifest_is_idempotent(tmp_path, mode):
+    src, dst = str(tmp_path / "images"), str(tmp_path / "recovery_images")
+    _bins(src)
+    first = list(iter_recover_images(src, dst, mode=mode))
+    assert sorted(r.is_image for r in first) == [False, False, True]
+    tree = _tree(dst)
+
+    os.remove(os.path.join(dst, RECOVERY_MANIFEST))
+    second = list(iter_recover_images(src, dst, mode=mode))
+    assert not any(r.skipped for r in second)
+    assert _tree(dst) == tree
+    assert sorted(r.dst_path for r in second) == sorted(r.dst_path for r in first)
+    if mode == "hardlink":
+        assert os.path.samefile(os.path.join(src, "image_2.bin"), os.path.join(dst, "_non_image", "image_2.bin"))
+
+
+def test_hardlinked_non_image_is_replaced_when_source_is_rewritten(tmp_path):
+    src, dst = str(tmp_path / "images"), str(tmp_path / "recovery_images")
+    _bins(src)
+    list(iter_recover_images(src, dst, mode="hardlink"))
+    # 源文件换成了新文件（不是原地修改），旧的硬链接要被替换
+    path = os.path.join(src, "image_2.bin")
+    os.remove(path)
+    with open(path, "wb") as f:
+        f.write(b"error: still failing")
+    list(iter_recover_images(src, dst, mode="hardlink"))
+    assert os.path.samefile(path, os.path.join(dst, "_non_image", "image_2.bin"))
+
+
+def test_manifest_skips_unchanged_sources(tmp_path):
+    src, dst = str(tmp_path / "images"), str(tmp_path / "recovery_images")
+    _bins(src)
+    assert not any(r.skipped for r in iter_recover_images(src, dst))
+    assert all(r.skipped for r in iter_recover_images(src, dst))
+
+    # 源文件变了、目标被删、源文件没了：分别重新处理、重新生成、从 manifest 中清掉
+    with open(os.path.join(src, "image_3.bin"), "ab") as f:
+        f.write(b"more")
+    os.remove(os.path.join(dst, "image_1.jpg"))
+    os.remove(os.path.join(src, "image_2.bin"))
+    results = {os.path.basename(r.src_path): r for r in iter_recover_images(src, dst)}
+    assert sorted(results) == ["image_1.bin", "image_3.bin"]
+    assert not results["image_1.bin"].skipped and not results["image_3.bin"].skipped
+    assert os.path.exists(os.path.join(dst, "image_1.jpg"))
+    assert not os.path.exists(os.path.join(dst, "image_1_2.jpg"))
+    with open(os.path.join(dst, RECOVERY_MANIFEST), encoding="utf-8") as f:
+        assert sorted(json.load(f)) == ["image_1.bin", "image_3.bin"]
+    assert all(r.skipped for r in iter_recover_images(src, dst))